@@ -0,0 +1,274 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import io
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import tarfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any, Dict, IO, Iterator, List, Optional, Tuple, cast
+)
+
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginUnpackFailed
+)
+
+
+class StashArchive:
+    """
+    **Implements read access to a stash OCI archive**
+
+    The OCI archive is a tarball of an OCI image layout. The
+    tarball is scanned once for the location of its members,
+    blob data is then read directly from the archive file such
+    that multiple blobs can be read concurrently.
+
+    :param str filename: OCI archive file path
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.members: Optional[Dict[str, Tuple[int, int]]] = None
+
+    def get_members(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Provides data offset and size of the regular archive members
+
+        :return: member path to (offset, size) mapping
+
+        :rtype: dict
+        """
+        if self.members is None:
+            members = {}
+            with tarfile.open(self.filename) as archive:
+                for member in archive:
+                    if member.isreg() and not member.issparse():
+                        members[os.path.normpath(member.name)] = (
+                            member.offset_data, member.size
+                        )
+            self.members = members
+        return self.members
+
+    def read(self, path: str) -> bytes:
+        """
+        Read the data of the given archive member
+
+        :param str path: member path in the archive
+
+        :return: member data
+
+        :rtype: bytes
+        """
+        offset, size = self.get_members()[os.path.normpath(path)]
+        with open(self.filename, 'rb') as archive:
+            archive.seek(offset)
+            return archive.read(size)
+
+    def get_digest(self) -> str:
+        """
+        Provides the digest of the archived image
+
+        :return: digest of the first manifest in the archive index
+
+        :rtype: str
+        """
+        return json.loads(self.read('index.json'))['manifests'][0]['digest']
+
+    def get_layers(self) -> List[Dict[str, Any]]:
+        """
+        Provides the layer descriptors of the archived image
+
+        :return: list of layer descriptors in stack order
+
+        :rtype: list
+        """
+        manifests = json.loads(self.read('index.json'))['manifests']
+        while manifests:
+            manifest = json.loads(
+                self.read(self._get_blob_path(manifests[0]['digest']))
+            )
+            if 'manifests' not in manifest:
+                return manifest['layers']
+            manifests = manifest['manifests']
+        return []
+
+    @contextmanager
+    def open_layer(self, descriptor: Dict[str, Any]) -> Iterator[IO[bytes]]:
+        """
+        Open the blob of the given layer as uncompressed tar stream
+
+        The blob is read from the archive file in chunks. gzip
+        compressed layers are decompressed in process, zstd
+        compressed layers through the zstd tool
+
+        :param dict descriptor: layer descriptor from get_layers
+
+        :return: context manager yielding a readable binary stream
+
+        :rtype: contextmanager
+        """
+        offset, size = self.get_members()[
+            self._get_blob_path(descriptor['digest'])
+        ]
+        media_type = descriptor.get('mediaType', '')
+        with open(self.filename, 'rb') as archive:
+            archive.seek(offset)
+            blob = io.BufferedReader(_BlobReader(archive, size))
+            if media_type.endswith('zstd'):
+                with self._decompress_zstd(blob) as stream:
+                    yield stream
+            elif media_type.endswith('gzip'):
+                with gzip.GzipFile(fileobj=blob) as stream:
+                    yield cast(IO[bytes], stream)
+            else:
+                yield blob
+
+    def verify(self, jobs: int = 1) -> Dict[str, str]:
+        """
+        Check all blobs referenced from the archive index
+
+        Every manifest, config and layer blob is hashed and
+        compared against its digest and size. Manifests are
+        checked first as the blobs they reference are only
+        known from an intact manifest. The config and layer
+        blobs are hashed concurrently
+
+        :param int jobs: number of concurrent hash jobs
+
+        :return: digest to problem mapping, empty if the archive is intact
+
+        :rtype: dict
+        """
+        problems: Dict[str, str] = {}
+        blobs: Dict[str, int] = {}
+        try:
+            index = json.loads(self.read('index.json'))
+        except (KeyError, ValueError, tarfile.TarError) as issue:
+            return {'index.json': f'unreadable: {issue}'}
+        manifests = list(index.get('manifests', []))
+        while manifests:
+            descriptor = manifests.pop()
+            digest = descriptor['digest']
+            problem = self._check_blob(digest, descriptor['size'])
+            if problem:
+                problems[digest] = problem
+                continue
+            manifest = json.loads(self.read(self._get_blob_path(digest)))
+            if 'manifests' in manifest:
+                manifests += manifest['manifests']
+            else:
+                for descriptor in [manifest['config']] + manifest['layers']:
+                    blobs[descriptor['digest']] = descriptor['size']
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(
+                lambda blob: self._check_blob(*blob), blobs.items()
+            )
+            for digest, problem in zip(blobs, results):
+                if problem:
+                    problems[digest] = problem
+        return problems
+
+    def _check_blob(self, digest: str, size: int) -> Optional[str]:
+        algorithm, _, value = digest.partition(':')
+        if algorithm not in ('sha256', 'sha512'):
+            return f'unsupported digest algorithm {algorithm!r}'
+        member = self.get_members().get(self._get_blob_path(digest))
+        if not member:
+            return 'missing'
+        offset, member_size = member
+        if member_size != size:
+            return f'size mismatch: {member_size} != {size}'
+        checksum = hashlib.new(algorithm)
+        with open(self.filename, 'rb') as archive:
+            archive.seek(offset)
+            while size:
+                chunk = archive.read(min(size, 1 << 20))
+                if not chunk:
+                    return 'truncated'
+                checksum.update(chunk)
+                size -= len(chunk)
+        if checksum.hexdigest() != value:
+            return 'digest mismatch'
+        return None
+
+    @staticmethod
+    @contextmanager
+    def _decompress_zstd(blob: IO[bytes]) -> Iterator[IO[bytes]]:
+        # the compressed blob is fed to zstd from a thread
+        # while the caller reads the decompressed data
+        try:
+            zstd = subprocess.Popen(
+                ['zstd', '--decompress', '--stdout'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError as issue:
+            raise KiwiStackBuildPluginUnpackFailed(
+                f'Failed to start zstd: {issue}'
+            )
+        assert zstd.stdin and zstd.stdout
+        zstd_input = zstd.stdin
+
+        def feed() -> None:
+            try:
+                shutil.copyfileobj(blob, zstd_input)
+                zstd_input.close()
+            except BrokenPipeError:
+                # zstd exited early, its exit code tells why
+                pass
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        try:
+            yield zstd.stdout
+            zstd.stdout.read()
+        finally:
+            zstd.stdout.close()
+            feeder.join()
+            zstd.wait()
+        if zstd.returncode != 0:
+            raise KiwiStackBuildPluginUnpackFailed(
+                f'zstd decompression failed with exit code {zstd.returncode}'
+            )
+
+    @staticmethod
+    def _get_blob_path(digest: str) -> str:
+        return os.path.join('blobs', *digest.split(':', 1))
+
+
+class _BlobReader(io.RawIOBase):
+    """
+    Reads size bytes from the current position of the archive file
+    """
+    def __init__(self, archive: IO[bytes], size: int) -> None:
+        self.archive = archive
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        data = self.archive.read(min(len(buffer), self.remaining))
+        self.remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
@@ -0,0 +1,258 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import re
+import yaml
+import shlex
+import logging
+from docopt import DocoptExit
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any, Dict, List, Optional
+)
+
+from kiwi.command import Command
+from kiwi.defaults import Defaults
+from kiwi.path import Path
+from kiwi.utils.sync import DataSync
+
+from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+from kiwi_stackbuild_plugin.reflink import StackReflink
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginBatchManifestInvalid
+)
+
+log = logging.getLogger('kiwi')
+
+
+class StackBatch:
+    """
+    **Implements a batch of kiwi builds on one assembled stash root**
+
+    The batch manifest is a YAML file with a list of builds:
+
+    .. code:: yaml
+
+        builds:
+          - name: leap-iso
+            description: leap
+            type: iso
+            profiles: [Desktop]
+            args: [--signing-key, /path/to/key]
+
+    Every build gets its own target directory <target_dir>/<name>
+    with a copy-on-write clone of the assembled stash root as
+    image root. Builds with a description run 'system build' on
+    top of the clone, builds without one run 'system create' from
+    the clone. A relative description path is taken relative to
+    the manifest file. The type and profiles default to the
+    global kiwi options, all other global kiwi options except
+    the log file apply to every build. Each build runs as its
+    own kiwi process writing its own log file, such that builds
+    can run concurrently.
+
+    :param str manifest_file: batch manifest file path
+    :param dict global_args: kiwi global arguments dict
+    """
+    def __init__(
+        self, manifest_file: str, global_args: Dict[str, Any]
+    ) -> None:
+        self.manifest_file = manifest_file
+        self.global_args = global_args
+        self.builds = self._load()
+
+    def get_target_dirs(self, target_dir: str) -> List[str]:
+        """
+        Provides the target directories of the builds
+
+        :param str target_dir: batch target directory
+
+        :return: list of build target directories in manifest order
+
+        :rtype: list
+        """
+        return [
+            os.path.join(target_dir, build['name']) for build in self.builds
+        ]
+
+    def run(
+        self, root_dir: str, target_dir: str, jobs: int = 1,
+        metrics: Optional[StackBuildMetrics] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Run all builds of the batch on clones of root_dir
+
+        :param str root_dir: assembled stash root directory
+        :param str target_dir: batch target directory
+        :param int jobs: number of concurrent builds
+        :param StackBuildMetrics metrics: metrics to record the builds in
+
+        :return: dict of build name to target dir, log file and
+            status, plus the error of a build which failed before
+            its kiwi process ran
+
+        :rtype: dict
+        """
+        metrics = metrics or StackBuildMetrics('batch')
+
+        def run_build(build: Dict[str, Any]) -> Dict[str, Any]:
+            # a failed build setup must not abort the other builds
+            try:
+                return self._run_build(build, root_dir, target_dir, metrics)
+            except Exception as issue:
+                log.error(f'Batch build {build["name"]!r} failed: {issue}')
+                build_target_dir = os.path.join(target_dir, build['name'])
+                return {
+                    'target_dir': build_target_dir,
+                    'log_file': os.path.join(build_target_dir, 'build.log'),
+                    'status': 'failed',
+                    'error': f'{type(issue).__name__}: {issue}'
+                }
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(run_build, self.builds))
+        return {
+            build['name']: result
+            for build, result in zip(self.builds, results)
+        }
+
+    def _run_build(
+        self, build: Dict[str, Any], root_dir: str, target_dir: str,
+        metrics: StackBuildMetrics
+    ) -> Dict[str, Any]:
+        build_target_dir = os.path.join(target_dir, build['name'])
+        build_root_dir = os.path.join(build_target_dir, 'build', 'image-root')
+        log_file = os.path.join(build_target_dir, 'build.log')
+        Path.create(build_root_dir)
+        use_reflink = StackReflink.is_supported(root_dir, build_root_dir)
+        with metrics.phase(
+            'clone', build=build['name'],
+            method='reflink' if use_reflink else 'rsync'
+        ):
+            if use_reflink:
+                StackReflink(root_dir).clone(build_root_dir)
+            else:
+                DataSync(root_dir + os.sep, build_root_dir).sync_data(
+                    options=Defaults.get_sync_options()
+                )
+        command = 'build' if build['description'] else 'create'
+        log.info(
+            f'Running kiwi system {command} for {build["name"]!r}, '
+            f'logging to {log_file!r}'
+        )
+        with metrics.phase(f'kiwi_{command}', build=build['name']):
+            result = Command.run(
+                StackKiwiTask.get_command_line(
+                    command, self._get_command_args(
+                        build, build_root_dir, build_target_dir
+                    ), dict(
+                        self.global_args, **{
+                            '--type': build['type'],
+                            '--profile': build['profiles']
+                        }
+                    ), log_file
+                ), raise_on_error=False
+            )
+        return {
+            'target_dir': build_target_dir,
+            'log_file': log_file,
+            'status': 'ok' if result and result.returncode == 0
+            else 'failed'
+        }
+
+    @staticmethod
+    def _get_command_args(
+        build: Dict[str, Any], root_dir: str, target_dir: str
+    ) -> List[str]:
+        if build['description']:
+            return [
+                '--description', build['description'],
+                '--target-dir', target_dir, '--allow-existing-root'
+            ] + build['args']
+        return [
+            '--root', root_dir, '--target-dir', target_dir
+        ] + build['args']
+
+    def _load(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.manifest_file) as manifest:
+                manifest_data = yaml.safe_load(manifest)
+        except (OSError, yaml.YAMLError) as issue:
+            raise KiwiStackBuildPluginBatchManifestInvalid(
+                f'Failed to read batch manifest: {issue}'
+            )
+        entries = manifest_data.get('builds') \
+            if isinstance(manifest_data, dict) else None
+        if not entries or not isinstance(entries, list):
+            raise KiwiStackBuildPluginBatchManifestInvalid(
+                f'{self.manifest_file}: expected a non empty builds list'
+            )
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_file))
+        builds: List[Dict[str, Any]] = []
+        for index, entry in enumerate(entries, 1):
+            if not isinstance(entry, dict):
+                raise KiwiStackBuildPluginBatchManifestInvalid(
+                    f'{self.manifest_file}: build {index} is not a mapping'
+                )
+            build: Dict[str, Any] = {
+                'name': str(entry.get('name') or f'build-{index}'),
+                'description': entry.get('description'),
+                'type': entry.get('type') or self.global_args.get('--type'),
+                'profiles': entry.get('profiles') or sorted(
+                    set(self.global_args.get('--profile') or [])
+                ),
+                'args': entry.get('args') or []
+            }
+            if isinstance(build['profiles'], str):
+                build['profiles'] = [build['profiles']]
+            if isinstance(build['args'], str):
+                build['args'] = shlex.split(build['args'])
+            build['args'] = [str(arg) for arg in build['args']]
+            if build['description']:
+                build['description'] = os.path.join(
+                    manifest_dir, build['description']
+                )
+            self._check_build(build, builds)
+            builds.append(build)
+        return builds
+
+    def _check_build(
+        self, build: Dict[str, Any], builds: List[Dict[str, Any]]
+    ) -> None:
+        # the build name is the directory of the build below the batch
+        # target directory, which holds the assembled root in build/
+        name = build['name']
+        if name == 'build' or not re.match(r'^[0-9a-zA-Z][\w.-]*$', name):
+            raise KiwiStackBuildPluginBatchManifestInvalid(
+                f'{self.manifest_file}: invalid build name {name!r}'
+            )
+        if name in [other['name'] for other in builds]:
+            raise KiwiStackBuildPluginBatchManifestInvalid(
+                f'{self.manifest_file}: duplicate build name {name!r}'
+            )
+        try:
+            StackKiwiTask.validate(
+                'build' if build['description'] else 'create',
+                self._get_command_args(build, 'root', 'target')
+            )
+        except DocoptExit as issue:
+            raise KiwiStackBuildPluginBatchManifestInvalid(
+                f'{self.manifest_file}: invalid args for build {name!r}: '
+                f'{build["args"]}{os.linesep}{issue}'
+            )
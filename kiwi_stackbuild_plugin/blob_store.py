@@ -0,0 +1,401 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import stat
+import json
+import hashlib
+import logging
+from fnmatch import fnmatch
+from typing import (
+    TYPE_CHECKING, Dict, List, Optional, Tuple
+)
+
+from kiwi.path import Path
+
+from kiwi_stackbuild_plugin.index import StashIndex
+from kiwi_stackbuild_plugin.tree import StackTree
+
+if TYPE_CHECKING:  # pragma: no cover
+    from kiwi_stackbuild_plugin.manifest import StashManifest
+
+log = logging.getLogger('kiwi')
+
+
+class StashBlobStore:
+    """
+    **Implements a content addressed store for stash root trees**
+
+    Every regular file of a stash root is stored once below the
+    blobs directory of the stash home, addressed by the sha256
+    of its content and metadata. The root tree of a stash is
+    kept as a hardlink farm of these blobs at
+    <stash_home>/<name>/root, such that identical files are
+    shared across all stashes. The link count of a file in the
+    stash root therefore does not tell about hardlinks of the
+    stored root tree, these are recorded in the index of the
+    stash root, see get_link_groups.
+
+    The logical and the deduplicated size of every stash root are
+    kept in the stash index, see get_sizes. Adding or removing a
+    stash root changes the share of the blobs used by the other
+    stashes, the sizes of all stash roots are updated then.
+
+    :param str stash_home: stash home directory
+    """
+    def __init__(self, stash_home: str) -> None:
+        self.stash_home = stash_home
+        self.blob_dir = os.path.join(stash_home, '.blobs')
+
+    def add_root(
+        self, name: str, root_dir: str, exclude_list: List[str] = [],
+        manifest: Optional['StashManifest'] = None
+    ) -> Dict[str, int]:
+        """
+        Add the given root tree as stash root to the store
+
+        An already stored root tree for the given stash name
+        gets replaced
+
+        :param str name: stash name
+        :param str root_dir: root directory to store
+        :param list exclude_list: list of path patterns to skip
+        :param StashManifest manifest:
+            manifest of root_dir to take file checksums from
+
+        :return: dict with the bytes not stored again because the
+            file is a hardlink to an already stored blob and the
+            bytes not stored because of holes in sparse files
+
+        :rtype: dict
+        """
+        self._wipe_root(name)
+        stash_root = self._get_stash_root(name)
+        stats = {'hardlink_bytes': 0, 'sparse_bytes': 0}
+        index: Dict[str, List] = {}
+        link_groups: Dict[Tuple[int, int], str] = {}
+        directories = []
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            rel_dir = os.path.relpath(dirpath, root_dir)
+            if rel_dir == os.curdir:
+                rel_dir = ''
+            directories.append(rel_dir)
+            os.makedirs(os.path.join(stash_root, rel_dir), exist_ok=True)
+            for entry in dirnames[:] + filenames:
+                rel_path = os.path.join(rel_dir, entry)
+                if self._is_excluded(rel_path, exclude_list):
+                    if entry in dirnames:
+                        dirnames.remove(entry)
+                    continue
+                source = os.path.join(dirpath, entry)
+                target = os.path.join(stash_root, rel_path)
+                source_stat = os.lstat(source)
+                if stat.S_ISDIR(source_stat.st_mode):
+                    continue
+                elif stat.S_ISREG(source_stat.st_mode):
+                    key = self._store_blob(
+                        source, source_stat, manifest.get_checksum(
+                            rel_path
+                        ) if manifest else None, stats
+                    )
+                    os.link(self._get_blob_path(key), target)
+                    index[rel_path] = [key, source_stat.st_size]
+                    if source_stat.st_nlink > 1:
+                        # hardlinks of the root tree are grouped by
+                        # the first path found for their inode
+                        index[rel_path].append(
+                            link_groups.setdefault(
+                                (source_stat.st_dev, source_stat.st_ino),
+                                rel_path
+                            )
+                        )
+                elif stat.S_ISLNK(source_stat.st_mode):
+                    os.symlink(os.readlink(source), target)
+                    StackTree.copy_metadata(source, target, source_stat)
+                else:
+                    os.mknod(
+                        target, source_stat.st_mode, source_stat.st_rdev
+                    )
+                    StackTree.copy_metadata(source, target, source_stat)
+        # directory metadata is applied last because adding
+        # entries to a directory changes its modification time
+        for rel_dir in reversed(directories):
+            source = os.path.join(root_dir, rel_dir)
+            StackTree.copy_metadata(
+                source, os.path.join(stash_root, rel_dir), os.lstat(source)
+            )
+        # the index file marks the stash root as complete
+        with open(self._get_index_file(name), 'w') as index_file:
+            json.dump(index, index_file)
+        self._update_sizes()
+        return stats
+
+    def remove_root(self, name: str, prune_blobs: bool = True) -> None:
+        """
+        Remove the stash root of the given stash name from the store
+
+        :param str name: stash name
+        :param bool prune_blobs: delete blobs no longer referenced
+        """
+        self._wipe_root(name)
+        if prune_blobs and os.path.isdir(self.blob_dir):
+            for dirpath, dirnames, filenames in os.walk(self.blob_dir):
+                for blob in filenames:
+                    blob_path = os.path.join(dirpath, blob)
+                    if os.lstat(blob_path).st_nlink == 1:
+                        os.unlink(blob_path)
+        self._update_sizes(
+            {name: {'logical_size': None, 'deduplicated_size': None}}
+        )
+
+    def get_root(self, name: str) -> Optional[str]:
+        """
+        Provides the stored root tree of the given stash name
+
+        :param str name: stash name
+
+        :return: root directory path or None
+
+        :rtype: str
+        """
+        if os.path.isfile(self._get_index_file(name)):
+            return self._get_stash_root(name)
+        return None
+
+    def get_digest(self, name: str) -> Optional[str]:
+        """
+        Provides a digest identifying the stored root tree of a stash
+
+        The digest covers the index of the stash root and the time
+        it was written, such that every add_root of the stash
+        yields a new digest
+
+        :param str name: stash name
+
+        :return: sha256 hex digest or None
+
+        :rtype: str
+        """
+        index_file = self._get_index_file(name)
+        if not os.path.isfile(index_file):
+            return None
+        digest = hashlib.sha256(
+            f'{os.stat(index_file).st_mtime_ns}\0'.encode()
+        )
+        with open(index_file, 'rb') as index:
+            digest.update(index.read())
+        return digest.hexdigest()
+
+    def get_link_groups(self, name: str) -> Optional[Dict[str, str]]:
+        """
+        Provides the hardlinks of the stored root tree of a stash
+
+        All files of the stash root are hardlinks to their blobs,
+        identical files share the same blob inode. Only files
+        which were hardlinks in the stored root tree are
+        hardlinks of each other in an image root
+
+        :param str name: stash name
+
+        :return:
+            relative path to link group mapping of the hardlinked
+            files, files of the same group are hardlinks of each
+            other, None if the stash has no stored root
+
+        :rtype: dict
+        """
+        index = self._load_index(name)
+        if index is None:
+            return None
+        return {
+            rel_path: entry[2] for rel_path, entry in index.items()
+            if len(entry) > 2
+        }
+
+    def verify_root(self, name: str, jobs: int = 1) -> Dict[str, str]:
+        """
+        Check the files of a stash root against their blob keys
+
+        The key of every indexed file is computed again from the
+        file content and metadata and compared with the key the
+        file was stored with. The files are hashed concurrently
+
+        :param str name: stash name
+        :param int jobs: number of concurrent hash jobs
+
+        :return: path to problem mapping, empty if the stash root is intact
+
+        :rtype: dict
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        index = self._load_index(name) or {}
+        stash_root = self._get_stash_root(name)
+
+        def check_file(rel_path: str) -> Optional[str]:
+            path = os.path.join(stash_root, rel_path)
+            if not os.path.isfile(path):
+                return 'missing'
+            if self._get_key(path, os.lstat(path), None) != index[rel_path][0]:
+                return 'checksum mismatch'
+            return None
+
+        problems = {}
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for rel_path, problem in zip(index, pool.map(check_file, index)):
+                if problem:
+                    problems[rel_path] = problem
+        return problems
+
+    def get_sizes(self, name: str) -> Optional[Dict[str, int]]:
+        """
+        Provides the logical and the deduplicated size of a stash
+
+        The logical size is the sum of all file sizes in the
+        stash root. The deduplicated size accounts every unique
+        blob once and splits blobs shared with other stashes
+        evenly between them, such that the deduplicated sizes
+        of all stashes sum up to the size of the store. The
+        sizes are read from the stash index, no stash root
+        index is loaded
+
+        :param str name: stash name
+
+        :return: dict with logical_size and deduplicated_size or None
+
+        :rtype: dict
+        """
+        return self.get_index_sizes(
+            StashIndex(self.stash_home).get_stashes().get(name, {})
+        )
+
+    @staticmethod
+    def get_index_sizes(stash_data: Dict) -> Optional[Dict[str, int]]:
+        """
+        Provides the blob store sizes of a stash from its index data
+
+        :param dict stash_data: stash data of the stash index
+
+        :return: dict with logical_size and deduplicated_size or None
+
+        :rtype: dict
+        """
+        if 'deduplicated_size' not in stash_data:
+            return None
+        return {
+            'logical_size': stash_data['logical_size'],
+            'deduplicated_size': stash_data['deduplicated_size']
+        }
+
+    def _wipe_root(self, name: str) -> None:
+        Path.wipe(self._get_index_file(name))
+        Path.wipe(self._get_stash_root(name))
+
+    def _update_sizes(
+        self, sizes: Optional[Dict[str, Dict[str, Optional[int]]]] = None
+    ) -> None:
+        # the shares of all stashes using a blob change with every
+        # stash root added or removed. Only this costly walk over
+        # all stash root indexes counts the blob references, the
+        # sizes are read from the stash index
+        if not os.path.isdir(self.stash_home):
+            return
+        sizes = dict(sizes or {})
+        indexes = {}
+        references: Dict[str, int] = {}
+        for stash_name in os.listdir(self.stash_home):
+            stash_index = self._load_index(stash_name)
+            if stash_index is None:
+                continue
+            indexes[stash_name] = stash_index
+            for key in {entry[0] for entry in stash_index.values()}:
+                references[key] = references.get(key, 0) + 1
+        for stash_name, stash_index in indexes.items():
+            blobs = {entry[0]: entry[1] for entry in stash_index.values()}
+            sizes[stash_name] = {
+                'logical_size': sum(
+                    entry[1] for entry in stash_index.values()
+                ),
+                'deduplicated_size': round(
+                    sum(size / references[key] for key, size in blobs.items())
+                )
+            }
+        StashIndex(self.stash_home).update_stashes(sizes)
+
+    def _store_blob(
+        self, source: str, source_stat: os.stat_result,
+        checksum: Optional[str], stats: Dict[str, int]
+    ) -> str:
+        key = self._get_key(source, source_stat, checksum)
+        blob_path = self._get_blob_path(key)
+        if os.path.exists(blob_path):
+            stats['hardlink_bytes'] += source_stat.st_size
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            blob_tmp = f'{blob_path}.{os.getpid()}'
+            if os.path.lexists(blob_tmp):
+                # left over by a former process of the same pid
+                os.unlink(blob_tmp)
+            stats['sparse_bytes'] += StackTree.copy_data(
+                source, blob_tmp, source_stat.st_size
+            )
+            StackTree.copy_metadata(source, blob_tmp, source_stat)
+            os.rename(blob_tmp, blob_path)
+        return key
+
+    def _get_key(
+        self, source: str, source_stat: os.stat_result,
+        checksum: Optional[str]
+    ) -> str:
+        # the manifest module is only needed to create and
+        # verify stash roots, not to list them
+        from kiwi_stackbuild_plugin.manifest import StashManifest
+        key = hashlib.sha256()
+        key.update(
+            '{0}:{1}:{2}:{3}\0'.format(
+                source_stat.st_mode, source_stat.st_uid,
+                source_stat.st_gid, source_stat.st_mtime_ns
+            ).encode()
+        )
+        for name, value in StackTree.get_xattrs(source):
+            key.update(name.encode() + b'\0' + value + b'\0')
+        key.update(
+            (checksum or StashManifest.get_file_checksum(source)).encode()
+        )
+        return key.hexdigest()
+
+    def _get_blob_path(self, key: str) -> str:
+        return os.path.join(self.blob_dir, key[:2], key)
+
+    def _get_stash_root(self, name: str) -> str:
+        return os.path.join(self.stash_home, name, 'root')
+
+    def _get_index_file(self, name: str) -> str:
+        return os.path.join(self.stash_home, name, f'{name}.blobs')
+
+    def _load_index(self, name: str) -> Optional[Dict[str, List]]:
+        index_file = self._get_index_file(name)
+        if not os.path.isfile(index_file):
+            return None
+        with open(index_file) as index:
+            return json.load(index)
+
+    @staticmethod
+    def _is_excluded(rel_path: str, exclude_list: List[str]) -> bool:
+        for pattern in exclude_list:
+            if fnmatch(rel_path, pattern):
+                return True
+        return False
@@ -0,0 +1,170 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import json
+import logging
+from typing import (
+    Any, Dict, List, Optional, Tuple
+)
+
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginResumeFailed
+)
+
+log = logging.getLogger('kiwi')
+
+
+class StackCheckpoint:
+    """
+    **Implements checkpoints of the stashes applied to an image root**
+
+    The checkpoint file records the stash stack of an image root,
+    the digest of every stash and whether the stash was applied
+    completely. It is replaced atomically after every applied
+    stash, such that a failed stackbuild can be resumed with the
+    first stash not applied. A stash applied partially is applied
+    again as a whole.
+
+    :param str checkpoint_file: checkpoint file path
+    """
+    def __init__(self, checkpoint_file: str) -> None:
+        self.checkpoint_file = checkpoint_file
+        self.stashes: List[Dict[str, Any]] = []
+        self.key_data: List[str] = []
+        self.data: Optional[Dict[str, Any]] = None
+
+    def load(self) -> bool:
+        """
+        Load the checkpoint of an existing image root
+
+        :return: True if a checkpoint was found, False otherwise
+
+        :rtype: bool
+        """
+        if not os.path.isfile(self.checkpoint_file):
+            return False
+        try:
+            with open(self.checkpoint_file) as checkpoint:
+                self.data = json.load(checkpoint)
+        except ValueError as issue:
+            raise KiwiStackBuildPluginResumeFailed(
+                f'Unreadable checkpoint {self.checkpoint_file}: {issue}'
+            )
+        return True
+
+    def start(
+        self, stashes: List[Tuple[str, Optional[str]]],
+        key_data: List[str]
+    ) -> int:
+        """
+        Start applying the given stash stack
+
+        If a checkpoint was loaded or started before, the stashes
+        applied before are kept as applied. This requires the same
+        stash stack with the same path filter, and the applied
+        stashes must still have the recorded digest, otherwise the
+        image root cannot be resumed
+
+        :param list stashes: list of stash name and digest tuples
+            in stack order
+        :param list key_data: path filter data the stashes are
+            applied with
+
+        :return: number of stashes already applied
+
+        :rtype: int
+        """
+        applied = [False] * len(stashes)
+        if self.data is not None:
+            recorded = self.data.get('stashes') or []
+            if [stash['name'] for stash in recorded] != [
+                name for name, digest in stashes
+            ] or self.data.get('filter') != key_data:
+                raise KiwiStackBuildPluginResumeFailed(
+                    'Stash stack or path filters differ from checkpoint '
+                    f'{self.checkpoint_file}'
+                )
+            for index, (name, digest) in enumerate(stashes):
+                if not recorded[index].get('applied'):
+                    continue
+                if not digest or digest != recorded[index].get('digest'):
+                    raise KiwiStackBuildPluginResumeFailed(
+                        f'Stash {name!r} changed since it was applied, '
+                        f'recorded digest: {recorded[index]["digest"]}'
+                    )
+                applied[index] = True
+        self.stashes = [
+            {'name': name, 'digest': digest, 'applied': applied[index]}
+            for index, (name, digest) in enumerate(stashes)
+        ]
+        self.key_data = key_data
+        self.data = {'filter': self.key_data, 'stashes': self.stashes}
+        self._write()
+        return applied.count(True)
+
+    def is_applied(self, index: int) -> bool:
+        """
+        Check if the stash at the given stack index was applied
+
+        :param int index: stash index in stack order
+
+        :return: True or False
+
+        :rtype: bool
+        """
+        return bool(self.stashes) and self.stashes[index]['applied']
+
+    def is_complete(self) -> bool:
+        """
+        Check if all stashes of the stack were applied
+
+        :return: True or False
+
+        :rtype: bool
+        """
+        return bool(self.stashes) and all(
+            stash['applied'] for stash in self.stashes
+        )
+
+    def set_applied(self, index: int) -> None:
+        """
+        Record the stash at the given stack index as applied
+
+        :param int index: stash index in stack order
+        """
+        if self.stashes:
+            log.debug(
+                f'Checkpoint: stash {self.stashes[index]["name"]!r} applied'
+            )
+            self.stashes[index]['applied'] = True
+            self._write()
+
+    def set_complete(self) -> None:
+        """
+        Record all stashes of the stack as applied
+        """
+        if self.stashes:
+            for stash in self.stashes:
+                stash['applied'] = True
+            self._write()
+
+    def _write(self) -> None:
+        checkpoint_tmp = f'{self.checkpoint_file}.{os.getpid()}'
+        with open(checkpoint_tmp, 'w') as checkpoint:
+            json.dump(self.data, checkpoint, indent=4)
+        os.replace(checkpoint_tmp, self.checkpoint_file)
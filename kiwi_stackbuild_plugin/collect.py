@@ -0,0 +1,170 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import logging
+from typing import (
+    Any, Dict, List
+)
+
+from kiwi.command import Command
+from kiwi.path import Path
+
+from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+from kiwi_stackbuild_plugin.index import StashIndex
+from kiwi_stackbuild_plugin.lock import StashLock
+from kiwi_stackbuild_plugin.root_cache import StackRootCache
+
+log = logging.getLogger('kiwi')
+
+
+class StashCollector:
+    """
+    **Implements a size bounded garbage collection of stashes**
+
+    The stashes in the stash home are evicted in least recently
+    used order until the disk usage of all stashes fits into the
+    given size. A stash counts with its stash directory, its share
+    of the blob store and its images in the local containers
+    storage. The last use time is taken from the stash index,
+    stashes not in the index count with the modification time
+    of their stash directory. Stashes locked by a running
+    stackbuild are never evicted. Assembled roots in the root
+    cache count as well and are evicted before any stash, they
+    can be assembled again from the stashes.
+
+    :param str stash_home: stash home directory
+    """
+    def __init__(self, stash_home: str) -> None:
+        self.stash_home = stash_home
+        self.blob_store = StashBlobStore(stash_home)
+        self.index = StashIndex(stash_home)
+        self.root_cache = StackRootCache(stash_home)
+
+    def get_stashes(self) -> List[Dict[str, Any]]:
+        """
+        Provides name, tags, size and last use time of all stashes
+
+        :return: list of stash dicts, least recently used first
+
+        :rtype: list
+        """
+        stashes = []
+        stash_index = self.index.get_stashes()
+        if os.path.isdir(self.stash_home):
+            for name in os.listdir(self.stash_home):
+                stash_dir = os.path.join(self.stash_home, name)
+                if name.startswith('.') or not os.path.isdir(stash_dir):
+                    continue
+                stash_data = stash_index.get(name, {})
+                tags = stash_data.get('tags') or ['latest']
+                stashes.append(
+                    {
+                        'name': name,
+                        'tags': tags,
+                        'size': self._get_stash_size(name, tags, stash_data),
+                        'last_used': stash_data.get('last_used') or int(
+                            os.stat(stash_dir).st_mtime
+                        )
+                    }
+                )
+        return sorted(
+            stashes, key=lambda stash: (stash['last_used'], stash['name'])
+        )
+
+    def collect(self, max_size: int, keep: int = 0) -> Dict[str, Any]:
+        """
+        Evict least recently used stashes until max_size is reached
+
+        :param int max_size: size in bytes all stashes may use
+        :param int keep: number of most recently used stashes to keep
+
+        :return: dict with evicted and in use stash names, evicted
+            root cache keys and the total size before and after
+            the collection
+
+        :rtype: dict
+        """
+        stashes = self.get_stashes()
+        cache_entries = self.root_cache.get_entries()
+        total_size = sum(stash['size'] for stash in stashes) + \
+            sum(entry['size'] for entry in cache_entries)
+        result: Dict[str, Any] = {
+            'size_before': total_size,
+            'evicted': [],
+            'evicted_root_cache': [],
+            'in_use': []
+        }
+        for entry in cache_entries:
+            if total_size <= max_size:
+                break
+            if self.root_cache.remove(entry['key']):
+                total_size -= entry['size']
+                result['evicted_root_cache'].append(entry['key'])
+        candidates = stashes[:max(len(stashes) - keep, 0)]
+        for stash in candidates:
+            if total_size <= max_size:
+                break
+            stash_lock = StashLock(self.stash_home, stash['name'])
+            if not stash_lock.acquire(exclusive=True, blocking=False):
+                log.info(f'Stash {stash["name"]!r} is in use, not evicted')
+                result['in_use'].append(stash['name'])
+                continue
+            try:
+                self._evict(stash['name'], stash['tags'])
+            finally:
+                stash_lock.release()
+            total_size -= stash['size']
+            result['evicted'].append(stash['name'])
+        result['size_after'] = total_size
+        return result
+
+    def _evict(self, name: str, tags: List[str]) -> None:
+        log.info(f'Evicting stash: {name!r}')
+        for tag in tags:
+            Command.run(
+                ['podman', 'image', 'rm', f'localhost/{name}:{tag}'],
+                raise_on_error=False
+            )
+        if self.blob_store.get_root(name):
+            self.blob_store.remove_root(name)
+        self.index.remove_stash(name)
+        Path.wipe(os.path.join(self.stash_home, name))
+
+    def _get_stash_size(
+        self, name: str, tags: List[str], stash_data: Dict[str, Any]
+    ) -> int:
+        # files of the stash root in the blob store are hardlinks
+        # to shared blobs and count with the deduplicated size
+        stash_dir = os.path.join(self.stash_home, name)
+        blob_sizes = StashBlobStore.get_index_sizes(stash_data)
+        size = blob_sizes['deduplicated_size'] if blob_sizes else 0
+        for dirpath, dirnames, filenames in os.walk(stash_dir):
+            if dirpath == stash_dir and blob_sizes and 'root' in dirnames:
+                dirnames.remove('root')
+            for filename in filenames:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+        for tag in tags:
+            image_info = Command.run(
+                [
+                    'podman', 'image', 'inspect', '--format', '{{.Size}}',
+                    f'localhost/{name}:{tag}'
+                ], raise_on_error=False
+            )
+            if image_info.returncode == 0:
+                size += int(image_info.output.strip())
+        return size
@@ -40,6 +40,61 @@ class StackBuildDefaults:
         """
         return '/var/tmp/kiwi-stash'
 
+    @staticmethod
+    def get_pull_jobs() -> int:
+        """
+        Provides the default number of concurrent stash pulls
+
+        :return: number of pull jobs
+
+        :rtype: int
+        """
+        return 4
+
+    @staticmethod
+    def get_server_socket() -> str:
+        """
+        Provides the unix socket path of the stackbuild server
+
+        :return: socket path name
+
+        :rtype: str
+        """
+        return '/run/kiwi-stackbuild.sock'
+
+    @staticmethod
+    def get_server_workers() -> int:
+        """
+        Provides the default number of concurrent stackbuild server jobs
+
+        :return: number of workers
+
+        :rtype: int
+        """
+        return 2
+
+    @staticmethod
+    def get_stash_compressions() -> List[str]:
+        """
+        Provides the list of supported stash archive layer compressions
+
+        :return: list of compression format names
+
+        :rtype: list
+        """
+        return ['none', 'gzip', 'zstd', 'zstd:chunked']
+
+    @staticmethod
+    def get_stash_compression() -> str:
+        """
+        Provides the default stash archive layer compression
+
+        :return: compression format name
+
+        :rtype: str
+        """
+        return 'gzip'
+
     @staticmethod
     def is_container_name_valid(name: str) -> bool:
         """
@@ -0,0 +1,80 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import json
+import logging
+from typing import List
+
+from kiwi.path import Path
+
+log = logging.getLogger('kiwi')
+
+
+class StashDeletions:
+    """
+    **Implements the paths a stash deletes from its base stashes**
+
+    A stash root built on top of other stashes can delete files
+    of these base stashes. The stash root then just lacks these
+    paths, which stacking the stashes cannot tell apart from
+    paths the stash never had. The deleted paths are therefore
+    recorded in a json file in the stash directory when the stash
+    is created, and removed from the stashes below it in the
+    stack by stackbuild. Only the topmost deleted path of a
+    deleted directory tree is recorded.
+
+    :param str stash_home: stash home directory
+    :param str name: stash name
+    """
+    def __init__(self, stash_home: str, name: str) -> None:
+        self.deleted_file = os.path.join(stash_home, name, f'{name}.deleted')
+
+    def get(self) -> List[str]:
+        """
+        Provides the deleted paths of the stash
+
+        :return: list of paths relative to the root tree
+
+        :rtype: list
+        """
+        if not os.path.isfile(self.deleted_file):
+            return []
+        try:
+            with open(self.deleted_file) as deleted:
+                return json.load(deleted)
+        except ValueError as issue:
+            log.warning(
+                f'Ignoring unreadable deleted paths {self.deleted_file}: {issue}'
+            )
+            return []
+
+    def set(self, paths: List[str]) -> None:
+        """
+        Record the deleted paths of the stash
+
+        An empty list removes the record
+
+        :param list paths: list of paths relative to the root tree
+        """
+        if not paths:
+            Path.wipe(self.deleted_file)
+            return
+        deleted_tmp = f'{self.deleted_file}.{os.getpid()}'
+        with open(deleted_tmp, 'w') as deleted:
+            json.dump(sorted(paths), deleted, indent=4)
+        os.replace(deleted_tmp, self.deleted_file)
@@ -41,3 +41,52 @@ class KiwiStackBuildPluginRootSyncFailed(KiwiError):
     Exception raised if the rsync process to sync the stash into
     the root-tree failed
     """
+
+
+class KiwiStackBuildPluginInvalidArgument(KiwiError):
+    """
+    Exception raised if a command line argument has an invalid value
+    """
+
+
+class KiwiStackBuildPluginStashCorrupted(KiwiError):
+    """
+    Exception raised if the verification of a stash failed
+    """
+
+
+class KiwiStackBuildPluginUnpackFailed(KiwiError):
+    """
+    Exception raised if a stash archive layer could not be unpacked
+    """
+
+
+class KiwiStackBuildPluginBatchManifestInvalid(KiwiError):
+    """
+    Exception raised if the batch manifest cannot be used
+    """
+
+
+class KiwiStackBuildPluginBatchBuildFailed(KiwiError):
+    """
+    Exception raised if builds of a batch stackbuild failed
+    """
+
+
+class KiwiStackBuildPluginResumeFailed(KiwiError):
+    """
+    Exception raised if a stackbuild cannot be resumed from the
+    checkpoint of its image root
+    """
+
+
+class KiwiStackBuildPluginServerError(KiwiError):
+    """
+    Exception raised if the stackbuild server cannot serve a request
+    """
+
+
+class KiwiStackBuildPluginKiwiTaskFailed(KiwiError):
+    """
+    Exception raised if a kiwi system task run in a child process failed
+    """
@@ -0,0 +1,142 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import json
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+from typing import (
+    Any, Dict, Iterator
+)
+
+log = logging.getLogger('kiwi')
+
+
+class StashIndex:
+    """
+    **Implements the cached index of the stashes in the stash home**
+
+    The index keeps the information about every stash which is
+    expensive to collect, like tags, layer count, sizes and the
+    time of creation and last use, in a json file in the stash
+    home. Listing the stashes only reads this file instead of
+    walking archives and the containers storage.
+
+    Updates are serialized through a lock file and the index is
+    replaced atomically, such that concurrent stash and stackbuild
+    calls neither lose updates nor read a partial index.
+
+    :param str stash_home: stash home directory
+    """
+    def __init__(self, stash_home: str) -> None:
+        self.stash_home = stash_home
+        self.index_file = os.path.join(stash_home, '.index.json')
+        self.lock_file = os.path.join(stash_home, '.index.lock')
+
+    def get_stashes(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Provides the index data of all stashes
+
+        :return: stash name to stash data mapping
+
+        :rtype: dict
+        """
+        if not os.path.isfile(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as index:
+                return json.load(index)
+        except ValueError as issue:
+            log.warning(
+                f'Ignoring unreadable stash index {self.index_file}: {issue}'
+            )
+            return {}
+
+    def add_stash(self, name: str, tag: str, data: Dict[str, Any]) -> None:
+        """
+        Add or update the index data of a stash
+
+        The given tag is added to the tags of the stash, creation
+        and last use time are set to the current time
+
+        :param str name: stash name
+        :param str tag: stash tag
+        :param dict data: stash data like layers and sizes
+        """
+        now = int(time.time())
+        with self._locked() as stashes:
+            stash = stashes.get(name, {})
+            stash.update(data)
+            stash['tags'] = sorted(set(stash.get('tags', [])) | {tag})
+            stash['created'] = now
+            stash['last_used'] = now
+            stashes[name] = stash
+
+    def update_stashes(self, data: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Update the index data of the given stashes
+
+        Unlike add_stash the tags and times of the stashes are
+        kept. A None value removes the key from the stash data
+
+        :param dict data: stash name to stash data mapping
+        """
+        with self._locked() as stashes:
+            for name, stash_data in data.items():
+                stash = stashes.get(name, {})
+                for key, value in stash_data.items():
+                    if value is None:
+                        stash.pop(key, None)
+                    else:
+                        stash[key] = value
+                if stash:
+                    stashes[name] = stash
+
+    def touch(self, name: str) -> None:
+        """
+        Set the last use time of an indexed stash to now
+
+        :param str name: stash name
+        """
+        if name not in self.get_stashes():
+            return
+        with self._locked() as stashes:
+            if name in stashes:
+                stashes[name]['last_used'] = int(time.time())
+
+    def remove_stash(self, name: str) -> None:
+        """
+        Remove a stash from the index
+
+        :param str name: stash name
+        """
+        with self._locked() as stashes:
+            stashes.pop(name, None)
+
+    @contextmanager
+    def _locked(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        os.makedirs(self.stash_home, exist_ok=True)
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stashes = self.get_stashes()
+            yield stashes
+            index_tmp = f'{self.index_file}.{os.getpid()}'
+            with open(index_tmp, 'w') as index:
+                json.dump(stashes, index, indent=4, sort_keys=True)
+            os.replace(index_tmp, self.index_file)
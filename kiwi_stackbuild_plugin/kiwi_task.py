@@ -0,0 +1,227 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import sys
+import copy
+import logging
+from docopt import docopt
+from typing import (
+    Any, Dict, List, cast
+)
+
+import kiwi.tasks.system_build
+import kiwi.tasks.system_create
+from kiwi.logger import Logger
+from kiwi.tasks.base import CliTask
+from kiwi.tasks.system_build import SystemBuildTask
+from kiwi.tasks.system_create import SystemCreateTask
+
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginInvalidArgument,
+    KiwiStackBuildPluginKiwiTaskFailed
+)
+
+log = logging.getLogger('kiwi')
+
+
+class StackKiwiTask:
+    """
+    **Implements in-process creation of kiwi system tasks**
+
+    A kiwi CliTask parses sys.argv with docopt and discovers all
+    kiwi task plugins when it is constructed. The tasks created
+    here get their command and global arguments passed in as
+    dicts instead, and take the runtime checks and the runtime
+    config from an already initialized task. Nothing is parsed
+    or imported again and sys.argv is never touched, such that
+    many tasks can be created in one process. The task gets every
+    attribute CliTask.__init__ sets, the unit tests compare them
+    against a CliTask constructed from a kiwi command line.
+
+    :param CliTask runtime_task: initialized task providing the
+        runtime checks and the runtime config
+    """
+    tasks: Dict[str, Any] = {
+        'build': (SystemBuildTask, kiwi.tasks.system_build.__doc__),
+        'create': (SystemCreateTask, kiwi.tasks.system_create.__doc__)
+    }
+    # kiwi-ng global options of the system commands, the log
+    # file and log socket are set per command line
+    global_options = [
+        '--type', '--profile', '--target-arch', '--temp-dir',
+        '--shared-cache-dir', '--kiwi-file', '--config', '--loglevel',
+        '--debug', '--debug-run-scripts-in-screen', '--color-output'
+    ]
+
+    def __init__(self, runtime_task: CliTask) -> None:
+        self.runtime_task = runtime_task
+
+    @staticmethod
+    def validate(command: str, argv: List[str]) -> Dict[str, Any]:
+        """
+        Validate the arguments of a kiwi system command
+
+        The arguments are checked against the docopt usage of
+        the original kiwi task module
+
+        :param str command: system command name, build or create
+        :param list argv: command arguments without 'system <command>'
+
+        :return: docopt command arguments dict
+
+        :rtype: dict
+        """
+        task_class, usage = StackKiwiTask._get_task(command)
+        log.debug(f'Validating kiwi system {command} arguments: {argv}')
+        return docopt(usage, argv=['system', command] + argv)
+
+    def new(
+        self, command: str, command_args: Dict[str, Any],
+        global_args: Dict[str, Any]
+    ) -> CliTask:
+        """
+        Create a kiwi system task from validated arguments
+
+        :param str command: system command name, build or create
+        :param dict command_args: docopt command arguments dict
+        :param dict global_args: kiwi global arguments dict
+
+        :return: task instance ready to process
+
+        :rtype: CliTask
+        """
+        task_class, usage = self._get_task(command)
+        log.debug(
+            f'Creating kiwi system {command} task with: {command_args}'
+        )
+        return self.create(task_class, command_args, global_args)
+
+    def create(
+        self, task_class: Any, command_args: Dict[str, Any],
+        global_args: Dict[str, Any]
+    ) -> CliTask:
+        """
+        Create a task of the given CliTask class from validated arguments
+
+        :param CliTask task_class: task class to instantiate
+        :param dict command_args: docopt command arguments dict
+        :param dict global_args: kiwi global arguments dict
+
+        :return: task instance ready to process
+
+        :rtype: CliTask
+        """
+        task = task_class.__new__(task_class)
+        task.cli = self.runtime_task.cli
+        task.task = sys.modules[task_class.__module__]
+        task.command_args = command_args
+        task.global_args = global_args
+        task.runtime_checker = None
+        task.checks_before_command_args = copy.deepcopy(
+            self.runtime_task.checks_before_command_args
+        )
+        task.checks_after_command_args = copy.deepcopy(
+            self.runtime_task.checks_after_command_args
+        )
+        task.runtime_config = self.runtime_task.runtime_config
+        return task
+
+    @staticmethod
+    def process_forked(task: CliTask, log_file: str) -> None:
+        """
+        Process the task in a child process forked from this process
+
+        Unlike a new kiwi-ng process the child starts with all
+        modules of this process loaded, nothing is imported or
+        parsed again. kiwi logging is process global, the child
+        logs to the given log file only, the log handlers of this
+        process are dropped in the child. Changes of the process
+        global kiwi state done by the task stay in the child.
+
+        :param CliTask task: task to process
+        :param str log_file: log file path
+
+        :raises KiwiStackBuildPluginKiwiTaskFailed: if the task failed
+        """
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            StackKiwiTask._process_child(task, log_file)
+        exit_code = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+        if exit_code != 0:
+            raise KiwiStackBuildPluginKiwiTaskFailed(
+                f'kiwi task exited with {exit_code}, see {log_file!r}'
+            )
+
+    @staticmethod
+    def get_command_line(
+        command: str, argv: List[str], global_args: Dict[str, Any],
+        log_file: str
+    ) -> List[str]:
+        """
+        Provides the kiwi-ng command line of a kiwi system command
+
+        All global arguments are passed on except for the log
+        file and log socket, the command logs to the given log file
+
+        :param str command: system command name, build or create
+        :param list argv: command arguments without 'system <command>'
+        :param dict global_args: kiwi global arguments dict
+        :param str log_file: log file path
+
+        :return: command line
+
+        :rtype: list
+        """
+        command_line = ['kiwi-ng', '--logfile', log_file]
+        for option in StackKiwiTask.global_options:
+            value = global_args.get(option)
+            if value is True:
+                command_line.append(option)
+            elif isinstance(value, list):
+                for item in value:
+                    command_line += [option, item]
+            elif value:
+                command_line += [option, value]
+        return command_line + ['system', command] + argv
+
+    @staticmethod
+    def _process_child(task: CliTask, log_file: str) -> None:
+        kiwi_log = cast(Logger, log)
+        exit_code = 1
+        try:
+            for handler_type in ('file', 'socket'):
+                handler = kiwi_log.log_handlers.pop(handler_type, None)
+                if handler:
+                    kiwi_log.removeHandler(handler)
+            kiwi_log.set_logfile(log_file)
+            kiwi_log.setLogLevel(logging.CRITICAL, except_for=['file'])
+            task.process()
+            exit_code = 0
+        except BaseException as issue:
+            log.error(f'{type(issue).__name__}: {issue}')
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    @staticmethod
+    def _get_task(command: str) -> Any:
+        if command not in StackKiwiTask.tasks:
+            raise KiwiStackBuildPluginInvalidArgument(
+                f'Unsupported kiwi system command: {command!r}'
+            )
+        return StackKiwiTask.tasks[command]
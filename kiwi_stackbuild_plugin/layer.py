@@ -0,0 +1,120 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import stat
+import tarfile
+import logging
+from fnmatch import fnmatch
+from typing import (
+    Dict, List, Optional
+)
+
+from kiwi_stackbuild_plugin.unpack import WHITEOUT_PREFIX
+
+log = logging.getLogger('kiwi')
+
+# extended attributes kept in the container layers, like
+# the kiwi rsync filters for the container rootfs do
+XATTR_PATTERNS = ['user.*', 'security.ima*', 'security.capability*']
+
+
+class StashLayer:
+    """
+    **Implements an OCI layer tar of the changes of a root tree**
+
+    The layer holds the changed and new paths of the root tree
+    and an OCI whiteout for every removed path, such that it can
+    be added on top of the previous stash layer without unpacking
+    the stash. Paths below a removed directory are covered by the
+    whiteout of the directory. Owner and group are stored by
+    number only, the extended attributes matching XATTR_PATTERNS
+    are stored as PAX headers.
+
+    :param str root_dir: root directory
+    """
+    def __init__(self, root_dir: str) -> None:
+        self.root_dir = root_dir
+
+    def create(
+        self, filename: str, changed: List[str], removed: List[str]
+    ) -> Dict[str, int]:
+        """
+        Write the layer tar of the given changes
+
+        :param str filename: layer tar file path
+        :param list changed: changed or new paths in parent first order
+        :param list removed: removed paths in parent first order
+
+        :return: dict with the number of layer entries and whiteouts
+
+        :rtype: dict
+        """
+        stats = {'entries': 0, 'whiteouts': 0}
+        with tarfile.open(
+            filename, 'w', format=tarfile.PAX_FORMAT
+        ) as layer:
+            for rel_path in removed:
+                parent, name = os.path.split(rel_path)
+                # a removed or replaced parent already hides the path
+                if not self._is_dir(parent):
+                    continue
+                whiteout = tarfile.TarInfo(
+                    os.path.join(parent, WHITEOUT_PREFIX + name)
+                )
+                whiteout.mode = 0o644
+                layer.addfile(whiteout)
+                stats['whiteouts'] += 1
+            for rel_path in changed:
+                layer.add(
+                    os.path.join(self.root_dir, rel_path), rel_path,
+                    recursive=False, filter=self._set_member_data
+                )
+                stats['entries'] += 1
+        return stats
+
+    def _is_dir(self, rel_dir: str) -> bool:
+        try:
+            return stat.S_ISDIR(
+                os.lstat(os.path.join(self.root_dir, rel_dir)).st_mode
+            )
+        except FileNotFoundError:
+            return False
+
+    def _set_member_data(
+        self, member: tarfile.TarInfo
+    ) -> Optional[tarfile.TarInfo]:
+        # user and group names of the build host are meaningless
+        # for the root tree, the ids are used as they are
+        member.uname = ''
+        member.gname = ''
+        if member.issym():
+            return member
+        path = os.path.join(self.root_dir, member.name)
+        try:
+            names = os.listxattr(path, follow_symlinks=False)
+        except OSError as issue:
+            log.debug(f'Reading extended attributes of {path} said: {issue}')
+            return member
+        pax_headers = dict(member.pax_headers)
+        for name in sorted(names):
+            if any(fnmatch(name, pattern) for pattern in XATTR_PATTERNS):
+                pax_headers[f'SCHILY.xattr.{name}'] = os.getxattr(
+                    path, name, follow_symlinks=False
+                ).decode('utf-8', 'surrogateescape')
+        member.pax_headers = pax_headers
+        return member
@@ -0,0 +1,86 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import fcntl
+from typing import (
+    IO, Optional
+)
+
+
+class StashLock:
+    """
+    **Implements the in use lock of a stash**
+
+    Users of a stash hold a shared lock on the lock file of the
+    stash. Removing a stash requires the exclusive lock, which is
+    only granted if no user holds the stash. The lock file is kept
+    outside of the stash directory, by default at
+    <stash_home>/.locks/<name>.lock, such that removing the stash
+    directory doesn't remove the lock file held by the remover.
+    A user waiting for the lock while the stash is removed gets
+    no lock once the stash is gone.
+
+    :param str stash_home: stash home directory
+    :param str name: stash name
+    :param str lock_dir: directory of the lock file
+    """
+    def __init__(
+        self, stash_home: str, name: str, lock_dir: Optional[str] = None
+    ) -> None:
+        self.stash_dir = os.path.join(stash_home, name)
+        self.lock_dir = lock_dir or os.path.join(stash_home, '.locks')
+        self.lock_file = os.path.join(self.lock_dir, f'{name}.lock')
+        self.lock: Optional[IO] = None
+
+    def acquire(self, exclusive: bool = False, blocking: bool = True) -> bool:
+        """
+        Acquire the lock
+
+        :param bool exclusive: acquire the exclusive lock
+        :param bool blocking: wait until the lock is granted
+
+        :return: True if the lock was acquired, False if the stash
+            does not exist or the lock is held by another user
+
+        :rtype: bool
+        """
+        if not os.path.isdir(self.stash_dir):
+            return False
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.lock = open(self.lock_file, 'a')
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.lock, operation)
+        except BlockingIOError:
+            self.release()
+            return False
+        if not os.path.isdir(self.stash_dir):
+            # the stash was removed while waiting for the lock
+            self.release()
+            return False
+        return True
+
+    def release(self) -> None:
+        """
+        Release the lock
+        """
+        if self.lock:
+            self.lock.close()
+            self.lock = None
@@ -0,0 +1,331 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import stat
+import time
+import sqlite3
+import hashlib
+import logging
+from fnmatch import fnmatch
+from typing import (
+    Dict, List, Optional, Tuple
+)
+
+from kiwi_stackbuild_plugin.layer import XATTR_PATTERNS
+
+log = logging.getLogger('kiwi')
+
+# entry fields compared between manifests, the trailing
+# inode and ctime fields only serve the checksum cache
+ENTRY_FIELDS = 8
+
+
+class StashManifest:
+    """
+    **Implements a manifest of the files in a stash root**
+
+    The manifest maps every path of a root tree to its type,
+    mode, ownership, size, modification time, content hash,
+    hash of the extended attributes matching XATTR_PATTERNS,
+    inode and change time. Comparing the manifest of a new root
+    tree with the manifest stored with the previous stash layer
+    provides the paths which need to go into the next layer.
+
+    The manifest is stored as sqlite database and also serves
+    as checksum cache. The content hash of a file is only
+    reused if inode, size, modification time and change time
+    are unchanged. The change time cannot be set from user
+    space, thus any modification of the root tree done outside
+    of kiwi invalidates the cached checksum. Files changed in
+    the same clock tick as the manifest was created are hashed
+    again on the next run.
+
+    :param dict entries: path to entry mapping
+    :param dict meta: manifest meta data
+    """
+    def __init__(
+        self, entries: Dict[str, List] = {}, meta: Dict[str, str] = {}
+    ) -> None:
+        self.entries = dict(entries)
+        self.meta = dict(meta)
+
+    @staticmethod
+    def load(filename: str) -> Optional['StashManifest']:
+        """
+        Load manifest from file
+
+        :param str filename: manifest file path
+
+        :return: StashManifest instance or None if there is no manifest
+
+        :rtype: StashManifest
+        """
+        if not os.path.isfile(filename):
+            return None
+        try:
+            connection = sqlite3.connect(filename)
+            try:
+                meta = dict(connection.execute('SELECT key, value FROM meta'))
+                entries = {
+                    row[0]: list(row[1:]) for row in connection.execute(
+                        'SELECT * FROM entries'
+                    )
+                }
+            finally:
+                connection.close()
+        except sqlite3.DatabaseError as issue:
+            log.warning(f'Ignoring unreadable manifest {filename}: {issue}')
+            return None
+        return StashManifest(entries, meta)
+
+    def save(self, filename: str) -> None:
+        """
+        Write manifest to file
+
+        The manifest is written to a temporary file first and
+        moved in place such that readers never see a partial file
+
+        :param str filename: manifest file path
+        """
+        filename_tmp = f'{filename}.{os.getpid()}'
+        if os.path.exists(filename_tmp):
+            os.unlink(filename_tmp)
+        connection = sqlite3.connect(filename_tmp)
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)'
+                )
+                connection.execute(
+                    'CREATE TABLE entries ('
+                    'path TEXT PRIMARY KEY, kind TEXT, mode INTEGER, '
+                    'uid INTEGER, gid INTEGER, size INTEGER, '
+                    'mtime_ns INTEGER, digest TEXT, xattrs TEXT, '
+                    'inode INTEGER, ctime_ns INTEGER)'
+                )
+                connection.executemany(
+                    'INSERT INTO meta VALUES (?, ?)', self.meta.items()
+                )
+                connection.executemany(
+                    'INSERT INTO entries VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        [path] + entry for path, entry in self.entries.items()
+                    )
+                )
+        finally:
+            connection.close()
+        os.replace(filename_tmp, filename)
+
+    @staticmethod
+    def from_root(
+        root_dir: str, exclude_list: List[str] = [],
+        previous: Optional['StashManifest'] = None
+    ) -> 'StashManifest':
+        """
+        Create manifest from the given root tree
+
+        File contents are only hashed if the checksum cached
+        in the previous manifest is not valid for the file
+
+        :param str root_dir: root directory
+        :param list exclude_list: list of path patterns to skip
+        :param StashManifest previous: manifest used as checksum cache
+
+        :return: StashManifest instance
+
+        :rtype: StashManifest
+        """
+        meta = {
+            'created_ns': str(time.time_ns()),
+            'device': str(os.stat(root_dir).st_dev)
+        }
+        cached_entries: Dict[str, List] = {}
+        cache_created_ns = 0
+        if previous and previous.meta.get('device') == meta['device']:
+            cached_entries = previous.entries
+            cache_created_ns = int(previous.meta.get('created_ns', 0))
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            rel_dir = os.path.relpath(dirpath, root_dir)
+            if rel_dir == os.curdir:
+                rel_dir = ''
+            for entry in dirnames[:] + filenames:
+                rel_path = os.path.join(rel_dir, entry)
+                if StashManifest._is_excluded(rel_path, exclude_list):
+                    if entry in dirnames:
+                        dirnames.remove(entry)
+                    continue
+                path = os.path.join(dirpath, entry)
+                path_stat = os.lstat(path)
+                entries[rel_path] = StashManifest._get_entry(
+                    path, path_stat, cached_entries.get(rel_path),
+                    cache_created_ns
+                )
+        return StashManifest(entries, meta)
+
+    def get_checksum(self, path: str) -> Optional[str]:
+        """
+        Provides the sha256 content checksum of a regular file
+
+        :param str path: path relative to the root tree
+
+        :return: hex digest or None
+
+        :rtype: str
+        """
+        entry = self.entries.get(path)
+        if entry and entry[0] == 'f':
+            return entry[6]
+        return None
+
+    def diff(self, previous: 'StashManifest') -> Tuple[List[str], List[str]]:
+        """
+        Compare this manifest with the manifest of the previous layer
+
+        :param StashManifest previous: manifest of the previous layer
+
+        :return: tuple of changed or new paths and of removed paths
+
+        :rtype: tuple
+        """
+        changed = sorted(
+            path for path, entry in self.entries.items()
+            if entry[:ENTRY_FIELDS] != previous.entries.get(path, [])[:ENTRY_FIELDS]
+        )
+        removed = sorted(
+            path for path in previous.entries
+            if path not in self.entries
+        )
+        return (changed, removed)
+
+    def get_deleted(
+        self, bases: List['StashManifest'], exclude_list: List[str] = []
+    ) -> List[str]:
+        """
+        Provides the paths of the base stash roots missing in this one
+
+        A path below a missing directory is not listed again, paths
+        excluded from this manifest are not considered deleted
+
+        :param list bases: manifests of the base stash roots
+        :param list exclude_list: list of path patterns of this manifest
+
+        :return: list of deleted paths
+
+        :rtype: list
+        """
+        # sorted by components, a directory is followed by its content
+        paths = sorted(
+            {path for base in bases for path in base.entries},
+            key=lambda path: path.split(os.sep)
+        )
+        deleted: List[str] = []
+        pruned = None
+        for path in paths:
+            if pruned and path.startswith(pruned + os.sep):
+                continue
+            if path in self.entries:
+                continue
+            pruned = path
+            if not StashManifest._is_excluded(path, exclude_list):
+                deleted.append(path)
+        return deleted
+
+    @staticmethod
+    def _get_entry(
+        path: str, path_stat: os.stat_result, cached: Optional[List],
+        cache_created_ns: int
+    ) -> List:
+        mode = path_stat.st_mode
+        if stat.S_ISREG(mode):
+            kind = 'f'
+        elif stat.S_ISDIR(mode):
+            kind = 'd'
+        elif stat.S_ISLNK(mode):
+            kind = 'l'
+        else:
+            kind = 'o'
+        entry = [
+            kind, mode, path_stat.st_uid, path_stat.st_gid,
+            path_stat.st_size, path_stat.st_mtime_ns
+        ]
+        if kind == 'f':
+            if cached and cached[:6] == entry and \
+                    cached[8:] == [path_stat.st_ino, path_stat.st_ctime_ns] \
+                    and path_stat.st_ctime_ns < cache_created_ns:
+                digest = cached[6]
+            else:
+                digest = StashManifest.get_file_checksum(path)
+        elif kind == 'l':
+            digest = os.readlink(path)
+        elif kind == 'o':
+            digest = str(path_stat.st_rdev)
+        else:
+            digest = ''
+        return entry + [
+            digest, StashManifest._get_xattrs_checksum(path, kind),
+            path_stat.st_ino, path_stat.st_ctime_ns
+        ]
+
+    @staticmethod
+    def get_file_checksum(path: str) -> str:
+        """
+        Provides the sha256 checksum of the given file contents
+
+        :param str path: file path
+
+        :return: hex digest
+
+        :rtype: str
+        """
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as data:
+            for chunk in iter(lambda: data.read(1 << 20), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    @staticmethod
+    def _get_xattrs_checksum(path: str, kind: str) -> str:
+        # symlinks carry no extended attributes in the layers
+        if kind == 'l':
+            return ''
+        try:
+            names = sorted(
+                name for name in os.listxattr(path, follow_symlinks=False)
+                if any(fnmatch(name, pattern) for pattern in XATTR_PATTERNS)
+            )
+            if not names:
+                return ''
+            checksum = hashlib.sha256()
+            for name in names:
+                checksum.update(name.encode() + b'\0')
+                checksum.update(
+                    os.getxattr(path, name, follow_symlinks=False) + b'\0'
+                )
+        except OSError as issue:
+            log.debug(f'Reading extended attributes of {path} said: {issue}')
+            return ''
+        return checksum.hexdigest()
+
+    @staticmethod
+    def _is_excluded(rel_path: str, exclude_list: List[str]) -> bool:
+        for pattern in exclude_list:
+            if fnmatch(rel_path, pattern):
+                return True
+        return False
@@ -0,0 +1,222 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import logging
+from typing import (
+    Dict, List, Optional, Set
+)
+
+from kiwi.utils.sync import DataSync
+from kiwi.utils.temporary import Temporary
+from kiwi.defaults import Defaults
+
+from kiwi_stackbuild_plugin.checkpoint import StackCheckpoint
+from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+from kiwi_stackbuild_plugin.parallel_copy import StackParallelCopy
+from kiwi_stackbuild_plugin.path_filter import StashPathFilter
+from kiwi_stackbuild_plugin.reflink import StackReflink
+
+log = logging.getLogger('kiwi')
+
+
+class StackMerge:
+    """
+    **Implements a merged sync of stacked stash roots**
+
+    Instead of syncing every stash root on top of the former
+    one, the merge planner walks all stash roots first and
+    assigns every path to the stash which provides it last
+    in the stack. Each stash is then synced with only the
+    paths it wins such that every path is written exactly
+    once into the target directory. Paths not selected by the
+    optional path filter are neither walked nor synced.
+
+    :param list stash_roots: stash root directories in stack order
+    :param StashPathFilter path_filter: include/exclude path filter
+    :param int sync_jobs:
+        number of threads to copy the paths with the parallel
+        copy engine, rsync is used if not set
+    :param dict link_groups:
+        stash root to link groups mapping of the stash roots
+        from the blob store, see StashBlobStore.get_link_groups
+    :param dict deleted:
+        stash root to the list of paths the stash deleted from
+        the stashes below it, see StashDeletions
+    """
+    def __init__(
+        self, stash_roots: List[str],
+        path_filter: Optional[StashPathFilter] = None,
+        sync_jobs: int = 0,
+        link_groups: Optional[Dict[str, Dict[str, str]]] = None,
+        deleted: Optional[Dict[str, List[str]]] = None
+    ) -> None:
+        self.stash_roots = stash_roots
+        self.path_filter = path_filter
+        self.sync_jobs = sync_jobs
+        self.link_groups = link_groups or {}
+        self.deleted = deleted or {}
+        self.plan: Optional[List[List[str]]] = None
+        self.deletions = 0
+
+    def get_plan(self) -> List[List[str]]:
+        """
+        Provides the list of winning paths per stash root
+
+        The stash roots are walked from top to bottom. A path
+        already provided by an upper stash is skipped, directories
+        on both sides are merged, a directory below a path that
+        is not a directory in an upper stash is pruned. Like rsync
+        with --one-file-system, mount points below a stash root
+        are planned but not descended into. The paths
+        deleted by a stash hide the paths of the lower stashes, a
+        deleted directory provided again by an upper stash hides
+        the content the directory has in the lower stashes
+
+        :return: list of relative path lists in stack order
+
+        :rtype: list
+        """
+        if self.plan is None:
+            plan: List[List[str]] = [[] for root in self.stash_roots]
+            claimed: Dict[str, bool] = {}
+            opaque_dirs: Set[str] = set()
+            self.deletions = 0
+            for index in reversed(range(len(self.stash_roots))):
+                root = self.stash_roots[index]
+                root_device = os.lstat(root).st_dev
+                lookup = ['']
+                while lookup:
+                    rel_dir = lookup.pop()
+                    if rel_dir in opaque_dirs:
+                        continue
+                    with os.scandir(os.path.join(root, rel_dir)) as entries:
+                        for entry in entries:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            rel_path = os.path.join(rel_dir, entry.name)
+                            if not self._is_selected(rel_path, is_dir):
+                                continue
+                            # mount points are not descended into
+                            descend = is_dir and entry.stat(
+                                follow_symlinks=False
+                            ).st_dev == root_device
+                            if rel_path in claimed:
+                                if descend and claimed[rel_path]:
+                                    lookup.append(rel_path)
+                                continue
+                            claimed[rel_path] = is_dir
+                            plan[index].append(rel_path)
+                            if descend:
+                                lookup.append(rel_path)
+                # deleted paths only hide paths of the lower stashes
+                for rel_path in self.deleted.get(root, []):
+                    if claimed.setdefault(rel_path, False):
+                        opaque_dirs.add(rel_path)
+                    self.deletions += 1
+            self.plan = plan
+        return self.plan
+
+    def sync_data(
+        self, target_dir: str, metrics: Optional[StackBuildMetrics] = None,
+        checkpoint: Optional[StackCheckpoint] = None
+    ) -> None:
+        """
+        Sync the winning paths of each stash root into target_dir
+
+        The stash roots are synced bottom up such that parent
+        directories implicitly created for a lower stash get
+        their final attributes from the upper stash providing them.
+        Stash roots on a filesystem supporting reflinks are cloned
+        into target_dir instead of synced, the others are copied with
+        the parallel copy engine if sync_jobs is set. Stash roots
+        with link groups are never synced by rsync, which would
+        hardlink all files sharing a blob. Stash roots recorded
+        as applied in the checkpoint are skipped, every synced
+        stash root is recorded in it
+
+        :param str target_dir: target directory path name
+        :param StackBuildMetrics metrics: metrics to record the sync in
+        :param StackCheckpoint checkpoint: checkpoint of target_dir
+        """
+        metrics = metrics or StackBuildMetrics('merge')
+        with metrics.phase('merge_plan'):
+            plan = self.get_plan()
+        if self.deletions:
+            log.info(f'--> {self.deletions} deleted paths applied')
+        for index, (root, paths) in enumerate(zip(self.stash_roots, plan)):
+            if checkpoint and checkpoint.is_applied(index):
+                log.info(f'--> Stash root {root!r} already applied, skipped')
+                continue
+            if not paths:
+                log.info(f'--> Stash root {root!r} fully overlayed, skipped')
+            else:
+                self._sync_root(root, paths, target_dir, metrics)
+            if checkpoint:
+                checkpoint.set_applied(index)
+
+    def _sync_root(
+        self, root: str, paths: List[str], target_dir: str,
+        metrics: StackBuildMetrics
+    ) -> None:
+        link_groups = self.link_groups.get(root)
+        if StackReflink.is_supported(root, target_dir):
+            log.info(
+                '--> Cloning {0} paths from stash root {1!r}'.format(
+                    len(paths), root
+                )
+            )
+            with metrics.phase('sync', stash_root=root, method='reflink'):
+                StackReflink(root).clone(target_dir, paths, link_groups)
+        elif self.sync_jobs or link_groups is not None:
+            log.info(
+                '--> Copying {0} paths from stash root {1!r}'.format(
+                    len(paths), root
+                )
+            )
+            with metrics.phase('sync', stash_root=root, method='copy'):
+                stats = StackParallelCopy(root, self.sync_jobs or 1).copy(
+                    target_dir, paths, link_groups
+                )
+            metrics.add_saved(stats)
+        else:
+            log.info(
+                '--> Syncing {0} paths from stash root {1!r}'.format(
+                    len(paths), root
+                )
+            )
+            self._sync_paths(root, paths, target_dir, metrics)
+        metrics.count_tree(root, paths)
+
+    def _is_selected(self, rel_path: str, is_dir: bool) -> bool:
+        if self.path_filter:
+            return self.path_filter.is_selected(rel_path, is_dir)
+        return True
+
+    @staticmethod
+    def _sync_paths(
+        root: str, paths: List[str], target_dir: str,
+        metrics: StackBuildMetrics
+    ) -> None:
+        with Temporary(prefix='kiwi_stash_merge.').new_file() as files:
+            files.write(b'\0'.join(os.fsencode(path) for path in paths))
+            files.flush()
+            with metrics.phase('sync', stash_root=root, method='rsync'):
+                DataSync(root + os.sep, target_dir).sync_data(
+                    options=Defaults.get_sync_options() + [
+                        '--from0', f'--files-from={files.name}'
+                    ]
+                )
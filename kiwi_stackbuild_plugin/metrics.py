@@ -0,0 +1,171 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import json
+import stat
+import time
+import resource
+import logging
+import threading
+from contextlib import contextmanager
+from typing import (
+    Any, Dict, Iterator, List, Optional
+)
+
+log = logging.getLogger('kiwi')
+
+
+class StackBuildMetrics:
+    """
+    **Implements phase timing and I/O counters**
+
+    Every phase of a stash or stackbuild call is timed with the
+    monotonic clock and recorded with its labels, e.g. the stash
+    it belongs to. Counters accumulate values like the number of
+    files and bytes synced. Phases and counters can be recorded
+    from concurrent threads.
+
+    :param str command: name of the instrumented command
+    :param bool count_io:
+        count synced files and bytes, this walks the synced data
+    """
+    def __init__(self, command: str, count_io: bool = False) -> None:
+        self.command = command
+        self.count_io = count_io
+        self.phases: List[Dict[str, Any]] = []
+        self.counters: Dict[str, int] = {}
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Time the phase run in the context
+
+        The phase is recorded also if it raised an exception
+
+        :param str name: phase name
+        :param dict labels: phase labels
+        """
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start_time
+            log.debug(f'Phase {name} {labels} took {seconds:.3f}s')
+            with self.lock:
+                self.phases.append(
+                    dict(labels, name=name, seconds=round(seconds, 6))
+                )
+
+    def add(self, counter: str, value: int) -> None:
+        """
+        Add value to the given counter
+
+        :param str counter: counter name
+        :param int value: value to add
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def count_tree(
+        self, root_dir: str, paths: Optional[List[str]] = None
+    ) -> None:
+        """
+        Add the files and bytes of a synced tree to the sync counters
+
+        :param str root_dir: root directory of the synced data
+        :param list paths:
+            relative paths synced from root_dir, all of root_dir if None
+        """
+        if not self.count_io:
+            return
+        files, size = 0, 0
+        if paths is None:
+            for dirpath, dirnames, filenames in os.walk(root_dir):
+                for filename in filenames:
+                    files += 1
+                    size += os.lstat(os.path.join(dirpath, filename)).st_size
+        else:
+            for path in paths:
+                path_stat = os.lstat(os.path.join(root_dir, path))
+                if not stat.S_ISDIR(path_stat.st_mode):
+                    files += 1
+                    size += path_stat.st_size
+        self.add('synced_files', files)
+        self.add('synced_bytes', size)
+
+    def add_saved(self, stats: Dict[str, int]) -> None:
+        """
+        Add the bytes saved by hardlinks and holes to the counters
+
+        The bytes are logged too, such that they are visible
+        without a metrics report
+
+        :param dict stats:
+            dict with the hardlink_bytes and sparse_bytes not written
+        """
+        if stats['hardlink_bytes'] or stats['sparse_bytes']:
+            log.info(
+                '--> {0} bytes kept as hardlinks, {1} bytes as holes'.format(
+                    stats['hardlink_bytes'], stats['sparse_bytes']
+                )
+            )
+        self.add('hardlink_saved_bytes', stats['hardlink_bytes'])
+        self.add('sparse_saved_bytes', stats['sparse_bytes'])
+
+    def get_report(self) -> Dict[str, Any]:
+        """
+        Provides the metrics report
+
+        The peak RSS of this process and of the largest
+        child process, e.g. rsync or podman, is reported
+        in bytes
+
+        :return: report dict
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'command': self.command,
+                'total_seconds': round(
+                    time.monotonic() - self.start_time, 6
+                ),
+                'phases': list(self.phases),
+                'counters': dict(self.counters),
+                'peak_rss_bytes': self._get_peak_rss(resource.RUSAGE_SELF),
+                'peak_child_rss_bytes': self._get_peak_rss(
+                    resource.RUSAGE_CHILDREN
+                )
+            }
+
+    def write(self, filename: str) -> None:
+        """
+        Write the metrics report as JSON file
+
+        :param str filename: report file path
+        """
+        log.info(f'Writing metrics report: {filename}')
+        with open(filename, 'w') as report:
+            json.dump(self.get_report(), report, indent=4)
+
+    @staticmethod
+    def _get_peak_rss(who: int) -> int:
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(who).ru_maxrss * 1024
@@ -0,0 +1,121 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import logging
+import threading
+from typing import (
+    Callable, Dict, Tuple
+)
+
+log = logging.getLogger('kiwi')
+
+# stash name, stash source and image id of a stash mount
+StashKey = Tuple[str, str, str]
+
+
+class StackMountPool:
+    """
+    **Implements stash mounts shared by concurrent stackbuilds**
+
+    A stash is mounted by the first stackbuild acquiring it and
+    stays mounted as long as any stackbuild holds a reference.
+    The last release umounts the stash with the umount function
+    given by the stackbuild which mounted it. Mounting and
+    umounting of the same stash is serialized, different stashes
+    are mounted concurrently.
+
+    Mounts are keyed by stash name, stash source, e.g. the
+    registry, and the image id the stash resolved to. A mount is
+    only shared by stackbuilds of the same image from the same
+    source, a stash of the same name pulled from another registry
+    or updated in between is mounted on its own.
+    """
+    def __init__(self) -> None:
+        self.mounts: Dict[
+            StashKey, Tuple[str, int, Callable[[], None]]
+        ] = {}
+        self.stash_locks: Dict[StashKey, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def acquire(
+        self, stash_key: StashKey, mount: Callable[[], str],
+        umount: Callable[[], None]
+    ) -> str:
+        """
+        Provides the mount point of the stash, mounting it if needed
+
+        :param tuple stash_key: stash name, source and image id
+        :param callable mount: function mounting the stash and
+            returning the mount point
+        :param callable umount: function umounting the stash
+
+        :return: stash mount point
+
+        :rtype: str
+        """
+        with self._get_stash_lock(stash_key):
+            if stash_key in self.mounts:
+                mount_point, references, stash_umount = self.mounts[
+                    stash_key
+                ]
+                log.info(
+                    f'Using shared mount of stash {stash_key[0]!r}: '
+                    f'{mount_point!r}'
+                )
+            else:
+                mount_point, references, stash_umount = mount(), 0, umount
+            self.mounts[stash_key] = (
+                mount_point, references + 1, stash_umount
+            )
+            return mount_point
+
+    def release(self, stash_key: StashKey) -> None:
+        """
+        Release a reference of the stash, umounting it with the last one
+
+        :param tuple stash_key: stash name, source and image id
+        """
+        with self._get_stash_lock(stash_key):
+            if stash_key not in self.mounts:
+                return
+            mount_point, references, stash_umount = self.mounts[stash_key]
+            if references > 1:
+                self.mounts[stash_key] = (
+                    mount_point, references - 1, stash_umount
+                )
+            else:
+                del self.mounts[stash_key]
+                stash_umount()
+
+    def get_references(self) -> Dict[StashKey, int]:
+        """
+        Provides the number of references per mounted stash
+
+        :return: stash key to reference count mapping
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                stash_key: references
+                for stash_key, (mount_point, references, umount) in
+                self.mounts.items()
+            }
+
+    def _get_stash_lock(self, stash_key: StashKey) -> threading.Lock:
+        with self.lock:
+            return self.stash_locks.setdefault(stash_key, threading.Lock())
@@ -0,0 +1,105 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import logging
+from typing import List
+
+from kiwi.command import Command
+from kiwi.path import Path
+
+log = logging.getLogger('kiwi')
+
+
+class StackOverlay:
+    """
+    **Implements an overlayfs mount of stacked stash roots**
+
+    The mounted stash roots are used as read-only lower directories
+    of an overlay filesystem mounted at the image root directory.
+    All changes done to the image root are written to an upper
+    directory, the stash data itself is never copied.
+
+    :param list lower_dirs: stash root directories in stack order
+    :param str mountpoint: image root directory to mount the overlay
+    :param str overlay_dir: directory to store the upper and work dirs
+    """
+    def __init__(
+        self, lower_dirs: List[str], mountpoint: str, overlay_dir: str
+    ) -> None:
+        self.lower_dirs = lower_dirs
+        self.mountpoint = mountpoint
+        self.upper = os.path.join(overlay_dir, 'upper')
+        self.work = os.path.join(overlay_dir, 'work')
+        self.mounted = False
+
+    def __enter__(self) -> 'StackOverlay':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.umount()
+
+    @staticmethod
+    def is_supported() -> bool:
+        """
+        Check if the running kernel provides the overlay filesystem
+
+        :return: True or False
+
+        :rtype: bool
+        """
+        try:
+            with open('/proc/filesystems') as filesystems:
+                for line in filesystems:
+                    if line.split()[-1:] == ['overlay']:
+                        return True
+        except OSError as issue:
+            log.debug(f'Reading /proc/filesystems failed with: {issue}')
+        return False
+
+    def mount(self) -> None:
+        """
+        Mount the overlay filesystem
+
+        overlayfs expects the lower directories from top to bottom,
+        thus the stack order is reversed such that the last stash
+        takes precedence over the former ones
+        """
+        Path.create(self.upper)
+        Path.create(self.work)
+        Path.create(self.mountpoint)
+        Command.run(
+            [
+                'mount', '-t', 'overlay', 'overlay', self.mountpoint, '-o',
+                'lowerdir={0},upperdir={1},workdir={2}'.format(
+                    ':'.join(reversed(self.lower_dirs)),
+                    self.upper, self.work
+                )
+            ]
+        )
+        self.mounted = True
+
+    def umount(self) -> None:
+        """
+        Umount the overlay filesystem
+        """
+        if self.mounted:
+            log.info(f'Umount stash overlay: {self.mountpoint!r}')
+            Command.run(
+                ['umount', self.mountpoint], raise_on_error=False
+            )
+            self.mounted = False
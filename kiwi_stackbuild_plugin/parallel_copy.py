@@ -0,0 +1,169 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import stat
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Dict, Iterator, List, Optional, Tuple
+)
+
+from kiwi_stackbuild_plugin.tree import StackTree
+
+log = logging.getLogger('kiwi')
+
+# limits of the files and bytes copied as one unit of work
+WORK_UNIT_FILES = 256
+WORK_UNIT_BYTES = 64 * 1024 * 1024
+
+Entry = Tuple[str, os.stat_result]
+
+
+class StackParallelCopy:
+    """
+    **Implements a multi-threaded copy of a stash root tree**
+
+    Copying many small files is bound by the latency of the per
+    file system calls rather than by the disk bandwidth. The
+    directories are created first, then the files are split into
+    work units of at most WORK_UNIT_FILES files or WORK_UNIT_BYTES
+    bytes, which are copied by a pool of threads. The file data is
+    copied in the kernel with copy_file_range, only the data
+    segments of a file are copied such that sparse files stay
+    sparse. Hardlinks are linked to the first copy of their inode,
+    or of their link group if given, once all files are copied.
+    Owner, mode, times and extended attributes, which includes
+    the POSIX ACLs, are copied from the stash root like rsync
+    does with the kiwi sync options, directories get their
+    metadata last. Mount points below the stash root are not
+    descended into, see StackTree.get_paths.
+
+    :param str source_dir: stash root directory
+    :param int jobs: number of copy threads
+    """
+    def __init__(self, source_dir: str, jobs: int = 1) -> None:
+        self.source_dir = source_dir
+        self.jobs = jobs
+
+    def copy(
+        self, target_dir: str, paths: Optional[List[str]] = None,
+        link_groups: Optional[Dict[str, str]] = None
+    ) -> Dict[str, int]:
+        """
+        Copy the stash root into target_dir
+
+        :param str target_dir: target directory
+        :param list paths:
+            relative paths to copy in parent first order, all
+            of source_dir if None. Missing parent directories of
+            the given paths are created
+        :param dict link_groups:
+            relative path to link group mapping of the files to
+            hardlink, see StashBlobStore.get_link_groups. Files of
+            the stash root sharing an inode are hardlinked if None
+
+        :return: dict with the bytes not copied because of
+            hardlinks and because of holes in sparse files
+
+        :rtype: dict
+        """
+        directories: List[Entry] = []
+        files: List[Entry] = []
+        links: List[Tuple[str, str]] = []
+        link_targets: Dict[object, str] = {}
+        if paths is None:
+            paths = list(StackTree.get_paths(self.source_dir))
+        for rel_path in paths:
+            source_stat = os.lstat(os.path.join(self.source_dir, rel_path))
+            if stat.S_ISDIR(source_stat.st_mode):
+                os.makedirs(os.path.join(target_dir, rel_path), exist_ok=True)
+                directories.append((rel_path, source_stat))
+                continue
+            os.makedirs(
+                os.path.join(target_dir, os.path.dirname(rel_path)),
+                exist_ok=True
+            )
+            link_group = StackTree.get_link_group(
+                rel_path, source_stat, link_groups
+            )
+            if link_group is not None:
+                if link_group in link_targets:
+                    links.append((link_targets[link_group], rel_path))
+                    continue
+                link_targets[link_group] = rel_path
+            files.append((rel_path, source_stat))
+        log.debug(
+            '--> Copying {0} files with {1} threads'.format(
+                len(files), self.jobs
+            )
+        )
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            sparse_bytes = sum(pool.map(
+                lambda unit: self._copy_files(target_dir, unit),
+                self._get_work_units(files)
+            ))
+        hardlink_bytes = 0
+        for link_target, rel_path in links:
+            target = os.path.join(target_dir, rel_path)
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.link(os.path.join(target_dir, link_target), target)
+            hardlink_bytes += os.lstat(target).st_size
+        # directory metadata is applied last because adding
+        # entries to a directory changes its modification time
+        for rel_path, source_stat in reversed(directories):
+            StackTree.copy_metadata(
+                os.path.join(self.source_dir, rel_path),
+                os.path.join(target_dir, rel_path), source_stat
+            )
+        return {
+            'hardlink_bytes': hardlink_bytes,
+            'sparse_bytes': sparse_bytes
+        }
+
+    def _copy_files(self, target_dir: str, unit: List[Entry]) -> int:
+        sparse_bytes = 0
+        for rel_path, source_stat in unit:
+            source = os.path.join(self.source_dir, rel_path)
+            target = os.path.join(target_dir, rel_path)
+            if os.path.lexists(target):
+                os.unlink(target)
+            if stat.S_ISREG(source_stat.st_mode):
+                sparse_bytes += StackTree.copy_data(
+                    source, target, source_stat.st_size
+                )
+            elif stat.S_ISLNK(source_stat.st_mode):
+                os.symlink(os.readlink(source), target)
+            else:
+                os.mknod(target, source_stat.st_mode, source_stat.st_rdev)
+            StackTree.copy_metadata(source, target, source_stat)
+        return sparse_bytes
+
+    @staticmethod
+    def _get_work_units(files: List[Entry]) -> Iterator[List[Entry]]:
+        unit: List[Entry] = []
+        unit_bytes = 0
+        for entry in files:
+            unit.append(entry)
+            unit_bytes += entry[1].st_size
+            if len(unit) == WORK_UNIT_FILES or unit_bytes >= WORK_UNIT_BYTES:
+                yield unit
+                unit = []
+                unit_bytes = 0
+        if unit:
+            yield unit
@@ -0,0 +1,111 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+from fnmatch import fnmatch
+from typing import List
+
+
+class StashPathFilter:
+    """
+    **Implements include and exclude path filters for stash roots**
+
+    Patterns are shell style patterns matched against the path
+    relative to the stash root, like the stash exclude list. A
+    path matching an exclude pattern is skipped together with
+    everything below it. If include patterns are given, only the
+    paths matching an include pattern, everything below them and
+    the parent directories leading to them are selected.
+
+    :param list include_list: list of path patterns to select
+    :param list exclude_list: list of path patterns to skip
+    """
+    def __init__(
+        self, include_list: List[str] = [], exclude_list: List[str] = []
+    ) -> None:
+        self.include_list = [
+            self._normalize(pattern) for pattern in include_list
+        ]
+        self.exclude_list = [
+            self._normalize(pattern) for pattern in exclude_list
+        ]
+
+    def __bool__(self) -> bool:
+        return bool(self.include_list or self.exclude_list)
+
+    def get_key_data(self) -> List[str]:
+        """
+        Provides the filter patterns as strings for cache keys
+
+        :return: list of tagged patterns
+
+        :rtype: list
+        """
+        return [
+            f'include:{pattern}' for pattern in self.include_list
+        ] + [
+            f'exclude:{pattern}' for pattern in self.exclude_list
+        ]
+
+    def is_selected(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Check if the given path passes the filters
+
+        A directory which is not selected has no selected
+        content, so walkers can skip it as a whole
+
+        :param str rel_path: path relative to the stash root
+        :param bool is_dir: path is a directory
+
+        :return: True or False
+
+        :rtype: bool
+        """
+        parents = self._get_parents(rel_path)
+        for path in parents:
+            for pattern in self.exclude_list:
+                if fnmatch(path, pattern):
+                    return False
+        if not self.include_list:
+            return True
+        for path in parents:
+            for pattern in self.include_list:
+                if fnmatch(path, pattern):
+                    return True
+        return is_dir and self._leads_to_include(rel_path)
+
+    def _leads_to_include(self, rel_dir: str) -> bool:
+        names = rel_dir.split(os.sep)
+        for pattern in self.include_list:
+            pattern_names = pattern.split(os.sep)
+            if len(names) < len(pattern_names) and all(
+                fnmatch(name, pattern_name)
+                for name, pattern_name in zip(names, pattern_names)
+            ):
+                return True
+        return False
+
+    @staticmethod
+    def _get_parents(rel_path: str) -> List[str]:
+        names = rel_path.split(os.sep)
+        return [
+            os.sep.join(names[:count]) for count in range(1, len(names) + 1)
+        ]
+
+    @staticmethod
+    def _normalize(pattern: str) -> str:
+        return os.path.normpath(pattern.strip(os.sep))
@@ -0,0 +1,143 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import stat
+import fcntl
+import logging
+from typing import (
+    Dict, List, Optional
+)
+
+from kiwi.utils.temporary import Temporary
+
+from kiwi_stackbuild_plugin.tree import StackTree
+
+log = logging.getLogger('kiwi')
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+
+class StackReflink:
+    """
+    **Implements a copy-on-write clone of a stash root tree**
+
+    Regular files are cloned with the FICLONE ioctl such that
+    the target shares the data extents of the stash instead of
+    copying them. Directories, symlinks, device nodes and
+    hardlinks are recreated. Owner, mode, times and extended
+    attributes, which includes the POSIX ACLs, are copied from
+    the stash root like rsync does with the kiwi sync options.
+    Like rsync with --one-file-system, mount points below the
+    stash root are not descended into.
+
+    :param str source_dir: stash root directory
+    """
+    def __init__(self, source_dir: str) -> None:
+        self.source_dir = source_dir
+
+    @staticmethod
+    def is_supported(source_dir: str, target_dir: str) -> bool:
+        """
+        Check if files of source_dir can be cloned into target_dir
+
+        The check clones the first regular file found in source_dir
+        into a temporary file in target_dir. Cloning requires both
+        to live on the same filesystem supporting reflinks, e.g.
+        btrfs or XFS
+
+        :param str source_dir: stash root directory
+        :param str target_dir: target directory
+
+        :return: True or False
+
+        :rtype: bool
+        """
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                if os.path.isfile(source) and not os.path.islink(source):
+                    try:
+                        with open(source, 'rb') as source_file:
+                            with Temporary(
+                                path=target_dir, prefix='.kiwi_reflink.'
+                            ).new_file() as target_file:
+                                fcntl.ioctl(
+                                    target_file.fileno(), FICLONE,
+                                    source_file.fileno()
+                                )
+                        return True
+                    except OSError as issue:
+                        log.debug(f'Reflink not supported: {issue}')
+                        return False
+        return False
+
+    def clone(
+        self, target_dir: str, paths: Optional[List[str]] = None,
+        link_groups: Optional[Dict[str, str]] = None
+    ) -> None:
+        """
+        Clone the stash root into target_dir
+
+        :param str target_dir: target directory
+        :param list paths:
+            relative paths to clone in parent first order, all
+            of source_dir if None. Missing parent directories of
+            the given paths are created
+        :param dict link_groups:
+            relative path to link group mapping of the files to
+            hardlink, see StashBlobStore.get_link_groups. Files of
+            the stash root sharing an inode are hardlinked if None
+        """
+        links: Dict[object, str] = {}
+        directories = []
+        for rel_path in StackTree.get_paths(self.source_dir) if paths is None else paths:
+            source = os.path.join(self.source_dir, rel_path)
+            target = os.path.join(target_dir, rel_path)
+            source_stat = os.lstat(source)
+            if stat.S_ISDIR(source_stat.st_mode):
+                os.makedirs(target, exist_ok=True)
+                directories.append((source, target, source_stat))
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.lexists(target):
+                os.unlink(target)
+            link_group = StackTree.get_link_group(
+                rel_path, source_stat, link_groups
+            )
+            if link_group in links:
+                os.link(links[link_group], target)
+                continue
+            if stat.S_ISREG(source_stat.st_mode):
+                with open(source, 'rb') as source_file:
+                    with open(target, 'xb') as target_file:
+                        fcntl.ioctl(
+                            target_file.fileno(), FICLONE,
+                            source_file.fileno()
+                        )
+            elif stat.S_ISLNK(source_stat.st_mode):
+                os.symlink(os.readlink(source), target)
+            else:
+                os.mknod(target, source_stat.st_mode, source_stat.st_rdev)
+            StackTree.copy_metadata(source, target, source_stat)
+            if link_group is not None:
+                links[link_group] = target
+        # directory metadata is applied last because adding
+        # entries to a directory changes its modification time
+        for source, target, source_stat in reversed(directories):
+            StackTree.copy_metadata(source, target, source_stat)
@@ -0,0 +1,200 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import hashlib
+import logging
+from typing import (
+    Any, Dict, List
+)
+
+from kiwi.command import Command
+from kiwi.path import Path
+from kiwi.exceptions import KiwiCommandError
+
+from kiwi_stackbuild_plugin.lock import StashLock
+
+log = logging.getLogger('kiwi')
+
+
+class StackRootCache:
+    """
+    **Implements a cache of assembled image roots**
+
+    The image root assembled from a stack of stashes is kept
+    at <stash_home>/.root-cache/<key>/root, keyed by the digests
+    of the stashes in stack order. A stackbuild of the same stack
+    copies the cached root into its image root with reflinks
+    where the filesystem supports them, instead of mounting and
+    syncing every stash again.
+
+    Entries are added atomically and are held by a shared
+    StashLock while being copied, such that the garbage
+    collection never removes an entry in use. The lock file of
+    an entry is kept next to the entry at
+    <stash_home>/.root-cache/<key>.lock, such that removing the
+    entry doesn't remove the lock file held by the garbage
+    collection.
+
+    :param str stash_home: stash home directory
+    """
+    def __init__(self, stash_home: str) -> None:
+        self.stash_home = stash_home
+        self.cache_dir = os.path.join(stash_home, '.root-cache')
+
+    @staticmethod
+    def get_key(digests: List[str]) -> str:
+        """
+        Provides the cache key of a stash stack
+
+        :param list digests: stash digests in stack order
+
+        :return: sha256 hex digest
+
+        :rtype: str
+        """
+        return hashlib.sha256('\0'.join(digests).encode()).hexdigest()
+
+    def has_root(self, key: str) -> bool:
+        """
+        Check if an assembled root is cached for the given key
+
+        :param str key: cache key
+
+        :return: True or False
+
+        :rtype: bool
+        """
+        return os.path.isdir(self._get_root(key))
+
+    def add_root(self, key: str, root_dir: str) -> None:
+        """
+        Add a copy of the given assembled root to the cache
+
+        :param str key: cache key
+        :param str root_dir: assembled image root directory
+        """
+        if self.has_root(key):
+            return
+        entry_tmp = os.path.join(self.cache_dir, f'{key}.{os.getpid()}')
+        Path.create(entry_tmp)
+        try:
+            log.info(f'Adding image root to root cache: {key}')
+            self._copy_tree(root_dir, os.path.join(entry_tmp, 'root'))
+            os.rename(entry_tmp, os.path.join(self.cache_dir, key))
+        except OSError as issue:
+            # a concurrent stackbuild cached the same stack first
+            log.debug(f'Root cache entry {key} not added: {issue}')
+        except KiwiCommandError as issue:
+            # the image root is built, caching it is optional
+            log.warning(f'Root cache entry {key} not added: {issue}')
+        finally:
+            Path.wipe(entry_tmp)
+
+    def materialize(self, key: str, target_dir: str) -> bool:
+        """
+        Copy the cached root of the given key to target_dir
+
+        :param str key: cache key
+        :param str target_dir: image root directory
+
+        :return: True if the cached root was copied, False on cache miss
+
+        :rtype: bool
+        """
+        entry_lock = self._get_lock(key)
+        if not entry_lock.acquire():
+            return False
+        try:
+            if not self.has_root(key):
+                return False
+            log.info(f'Using image root from root cache: {key}')
+            self._copy_tree(self._get_root(key), target_dir)
+            os.utime(os.path.join(self.cache_dir, key))
+            return True
+        finally:
+            entry_lock.release()
+
+    def get_entries(self) -> List[Dict[str, Any]]:
+        """
+        Provides key, size and last use time of all cache entries
+
+        :return: list of entry dicts, least recently used first
+
+        :rtype: list
+        """
+        entries = []
+        if os.path.isdir(self.cache_dir):
+            for key in os.listdir(self.cache_dir):
+                if not self.has_root(key):
+                    continue
+                size = 0
+                for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(self.cache_dir, key)
+                ):
+                    for filename in filenames:
+                        size += os.lstat(
+                            os.path.join(dirpath, filename)
+                        ).st_size
+                entries.append(
+                    {
+                        'key': key,
+                        'size': size,
+                        'last_used': int(
+                            os.stat(os.path.join(self.cache_dir, key)).st_mtime
+                        )
+                    }
+                )
+        return sorted(
+            entries, key=lambda entry: (entry['last_used'], entry['key'])
+        )
+
+    def remove(self, key: str) -> bool:
+        """
+        Remove the cache entry of the given key if it is not in use
+
+        :param str key: cache key
+
+        :return: True if the entry was removed
+
+        :rtype: bool
+        """
+        entry_lock = self._get_lock(key)
+        if not entry_lock.acquire(exclusive=True, blocking=False):
+            return False
+        try:
+            log.info(f'Removing root cache entry: {key}')
+            Path.wipe(os.path.join(self.cache_dir, key))
+        finally:
+            entry_lock.release()
+        return True
+
+    def _get_lock(self, key: str) -> StashLock:
+        return StashLock(self.cache_dir, key, self.cache_dir)
+
+    def _get_root(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key, 'root')
+
+    @staticmethod
+    def _copy_tree(source_dir: str, target_dir: str) -> None:
+        Path.create(target_dir)
+        Command.run(
+            [
+                'cp', '--archive', '--reflink=auto',
+                os.path.join(source_dir, '.'), target_dir
+            ]
+        )
@@ -0,0 +1,220 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any, Callable, Dict, Optional
+)
+
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginServerError
+)
+
+log = logging.getLogger('kiwi')
+
+
+class StackBuildServer:
+    """
+    **Implements a stackbuild job server on a unix socket**
+
+    The server reads one JSON request line per connection and
+    answers it with one JSON response line:
+
+    .. code:: json
+
+        {"command": "submit", "args": ["--stash", "name", ...],
+         "type": "iso", "profiles": ["Desktop"]}
+        {"command": "status", "job": 1}
+        {"command": "list"}
+        {"command": "shutdown"}
+
+    A submitted job is checked and queued right away, the response
+    provides its job id. Queued jobs are run by a pool of worker
+    threads in submit order. A shutdown stops accepting requests
+    and waits for the queued and running jobs. Errors are answered
+    with an error message.
+
+    :param str socket_path: unix socket path
+    :param callable new_job: function creating the job function
+        from a submit request, raising on invalid requests
+    :param int workers: number of concurrent jobs
+    """
+    def __init__(
+        self, socket_path: str,
+        new_job: Callable[[Dict[str, Any]], Callable[[], None]],
+        workers: int = 1
+    ) -> None:
+        self.socket_path = socket_path
+        self.new_job = new_job
+        self.workers = workers
+        self.jobs: Dict[int, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.server: Optional[socketserver.UnixStreamServer] = None
+
+    def serve(self) -> None:
+        """
+        Serve requests until a shutdown request is received
+        """
+        self._check_socket()
+        stack_server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                try:
+                    request = json.loads(self.rfile.readline())
+                except ValueError as issue:
+                    response = {'error': f'Invalid request: {issue}'}
+                else:
+                    response = stack_server.handle(request)
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, RequestHandler
+        )
+        # jobs run with the privileges of the server
+        os.chmod(self.socket_path, 0o600)
+        log.info(
+            f'Serving stackbuild jobs on {self.socket_path!r} '
+            f'with {self.workers} workers'
+        )
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+            self.pool.shutdown(wait=True)
+            log.info('Stackbuild server stopped')
+
+    def handle(self, request: Any) -> Dict[str, Any]:
+        """
+        Handle one request
+
+        :param dict request: request data
+
+        :return: response data
+
+        :rtype: dict
+        """
+        command = request.get('command') \
+            if isinstance(request, dict) else None
+        try:
+            if command == 'submit':
+                return {'job': self.submit(request)}
+            if command == 'status':
+                return self.get_job(request.get('job'))
+            if command == 'list':
+                with self.lock:
+                    return {
+                        'jobs': [dict(job) for job in self.jobs.values()]
+                    }
+            if command == 'shutdown':
+                self.shutdown()
+                return {'shutdown': True}
+        except (Exception, SystemExit) as issue:
+            return {'error': f'{type(issue).__name__}: {issue}'}
+        return {'error': f'Unknown request command: {command!r}'}
+
+    def submit(self, request: Dict[str, Any]) -> int:
+        """
+        Check and queue a job
+
+        :param dict request: submit request data
+
+        :return: job id
+
+        :rtype: int
+        """
+        job = self.new_job(request)
+        with self.lock:
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = {
+                'job': job_id,
+                'args': request.get('args'),
+                'state': 'queued',
+                'error': None,
+                'submitted': time.time(),
+                'finished': None
+            }
+        log.info(f'Queued stackbuild job {job_id}: {request.get("args")}')
+        self.pool.submit(self._run, job_id, job)
+        return job_id
+
+    def get_job(self, job_id: Any) -> Dict[str, Any]:
+        """
+        Provides the data of a job
+
+        :param int job_id: job id
+
+        :return: job data
+
+        :rtype: dict
+        """
+        with self.lock:
+            if job_id not in self.jobs:
+                raise KiwiStackBuildPluginServerError(
+                    f'Unknown job: {job_id!r}'
+                )
+            return dict(self.jobs[job_id])
+
+    def shutdown(self) -> None:
+        """
+        Stop serving requests, queued and running jobs are finished
+        """
+        if self.server:
+            log.info('Stackbuild server shutdown requested')
+            # shutdown blocks until serve_forever has returned
+            threading.Thread(target=self.server.shutdown).start()
+
+    def _run(self, job_id: int, job: Callable[[], None]) -> None:
+        self._update_job(job_id, state='running')
+        log.info(f'Running stackbuild job {job_id}')
+        try:
+            job()
+            self._update_job(job_id, state='done', finished=time.time())
+            log.info(f'Stackbuild job {job_id} done')
+        except (Exception, SystemExit) as issue:
+            self._update_job(
+                job_id, state='failed', finished=time.time(),
+                error=f'{type(issue).__name__}: {issue}'
+            )
+            log.error(f'Stackbuild job {job_id} failed: {issue}')
+
+    def _update_job(self, job_id: int, **data: Any) -> None:
+        with self.lock:
+            self.jobs[job_id].update(data)
+
+    def _check_socket(self) -> None:
+        if not os.path.exists(self.socket_path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(self.socket_path)
+            except OSError:
+                log.info(f'Removing stale socket {self.socket_path!r}')
+                os.unlink(self.socket_path)
+                return
+        raise KiwiStackBuildPluginServerError(
+            f'A stackbuild server is already serving on {self.socket_path!r}'
+        )
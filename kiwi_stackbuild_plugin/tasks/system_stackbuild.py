@@ -18,11 +18,43 @@
 """
 usage: kiwi-ng system stackbuild -h | --help
        kiwi-ng system stackbuild --stash=<name>... --description=<directory> --target-dir=<directory>
-           [--from-registry=<URI>]
+           [--from-registry=<URI>|--from-archive]
+           [--punch-holes]
+           [--pull-jobs=<number>]
+           [--sync-jobs=<number>]
+           [--overlay]
+           [--root-cache]
+           [--resume]
+           [--include=<pattern>...]
+           [--exclude=<pattern>...]
+           [--metrics-file=<path>]
            [-- <kiwi_build_command_args>...]
        kiwi-ng system stackbuild --stash=<name>... --target-dir=<directory>
-           [--from-registry=<URI>]
+           [--from-registry=<URI>|--from-archive]
+           [--punch-holes]
+           [--pull-jobs=<number>]
+           [--sync-jobs=<number>]
+           [--overlay]
+           [--root-cache]
+           [--resume]
+           [--include=<pattern>...]
+           [--exclude=<pattern>...]
+           [--metrics-file=<path>]
            [-- <kiwi_create_command_args>...]
+       kiwi-ng system stackbuild --stash=<name>... --batch=<manifest> --target-dir=<directory>
+           [--jobs=<number>]
+           [--from-registry=<URI>|--from-archive]
+           [--punch-holes]
+           [--pull-jobs=<number>]
+           [--sync-jobs=<number>]
+           [--root-cache]
+           [--resume]
+           [--include=<pattern>...]
+           [--exclude=<pattern>...]
+           [--metrics-file=<path>]
+       kiwi-ng system stackbuild --serve
+           [--socket=<path>]
+           [--workers=<number>]
        kiwi-ng system stackbuild help
 
 commands:
@@ -40,12 +72,103 @@ options:
     --stash=<name>...
         Name of the stash container. See 'system stash --list'
         for available stashes. Multiple stashes will be stacked
-        together in the given order
+        together in the given order. Every path is synced only
+        once from the stash providing it last in the stack.
+        Stashes kept in the blob store are used from there
+        without mounting the stash container
 
     --from-registry=<URI>
         Pull given stash container name from the provided
         registry URI
 
+    --from-archive
+        Unpack the layers of the stash OCI archives from the
+        stash home directly into the image root instead of
+        mounting the stash containers. Whiteouts in the layers
+        remove the paths of the lower layers
+
+    --punch-holes
+        Write blocks of zeros in the files unpacked from the
+        stash archives as holes. Files allocated in full in the
+        stash, like swap files or preallocated databases, become
+        sparse files too. Only used with --from-archive
+
+    --pull-jobs=<number>
+        Number of concurrent registry pulls if multiple stashes
+        are fetched via --from-registry. Each stash is mounted as
+        soon as its pull has finished. Defaults to 4
+
+    --sync-jobs=<number>
+        Copy the stash roots into the image root with the given
+        number of threads using the built-in parallel copy engine
+        instead of rsync. The copy preserves hardlinks, extended
+        attributes, ACLs, device nodes and sparse files like the
+        rsync based sync. Stash roots cloned with reflinks are not
+        affected
+
+    --overlay
+        Stack the stash roots as overlayfs lower directories below
+        a writable upper directory in the target dir instead of
+        copying the stash data into the image root. Falls back to
+        the copy based sync if overlayfs is not supported
+
+    --root-cache
+        Keep the image root assembled from the stashes in a cache
+        keyed by the stash digests in stack order. A stackbuild of
+        the same stash stack copies the cached root, with reflinks
+        if supported by the filesystem, instead of mounting and
+        syncing the stashes. The root cache is not used with
+        the --overlay and --from-registry options
+
+    --resume
+        Continue a failed stackbuild in the existing image root of
+        the target dir. Stashes recorded as applied in the checkpoint
+        of the image root are skipped, the stackbuild continues with
+        the first stash not applied completely. Cannot be combined
+        with the --overlay option
+
+    --include=<pattern>...
+        Sync only the paths of each stash matching one of the given
+        shell style patterns relative to the stash root, e.g. usr,
+        together with their content and parent directories. Paths
+        not selected are neither read nor written. Cannot be
+        combined with the --overlay option
+
+    --exclude=<pattern>...
+        Skip the paths of each stash matching one of the given
+        shell style patterns relative to the stash root, together
+        with their content. Cannot be combined with the --overlay
+        option
+
+    --batch=<manifest>
+        Assemble the stash stack once and run every build listed
+        in the given YAML manifest on a copy-on-write clone of the
+        assembled root. Each build gets its own target directory
+        below the target dir, named by the build, and its own log
+
+    --jobs=<number>
+        Number of concurrent builds of a --batch manifest.
+        Defaults to 1
+
+    --serve
+        Run as stackbuild server which takes stackbuild jobs from
+        clients on a unix socket. Jobs are queued and run by a pool
+        of workers in one long running process, concurrent jobs
+        share the mounts of the same stash
+
+    --socket=<path>
+        Unix socket path of the stackbuild server. Defaults to
+        /run/kiwi-stackbuild.sock
+
+    --workers=<number>
+        Number of concurrent jobs of the stackbuild server.
+        Defaults to 2
+
+    --metrics-file=<path>
+        Write a JSON report with the time spent in every step
+        per stash, the number of files and bytes synced and the
+        peak memory usage to the given file
+
     --description=<directory>
         Path to KIWI image description
 
@@ -61,36 +184,45 @@ options:
         'system create' command.
 """
 import os
-import sys
 import logging
-from unittest.mock import patch
 from docopt import docopt
+from functools import partial
 from typing import (
-    Dict, List
+    TYPE_CHECKING, Any, Callable, Dict, List, Optional, cast
 )
 
-import kiwi.tasks.system_build
-import kiwi.tasks.system_create
-
+# kiwi loads the modules of all task plugins on every call. Only
+# modules loaded by kiwi itself anyway are imported here, everything
+# else is imported by the code path using it, see test/unit/import_test.py
 from kiwi.help import Help
 from kiwi.privileges import Privileges
 from kiwi.tasks.base import CliTask
-from kiwi.tasks.system_create import SystemCreateTask
-from kiwi.tasks.system_build import SystemBuildTask
 from kiwi.command import Command
 from kiwi.path import Path
-from kiwi.utils.sync import DataSync
 from kiwi.defaults import Defaults
 
+from kiwi_stackbuild_plugin.defaults import StackBuildDefaults
 from kiwi_stackbuild_plugin.exceptions import (
     KiwiStackBuildPluginTargetDirExists,
-    KiwiStackBuildPluginRootSyncFailed
+    KiwiStackBuildPluginRootSyncFailed,
+    KiwiStackBuildPluginInvalidArgument,
+    KiwiStackBuildPluginStashNotFoundError,
+    KiwiStackBuildPluginBatchBuildFailed,
+    KiwiStackBuildPluginResumeFailed
 )
 
+if TYPE_CHECKING:  # pragma: no cover
+    from kiwi_stackbuild_plugin.batch import StackBatch
+    from kiwi_stackbuild_plugin.lock import StashLock
+    from kiwi_stackbuild_plugin.mount_pool import StackMountPool, StashKey
+
 log = logging.getLogger('kiwi')
 
 
 class SystemStackbuildTask(CliTask):
+    # stash mounts shared by the jobs of a stackbuild server
+    mount_pool: Optional['StackMountPool'] = None
+
     def process(self) -> None:
         self.manual = Help()
         if self.command_args.get('help') is True:
@@ -98,164 +230,655 @@ class SystemStackbuildTask(CliTask):
 
         Privileges.check_for_root_permissions()
 
+        if self.command_args.get('--serve'):
+            return self._serve()
+
         if self.command_args.get('--stash'):
-            image_root_dir = os.path.join(
-                self.command_args['--target-dir'], 'build', 'image-root'
+            from kiwi_stackbuild_plugin.batch import StackBatch
+            from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+            from kiwi_stackbuild_plugin.path_filter import StashPathFilter
+            self.pull_jobs = self._get_jobs_count(
+                '--pull-jobs', StackBuildDefaults.get_pull_jobs()
             )
-            if os.path.exists(image_root_dir):
-                raise KiwiStackBuildPluginTargetDirExists(
-                    f'image root dir: {image_root_dir!r} already exists'
+            self.sync_jobs = self._get_jobs_count('--sync-jobs', 0)
+            conflicts = [
+                option for option in ('--from-registry', '--overlay')
+                if self.command_args.get(option)
+            ]
+            if self.command_args.get('--from-archive') and conflicts:
+                raise KiwiStackBuildPluginInvalidArgument(
+                    f'--from-archive cannot be combined with {conflicts}'
+                )
+            if self.command_args.get('--punch-holes') and \
+                    not self.command_args.get('--from-archive'):
+                raise KiwiStackBuildPluginInvalidArgument(
+                    '--punch-holes can only be used with --from-archive'
+                )
+            self.path_filter = StashPathFilter(
+                self.command_args.get('--include') or [],
+                self.command_args.get('--exclude') or []
+            )
+            if self.command_args.get('--overlay') and self.path_filter:
+                raise KiwiStackBuildPluginInvalidArgument(
+                    '--include and --exclude cannot be combined with --overlay'
+                )
+            if self.command_args.get('--overlay') and \
+                    self.command_args.get('--resume'):
+                raise KiwiStackBuildPluginInvalidArgument(
+                    '--resume cannot be combined with --overlay'
                 )
-            Path.create(image_root_dir)
+            self.batch: Optional['StackBatch'] = None
+            if self.command_args.get('--batch'):
+                self.jobs = self._get_jobs_count('--jobs', 1)
+                self.batch = StackBatch(
+                    self.command_args['--batch'], self.global_args
+                )
+            self.blob_store_stashes: List[str] = []
+            self.link_groups: Dict[str, Dict[str, str]] = {}
+            self.deleted = self._get_deleted_paths()
+            self.shared_stashes: List['StashKey'] = []
+            self.stash_locks: List['StashLock'] = []
+            self.metrics = StackBuildMetrics(
+                'stackbuild',
+                count_io=bool(self.command_args.get('--metrics-file'))
+            )
+            try:
+                self._stackbuild()
+            finally:
+                if self.command_args.get('--metrics-file'):
+                    self.metrics.write(self.command_args['--metrics-file'])
 
-            for stash_name in self.command_args['--stash']:
-                if self.command_args['--from-registry']:
-                    log.info(
-                        'Fetching stash {0!r} from registry {1!r}'.format(
-                            stash_name,
-                            self.command_args['--from-registry']
-                        )
+    def _serve(self) -> None:
+        from kiwi_stackbuild_plugin.mount_pool import StackMountPool
+        from kiwi_stackbuild_plugin.server import StackBuildServer
+        self.mount_pool = StackMountPool()
+        socket_path = self.command_args.get('--socket') or \
+            StackBuildDefaults.get_server_socket()
+        StackBuildServer(
+            socket_path, self._new_server_job,
+            self._get_jobs_count(
+                '--workers', StackBuildDefaults.get_server_workers()
+            )
+        ).serve()
+
+    def _new_server_job(self, request: Dict[str, Any]) -> Callable[[], None]:
+        # a job is a stackbuild task created in process from the
+        # stackbuild arguments of the request and the global
+        # arguments of the server
+        from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+        args = request.get('args')
+        if not isinstance(args, list):
+            raise KiwiStackBuildPluginInvalidArgument(
+                f'Job args must be a list of stackbuild arguments: {args!r}'
+            )
+        # job args never print the help, the help flag is passed
+        # positionally as docopt and docopt-ng name it differently
+        command_args = docopt(
+            __doc__, ['system', 'stackbuild'] + [str(arg) for arg in args],
+            False
+        )
+        if not command_args.get('--stash'):
+            raise KiwiStackBuildPluginInvalidArgument(
+                f'Not a stackbuild job: {args}'
+            )
+        global_args = dict(self.global_args)
+        global_args['--type'] = request.get('type')
+        global_args['--profile'] = request.get('profiles') or []
+        job = cast(
+            SystemStackbuildTask, StackKiwiTask(self).create(
+                SystemStackbuildTask, command_args, global_args
+            )
+        )
+        job.mount_pool = self.mount_pool
+        return job.process
+
+    def _stackbuild(self) -> None:
+        from kiwi_stackbuild_plugin.checkpoint import StackCheckpoint
+        from kiwi_stackbuild_plugin.overlay import StackOverlay
+        image_root_dir = os.path.join(
+            self.command_args['--target-dir'], 'build', 'image-root'
+        )
+        # the checkpoint records the stashes applied to the image
+        # root such that a failed stackbuild can be resumed
+        self.checkpoint = StackCheckpoint(
+            os.path.join(
+                self.command_args['--target-dir'], 'build',
+                'stackbuild.checkpoint'
+            )
+        )
+        resume = os.path.exists(image_root_dir)
+        if resume:
+            if not self.command_args.get('--resume'):
+                raise KiwiStackBuildPluginTargetDirExists(
+                    f'image root dir: {image_root_dir!r} already exists, '
+                    'use --resume to continue a failed stackbuild'
+                )
+            if not self.checkpoint.load():
+                raise KiwiStackBuildPluginResumeFailed(
+                    f'No checkpoint found for image root dir: {image_root_dir!r}'
+                )
+            log.info(f'Resuming stackbuild in image root: {image_root_dir!r}')
+        if self.batch:
+            for build_target_dir in self.batch.get_target_dirs(
+                self.command_args['--target-dir']
+            ):
+                if os.path.exists(build_target_dir):
+                    raise KiwiStackBuildPluginTargetDirExists(
+                        f'batch build dir: {build_target_dir!r} already exists'
                     )
-                    Command.run(
-                        [
-                            'podman', 'pull', os.path.join(
-                                self.command_args['--from-registry'],
-                                stash_name
-                            )
-                        ]
+        Path.create(image_root_dir)
+
+        use_overlay = False
+        if self.command_args.get('--overlay'):
+            if self.deleted:
+                # overlayfs can't hide the paths of some lower dirs only
+                log.warning(
+                    'Stashes delete paths of lower stashes, '
+                    'using copy based sync'
+                )
+            elif StackOverlay.is_supported():
+                use_overlay = True
+            else:
+                log.warning(
+                    'overlayfs not supported, using copy based sync'
+                )
+
+        if use_overlay:
+            self._overlay_stashes(image_root_dir)
+        else:
+            self._sync_stashes(image_root_dir, resume)
+            if self.batch:
+                self._run_batch(self.batch, image_root_dir)
+            else:
+                self._run_kiwi_task(image_root_dir)
+
+    def _run_batch(self, batch: 'StackBatch', image_root_dir: str) -> None:
+        from kiwi.utils.output import DataOutput
+        # the assembled root is kept as the source of all build clones
+        log.info(
+            'Running {0} batch builds with {1} jobs'.format(
+                len(batch.builds), self.jobs
+            )
+        )
+        result = batch.run(
+            image_root_dir, self.command_args['--target-dir'], self.jobs,
+            self.metrics
+        )
+        DataOutput(result).display()
+        failed = [
+            name for name, build in result.items()
+            if build['status'] != 'ok'
+        ]
+        if failed:
+            raise KiwiStackBuildPluginBatchBuildFailed(
+                f'Batch build(s) failed: {failed}'
+            )
+
+    def _overlay_stashes(self, image_root_dir: str) -> None:
+        # all stashes stay mounted as overlay lower dirs
+        # until the kiwi build/create task is done
+        from kiwi_stackbuild_plugin.overlay import StackOverlay
+        try:
+            stash_mount_points = self._mount_stashes()
+            overlay = StackOverlay(
+                stash_mount_points, image_root_dir, os.path.join(
+                    self.command_args['--target-dir'], 'build', 'overlay'
+                )
+            )
+            log.info(
+                'Overlay mounting stash roots {0!r} to image root {1!r}'.format(
+                    stash_mount_points, image_root_dir
+                )
+            )
+            with overlay:
+                with self.metrics.phase('overlay_mount'):
+                    overlay.mount()
+                self._run_kiwi_task(image_root_dir)
+        finally:
+            self._umount_stashes()
+
+    def _sync_stashes(self, image_root_dir: str, resume: bool = False) -> None:
+        # an image root assembled from the same stash stack
+        # before is copied from the root cache
+        from kiwi_stackbuild_plugin.root_cache import StackRootCache
+        if resume and self._start_checkpoint() == len(
+            self.command_args['--stash']
+        ):
+            log.info('All stashes applied to image root, sync skipped')
+            return
+        root_cache = StackRootCache(StackBuildDefaults.get_stash_home())
+        root_cache_key = self._get_root_cache_key()
+        if root_cache_key and not resume:
+            try:
+                with self.metrics.phase('root_cache'):
+                    cache_hit = root_cache.materialize(
+                        root_cache_key, image_root_dir
                     )
-                try:
-                    log.info(f'Mounting stash: {stash_name!r}')
-                    stash_mount_point = Command.run(
-                        ['podman', 'image', 'mount', stash_name]
-                    ).output.strip()
-                    root = DataSync(
-                        stash_mount_point + os.sep, image_root_dir
+            except Exception as issue:
+                raise KiwiStackBuildPluginRootSyncFailed(issue)
+            if cache_hit:
+                self.metrics.count_tree(image_root_dir)
+                self._touch_stashes()
+                self._start_checkpoint()
+                self.checkpoint.set_complete()
+                return
+        if self.command_args.get('--from-archive'):
+            self._unpack_stashes(image_root_dir)
+        else:
+            self._sync_mounted_stashes(image_root_dir)
+        if root_cache_key:
+            with self.metrics.phase('root_cache_add'):
+                root_cache.add_root(root_cache_key, image_root_dir)
+
+    def _sync_mounted_stashes(self, image_root_dir: str) -> None:
+        # all stashes are mounted first such that every path
+        # is synced only once from the stash providing it last
+        from kiwi_stackbuild_plugin.merge import StackMerge
+        try:
+            stash_mount_points = self._mount_stashes()
+            self._start_checkpoint()
+            if len(stash_mount_points) == 1 and not self.path_filter:
+                self._sync_stash(stash_mount_points[0], image_root_dir)
+                self.checkpoint.set_applied(0)
+            else:
+                log.info(
+                    'Merging stash roots {0!r} to image root {1!r}'.format(
+                        stash_mount_points, image_root_dir
                     )
+                )
+                deleted = {
+                    stash_mount_point: self.deleted[stash_name]
+                    for stash_name, stash_mount_point in zip(
+                        self.command_args['--stash'], stash_mount_points
+                    ) if stash_name in self.deleted
+                }
+                StackMerge(
+                    stash_mount_points, self.path_filter, self.sync_jobs,
+                    self.link_groups, deleted
+                ).sync_data(image_root_dir, self.metrics, self.checkpoint)
+        except Exception as issue:
+            raise KiwiStackBuildPluginRootSyncFailed(issue)
+        finally:
+            self._umount_stashes()
+
+    def _unpack_stashes(self, image_root_dir: str) -> None:
+        # the layers of all stashes are unpacked in stack order
+        # from the stash archives, nothing is mounted
+        from kiwi_stackbuild_plugin.archive import StashArchive
+        from kiwi_stackbuild_plugin.unpack import StashUnpacker
+        try:
+            self._lock_stashes()
+            self._start_checkpoint()
+            for index, stash_name in enumerate(self.command_args['--stash']):
+                if self.checkpoint.is_applied(index):
+                    log.info(f'Stash {stash_name!r} already applied, skipped')
+                    continue
+                archive_file = self._get_stash_archive(stash_name)
+                if stash_name in self.deleted:
                     log.info(
-                        'Syncing stash root {0!r} to image root {1!r}'.format(
-                            stash_mount_point, image_root_dir
+                        'Removing paths deleted by stash {0!r}'.format(
+                            stash_name
                         )
                     )
-                    root.sync_data(
-                        options=Defaults.get_sync_options()
+                    StashUnpacker.remove_paths(
+                        image_root_dir, self.deleted[stash_name]
                     )
-                except Exception as issue:
-                    raise KiwiStackBuildPluginRootSyncFailed(issue)
-                finally:
-                    log.info(f'Umount stash: {stash_name!r}')
-                    Command.run(
-                        ['podman', 'image', 'umount', '--force', stash_name],
-                        raise_on_error=False
+                log.info(
+                    'Unpacking stash archive {0!r} to image root {1!r}'.format(
+                        archive_file, image_root_dir
                     )
-
-            if self.command_args.get('--description'):
-                with patch.object(
-                    sys, 'argv', self._validate_kiwi_build_command(
-                        [
-                            'system', 'build',
-                            '--description', self.command_args['--description'],
-                            '--target-dir', self.command_args['--target-dir'],
-                            '--allow-existing-root'
-                        ]
-                    )
-                ):
-                    kiwi_task = SystemBuildTask(
-                        should_perform_task_setup=False
-                    )
-            else:
-                with patch.object(
-                    sys, 'argv', self._validate_kiwi_create_command(
-                        [
-                            'system', 'create',
-                            '--root', image_root_dir,
-                            '--target-dir', self.command_args['--target-dir']
-                        ]
-                    )
-                ):
-                    kiwi_task = SystemCreateTask(
-                        should_perform_task_setup=False
+                )
+                with self.metrics.phase('unpack', stash=stash_name):
+                    stats = StashUnpacker(
+                        StashArchive(archive_file), self.path_filter,
+                        bool(self.command_args.get('--punch-holes'))
+                    ).unpack(image_root_dir)
+                log.info(
+                    '--> {0} files unpacked, {1} whiteouts applied'.format(
+                        stats['files'], stats['whiteouts']
                     )
+                )
+                self.metrics.add('synced_files', stats['files'])
+                self.metrics.add('synced_bytes', stats['bytes'])
+                self.metrics.add_saved(stats)
+                self.checkpoint.set_applied(index)
+            self._touch_stashes()
+        except Exception as issue:
+            raise KiwiStackBuildPluginRootSyncFailed(issue)
+        finally:
+            self._unlock_stashes()
 
-            kiwi_task.process()
-
-    def _validate_kiwi_create_command(
-        self, kiwi_create_command: List[str]
-    ) -> List[str]:
-        # construct create command from given command line
-        kiwi_create_command += self.command_args.get(
-            '<kiwi_create_command_args>'
+    def _get_stash_archive(self, stash_name: str) -> str:
+        archive_file = os.path.join(
+            StackBuildDefaults.get_stash_home(), stash_name,
+            f'{stash_name}.tar'
         )
-        if '--' in kiwi_create_command:
-            kiwi_create_command.remove('--')
-        # validate create command through docopt from the original
-        # kiwi.tasks.system_create docopt information
-        log.debug(
-            'Validating kiwi_create_command_args:{0}    {1}'.format(
-                os.linesep, kiwi_create_command
+        if not os.path.isfile(archive_file):
+            raise KiwiStackBuildPluginStashNotFoundError(
+                f'Stash archive {archive_file!r} not found'
             )
+        return archive_file
+
+    def _get_root_cache_key(self) -> Optional[str]:
+        # the stashes are identified by their archive, their blob
+        # store root or their image id in the local containers storage
+        if not self.command_args.get('--root-cache'):
+            return None
+        if self.command_args['--from-registry']:
+            log.warning('--root-cache is not used with --from-registry')
+            return None
+        digests = []
+        for stash_name in self.command_args['--stash']:
+            digest = self._get_stash_digest(stash_name)
+            if not digest:
+                log.warning(
+                    f'Stash {stash_name!r} not found, root cache not used'
+                )
+                return None
+            digests.append(digest)
+        # a filtered root differs from the full root of the stashes
+        from kiwi_stackbuild_plugin.root_cache import StackRootCache
+        # the deleted paths are not part of the stash digests
+        deleted_key_data = [
+            f'deleted:{stash_name}:{path}'
+            for stash_name, paths in self.deleted.items() for path in paths
+        ]
+        return StackRootCache.get_key(
+            digests + self.path_filter.get_key_data() + deleted_key_data
         )
-        validated_create_command = docopt(
-            kiwi.tasks.system_create.__doc__,
-            argv=kiwi_create_command
+
+    def _get_deleted_paths(self) -> Dict[str, List[str]]:
+        # the paths deleted by the stashes are recorded in the
+        # stash home, stashes from a registry don't have them
+        from kiwi_stackbuild_plugin.deletions import StashDeletions
+        deleted = {}
+        if not self.command_args.get('--from-registry'):
+            for stash_name in self.command_args['--stash']:
+                paths = StashDeletions(
+                    StackBuildDefaults.get_stash_home(), stash_name
+                ).get()
+                if paths:
+                    deleted[stash_name] = paths
+        return deleted
+
+    def _get_stash_digest(self, stash_name: str) -> Optional[str]:
+        from kiwi_stackbuild_plugin.archive import StashArchive
+        from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+        if self.command_args.get('--from-archive'):
+            return StashArchive(
+                self._get_stash_archive(stash_name)
+            ).get_digest()
+        digest = StashBlobStore(
+            StackBuildDefaults.get_stash_home()
+        ).get_digest(stash_name)
+        if digest:
+            return digest
+        return self._get_image_id(stash_name)
+
+    @staticmethod
+    def _get_image_id(image_ref: str) -> Optional[str]:
+        image_info = Command.run(
+            [
+                'podman', 'image', 'inspect',
+                '--format', '{{.Id}}', image_ref
+            ], raise_on_error=False
         )
-        # rebuild kiwi create command from validated docopt parser result
-        return self._rebuild_kiwi_command(
-            validated_create_command, 'create'
+        if image_info.returncode != 0:
+            return None
+        return image_info.output.strip()
+
+    def _start_checkpoint(self) -> int:
+        # the digests of pulled stashes are known once they are mounted
+        return self.checkpoint.start(
+            [
+                (stash_name, self._get_stash_digest(stash_name))
+                for stash_name in self.command_args['--stash']
+            ], self.path_filter.get_key_data()
         )
 
-    def _validate_kiwi_build_command(
-        self, kiwi_build_command: List[str]
-    ) -> List[str]:
-        # construct build command from given command line
-        kiwi_build_command += self.command_args.get(
-            '<kiwi_build_command_args>'
+    def _mount_stashes(self) -> List[str]:
+        # registry pulls run concurrently, each stash is mounted
+        # as soon as its pull has finished. The mount points are
+        # returned in stack order
+        from concurrent.futures import ThreadPoolExecutor
+        stashes = self.command_args['--stash']
+        if not self.command_args['--from-registry']:
+            self._lock_stashes()
+        if self.command_args['--from-registry'] and len(stashes) > 1:
+            with ThreadPoolExecutor(max_workers=self.pull_jobs) as pool:
+                stash_mount_points = list(
+                    pool.map(self._get_stash_mount, stashes)
+                )
+        else:
+            stash_mount_points = [
+                self._get_stash_mount(stash_name) for stash_name in stashes
+            ]
+        self._touch_stashes()
+        return stash_mount_points
+
+    def _touch_stashes(self) -> None:
+        from kiwi_stackbuild_plugin.index import StashIndex
+        stash_index = StashIndex(StackBuildDefaults.get_stash_home())
+        for stash_name in self.command_args['--stash']:
+            stash_index.touch(stash_name)
+
+    def _umount_stashes(self) -> None:
+        if self.mount_pool:
+            for stash_key in self.shared_stashes:
+                self.mount_pool.release(stash_key)
+            self.shared_stashes = []
+        else:
+            for stash_name in self.command_args['--stash']:
+                self._umount_stash(stash_name)
+        self._unlock_stashes()
+
+    def _get_stash_mount(self, stash_name: str) -> str:
+        # the jobs of a stackbuild server share the stash mounts,
+        # the stash is umounted when the last job released it
+        if not self.mount_pool:
+            return self._mount_stash(stash_name)
+        stash_root = self._get_blob_store_root(stash_name)
+        if stash_root:
+            return stash_root
+        # a mount is only shared for the same image of the same
+        # source, the image is mounted by its id such that a later
+        # pull or stash of the same name doesn't change the mount
+        image_ref = self._pull_stash(stash_name)
+        image_id = self._get_image_id(image_ref) or image_ref
+        stash_key = (
+            stash_name, self.command_args['--from-registry'] or '', image_id
         )
-        if '--' in kiwi_build_command:
-            kiwi_build_command.remove('--')
-        # validate build command through docopt from the original
-        # kiwi.tasks.system_build docopt information
-        log.debug(
-            'Validating kiwi_build_command_args:{0}    {1}'.format(
-                os.linesep, kiwi_build_command
-            )
+        stash_mount_point = self.mount_pool.acquire(
+            stash_key, partial(self._mount_image, stash_name, image_id),
+            partial(self._umount_stash, stash_name, image_id)
         )
-        validated_build_command = docopt(
-            kiwi.tasks.system_build.__doc__,
-            argv=kiwi_build_command
+        self.shared_stashes.append(stash_key)
+        return stash_mount_point
+
+    def _lock_stashes(self) -> None:
+        # protect the local stashes from eviction while in use
+        from kiwi_stackbuild_plugin.lock import StashLock
+        for stash_name in self.command_args['--stash']:
+            stash_lock = StashLock(
+                StackBuildDefaults.get_stash_home(), stash_name
+            )
+            if stash_lock.acquire():
+                self.stash_locks.append(stash_lock)
+            else:
+                log.warning(
+                    f'Stash {stash_name!r} not found in stash home, '
+                    'it is not locked against eviction'
+                )
+
+    def _unlock_stashes(self) -> None:
+        for stash_lock in self.stash_locks:
+            stash_lock.release()
+        self.stash_locks = []
+
+    def _get_jobs_count(self, option: str, default: int) -> int:
+        value = self.command_args.get(option)
+        if not value:
+            return default
+        if not value.isdigit() or int(value) < 1:
+            raise KiwiStackBuildPluginInvalidArgument(
+                f'{option} expects a positive number, got: {value!r}'
+            )
+        return int(value)
+
+    def _mount_stash(self, stash_name: str) -> str:
+        stash_root = self._get_blob_store_root(stash_name)
+        if stash_root:
+            return stash_root
+        self._pull_stash(stash_name)
+        return self._mount_image(stash_name, stash_name)
+
+    def _get_blob_store_root(self, stash_name: str) -> Optional[str]:
+        from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+        if self.command_args['--from-registry']:
+            return None
+        blob_store = StashBlobStore(StackBuildDefaults.get_stash_home())
+        stash_root = blob_store.get_root(stash_name)
+        if stash_root:
+            log.info(
+                f'Using stash {stash_name!r} from blob store: {stash_root!r}'
+            )
+            self.blob_store_stashes.append(stash_name)
+            # identical files share a blob inode in the stash
+            # root, only the recorded link groups are hardlinks
+            self.link_groups[stash_root] = \
+                blob_store.get_link_groups(stash_name) or {}
+        return stash_root
+
+    def _pull_stash(self, stash_name: str) -> str:
+        if not self.command_args['--from-registry']:
+            return stash_name
+        log.info(
+            'Fetching stash {0!r} from registry {1!r}'.format(
+                stash_name,
+                self.command_args['--from-registry']
+            )
         )
-        # rebuild kiwi build command from validated docopt parser result
-        return self._rebuild_kiwi_command(
-            validated_build_command, 'build'
+        image_ref = os.path.join(
+            self.command_args['--from-registry'], stash_name
         )
+        with self.metrics.phase('pull', stash=stash_name):
+            Command.run(['podman', 'pull', image_ref])
+        return image_ref
 
-    def _rebuild_kiwi_command(
-        self, validated_options_dict: Dict, command: str
-    ) -> List[str]:
-        kiwi_command = [
-            'system', command
-        ]
-        for option, value in validated_options_dict.items():
-            if option.startswith('-') and value:
-                if isinstance(value, bool):
-                    kiwi_command.append(option)
-                elif isinstance(value, str):
-                    kiwi_command.extend([option, value])
-                elif isinstance(value, list):
-                    for element in value:
-                        kiwi_command.extend([option, element])
-        final_kiwi_command = ['kiwi-ng']
-        if self.global_args.get('--type'):
-            final_kiwi_command.append('--type')
-            final_kiwi_command.append(self.global_args.get('--type'))
-        if self.global_args.get('--profile'):
-            for profile in sorted(set(self.global_args.get('--profile'))):
-                final_kiwi_command.append('--profile')
-                final_kiwi_command.append(profile)
-        final_kiwi_command += kiwi_command
-        log.debug(
-            'Building with:{0}    {1}'.format(
-                os.linesep, final_kiwi_command
+    def _mount_image(self, stash_name: str, image_ref: str) -> str:
+        log.info(f'Mounting stash: {stash_name!r}')
+        with self.metrics.phase('mount', stash=stash_name):
+            return Command.run(
+                ['podman', 'image', 'mount', image_ref]
+            ).output.strip()
+
+    def _umount_stash(
+        self, stash_name: str, image_ref: Optional[str] = None
+    ) -> None:
+        if stash_name in self.blob_store_stashes:
+            return
+        log.info(f'Umount stash: {stash_name!r}')
+        with self.metrics.phase('umount', stash=stash_name):
+            Command.run(
+                [
+                    'podman', 'image', 'umount', '--force',
+                    image_ref or stash_name
+                ], raise_on_error=False
+            )
+
+    def _sync_stash(
+        self, stash_mount_point: str, image_root_dir: str
+    ) -> None:
+        # on a filesystem supporting reflinks the stash files
+        # are cloned instead of copied
+        from kiwi.utils.sync import DataSync
+        from kiwi_stackbuild_plugin.parallel_copy import StackParallelCopy
+        from kiwi_stackbuild_plugin.reflink import StackReflink
+        link_groups = self.link_groups.get(stash_mount_point)
+        if StackReflink.is_supported(stash_mount_point, image_root_dir):
+            method = 'reflink'
+        elif self.sync_jobs or link_groups is not None:
+            # rsync would hardlink all files sharing a blob
+            method = 'copy'
+        else:
+            method = 'rsync'
+        log.info(
+            '{0} stash root {1!r} to image root {2!r}'.format(
+                'Cloning' if method == 'reflink' else 'Syncing',
+                stash_mount_point, image_root_dir
             )
         )
-        return final_kiwi_command
+        with self.metrics.phase(
+            'sync', stash_root=stash_mount_point, method=method
+        ):
+            if method == 'reflink':
+                StackReflink(stash_mount_point).clone(
+                    image_root_dir, link_groups=link_groups
+                )
+            elif method == 'copy':
+                self.metrics.add_saved(
+                    StackParallelCopy(
+                        stash_mount_point, self.sync_jobs or 1
+                    ).copy(image_root_dir, link_groups=link_groups)
+                )
+            else:
+                DataSync(
+                    stash_mount_point + os.sep, image_root_dir
+                ).sync_data(
+                    options=Defaults.get_sync_options()
+                )
+        self.metrics.count_tree(stash_mount_point)
+
+    def _run_kiwi_task(self, image_root_dir: str) -> None:
+        # the kiwi task is created in process from the validated
+        # arguments, sys.argv is not parsed again
+        from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+        if self.command_args.get('--description'):
+            command = 'build'
+            kiwi_command = [
+                '--description', self.command_args['--description'],
+                '--target-dir', self.command_args['--target-dir'],
+                '--allow-existing-root'
+            ]
+        else:
+            command = 'create'
+            kiwi_command = [
+                '--root', image_root_dir,
+                '--target-dir', self.command_args['--target-dir']
+            ]
+        command_args = self._validate_kiwi_command(command, kiwi_command)
+        global_args = self._get_kiwi_global_args()
+        kiwi_task = StackKiwiTask(self).new(command, command_args, global_args)
+        if self.mount_pool:
+            # kiwi logging and state are process global, the kiwi
+            # task of a stackbuild server job runs in a process
+            # forked from the server with its own log file
+            log_file = os.path.join(
+                self.command_args['--target-dir'], 'build.log'
+            )
+            log.info(f'Running kiwi system {command}, logging to {log_file!r}')
+            with self.metrics.phase(f'kiwi_{command}'):
+                StackKiwiTask.process_forked(kiwi_task, log_file)
+            return
+        with self.metrics.phase(f'kiwi_{command}'):
+            kiwi_task.process()
+
+    def _validate_kiwi_command(
+        self, command: str, kiwi_command: List[str]
+    ) -> Dict:
+        # construct the command from the given command line and
+        # validate it against the original kiwi task docopt usage
+        from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+        kiwi_command += [
+            arg for arg in self.command_args.get(
+                f'<kiwi_{command}_command_args>'
+            ) or [] if arg != '--'
+        ]
+        return StackKiwiTask.validate(command, kiwi_command)
+
+    def _get_kiwi_global_args(self) -> Dict:
+        global_args = dict(self.global_args)
+        if global_args.get('--profile'):
+            global_args['--profile'] = sorted(set(global_args['--profile']))
+        log.debug(f'Building with global args: {global_args}')
+        return global_args
@@ -20,7 +20,20 @@ usage: kiwi-ng system stash -h | --help
        kiwi-ng system stash --root=<directory>
            [--tag=<name>]
            [--container-name=<name>]
+           [--blob-store]
+           [--incremental]
+           [--base=<name>...]
+           [--archive|--no-archive]
+           [--compression=<format>]
+           [--compression-threads=<number>]
+           [--exclude=<pattern>...]
+           [--metrics-file=<path>]
        kiwi-ng system stash --list
+       kiwi-ng system stash --verify
+           [--container-name=<name>]
+           [--jobs=<number>]
+       kiwi-ng system stash --gc --max-size=<bytes>
+           [--keep=<number>]
        kiwi-ng system stash help
 
 commands:
@@ -37,29 +50,112 @@ options:
         the tag name for the container. By default set to 'latest'
     --container-name=<name>
         The name of the container. By default
-        set to the image name of the stash
+        set to the image name of the stash. Together with --verify
+        only the stash of this name is verified
+    --blob-store
+        store the root tree in the content addressed blob store
+        of the stash home instead of committing the stash container
+        to the local containers storage. Files identical across
+        stashes are kept only once. No stash container is built
+        unless --archive is given
+    --incremental
+        keep a manifest of the stashed root tree along with the
+        stash. When adding a new layer to an existing stash, only
+        the paths which differ from the manifest of the previous
+        layer are synced into the new layer. The manifest also
+        caches the file checksums for the next stash call
+    --base=<name>...
+        name of a stash the root directory was built on. Paths of
+        the base stashes which are missing in the root directory
+        are recorded as deleted by the stash. When the stashes are
+        stacked by stackbuild, the deleted paths are removed from
+        the stashes below the stash. The base stashes must have
+        been created with --incremental or --blob-store
+    --archive
+        together with --blob-store, also build the stash container
+        and export it as OCI archive file into the stash home, as
+        needed by stackbuild --from-archive. Without --blob-store
+        the archive is exported by default
+    --no-archive
+        do not export the stash container as OCI archive file into
+        the stash home. The stash is only kept in the local
+        containers storage
+    --compression=<format>
+        layer compression of the stash archive, one of none, gzip,
+        zstd or zstd:chunked. By default set to gzip. Stashes kept
+        only in the local containers storage are not compressed
+    --compression-threads=<number>
+        number of threads used to compress the stash archive layers.
+        By default all available CPUs are used
+    --exclude=<pattern>...
+        skip the paths of the root directory matching one of the
+        given shell style patterns relative to the root directory,
+        e.g. usr/share/doc, in addition to the default excludes
+        for dev, proc and sys
+    --metrics-file=<path>
+        write a JSON report with the time spent in every step,
+        the number of files and bytes synced and the peak memory
+        usage to the given file
     --list
-        list the available stashes
+        list the available stashes with their tags, layer count,
+        compressed and uncompressed size, creation and last use
+        time and the name of the image description, as recorded
+        in the stash index. For stashes kept in the blob store the
+        logical and the deduplicated size is shown
+    --verify
+        check the integrity of the available stashes. The blobs of
+        the stash archive are hashed against their OCI digests, the
+        files of stashes kept in the blob store against their blob
+        keys. Exits with an error if any stash is corrupt
+    --jobs=<number>
+        number of concurrent hash jobs. By default set to the
+        number of available CPUs
+    --gc
+        evict the least recently used stashes, their stash directory,
+        blob store root and images in the local containers storage,
+        until the stashes use no more than the given maximum size.
+        Stashes in use by a running stackbuild are not evicted.
+        Cached stackbuild image roots are evicted first
+    --max-size=<bytes>
+        the size in bytes all stashes may use after --gc
+    --keep=<number>
+        number of most recently used stashes never evicted by --gc.
+        By default set to 0
 """
 import os
+import shutil
 import logging
 from textwrap import dedent
+from typing import (
+    TYPE_CHECKING, Any, Dict, List, Optional
+)
 
+# kiwi loads the modules of all task plugins on every call. Only
+# modules loaded by kiwi itself anyway are imported here, everything
+# else is imported by the code path using it, see test/unit/import_test.py
 from kiwi.help import Help
 from kiwi.tasks.base import CliTask
 from kiwi.privileges import Privileges
 from kiwi.xml_description import XMLDescription
 from kiwi.xml_state import XMLState
-from kiwi.oci_tools import OCI
-from kiwi.utils.output import DataOutput
+from kiwi.utils.temporary import Temporary
+from kiwi.defaults import Defaults
 from kiwi.command import Command
 from kiwi.path import Path
 
 from kiwi_stackbuild_plugin.defaults import StackBuildDefaults
 from kiwi_stackbuild_plugin.exceptions import (
-    KiwiStackBuildPluginContainerNameInvalid
+    KiwiStackBuildPluginContainerNameInvalid,
+    KiwiStackBuildPluginInvalidArgument,
+    KiwiStackBuildPluginStashCorrupted,
+    KiwiStackBuildPluginStashNotFoundError
 )
 
+if TYPE_CHECKING:  # pragma: no cover
+    from kiwi.oci_tools.base import OCIBase
+    from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+    from kiwi_stackbuild_plugin.manifest import StashManifest
+
 log = logging.getLogger('kiwi')
 
 
@@ -70,19 +166,67 @@ class SystemStashTask(CliTask):
             return self.manual.show('kiwi::system::stash')
 
         if self.command_args.get('--list') is True:
+            from kiwi.utils.output import DataOutput
+            from kiwi_stackbuild_plugin.index import StashIndex
             stash_dir = StackBuildDefaults.get_stash_home()
+            # the stash index holds the sizes of the blob store
+            # stashes as well, nothing else is read
+            stash_index = StashIndex(stash_dir).get_stashes()
+            stash_list = {}
+            if os.path.isdir(stash_dir):
+                for stash_name in sorted(os.listdir(stash_dir)):
+                    if not stash_name.startswith('.'):
+                        stash_list[stash_name] = stash_index.get(
+                            stash_name, {}
+                        )
             stashes = DataOutput(
                 {
-                    stash_dir: os.listdir(
-                        stash_dir
-                    ) if os.path.isdir(stash_dir) else []
+                    stash_dir: stash_list
                 }
             )
             stashes.display()
             return
 
+        if self.command_args.get('--verify') is True:
+            return self._verify_stashes()
+
+        if self.command_args.get('--gc') is True:
+            return self._collect_stashes()
+
+        from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+        self.metrics = StackBuildMetrics(
+            'stash', count_io=bool(self.command_args.get('--metrics-file'))
+        )
+        try:
+            self._create_stash()
+        finally:
+            if self.command_args.get('--metrics-file'):
+                self.metrics.write(self.command_args['--metrics-file'])
+
+    def _create_stash(self) -> None:
+        from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+        from kiwi_stackbuild_plugin.deletions import StashDeletions
+        from kiwi_stackbuild_plugin.index import StashIndex
+        from kiwi_stackbuild_plugin.manifest import StashManifest
+        from kiwi_stackbuild_plugin.path_filter import StashPathFilter
         Privileges.check_for_root_permissions()
 
+        compression = self.command_args.get('--compression') or \
+            StackBuildDefaults.get_stash_compression()
+        if compression not in StackBuildDefaults.get_stash_compressions():
+            raise KiwiStackBuildPluginInvalidArgument(
+                '--compression expects one of {0}, got: {1!r}'.format(
+                    StackBuildDefaults.get_stash_compressions(), compression
+                )
+            )
+        compression_threads = self._get_jobs_count('--compression-threads')
+        base_manifests = self._load_base_manifests()
+        user_filter = StashPathFilter(
+            exclude_list=self.command_args.get('--exclude') or []
+        )
+        exclude_list = StackBuildDefaults.get_stash_exclude_list() + \
+            user_filter.exclude_list
+
         log.info('Reading Image description')
         kiwi_description = os.path.join(
             self.command_args['--root'], 'image', 'config.xml'
@@ -126,36 +270,469 @@ class SystemStashTask(CliTask):
         container_config = StackBuildDefaults.get_container_config(
             image_name, stash_container_tag, contact_info.author
         )
+        stash_image_ref = f'localhost/{image_name}:{stash_container_tag}'
+        stash_manifest_file_name = os.path.join(
+            stash_target_dir, f'{image_name}.manifest'
+        )
+        # a stash kept in the blob store is used from there, its
+        # stash container is only built if an archive is requested
+        build_container = not self.command_args.get('--blob-store') or \
+            self.command_args.get('--archive')
+        # a stash committed to the local containers storage is used
+        # as base for the new layer, the stash archive otherwise
+        base_image_ref = None
+        base_layer_id = ''
+        if build_container:
+            base_layer_id = SystemStashTask._get_image_id(stash_image_ref)
+            if base_layer_id:
+                base_image_ref = f'containers-storage:{stash_image_ref}'
+            elif os.path.isfile(stash_container_file_name):
+                base_image_ref = 'oci-archive:{0}:{1}:{2}'.format(
+                    stash_container_file_name, image_name,
+                    stash_container_tag
+                )
+                base_layer_id = SystemStashTask._get_archive_id(
+                    stash_container_file_name
+                )
+        manifest = None
+        previous_manifest = None
+        if self.command_args.get('--incremental') or \
+                self.command_args.get('--blob-store') or base_manifests:
+            log.info('Creating root tree manifest')
+            with self.metrics.phase('manifest'):
+                cached_manifest = StashManifest.load(
+                    stash_manifest_file_name
+                )
+                manifest = StashManifest.from_root(
+                    self.command_args['--root'], exclude_list,
+                    cached_manifest
+                )
+            # the manifest describes the previous layer only if the
+            # base stash was not changed since the manifest was saved
+            if self.command_args.get('--incremental') and cached_manifest \
+                    and base_image_ref and \
+                    cached_manifest.meta.get('layer') == base_layer_id:
+                previous_manifest = cached_manifest
+        if build_container:
+            oci = self._create_stash_container(
+                base_image_ref, manifest, previous_manifest, exclude_list,
+                container_config
+            )
+        if not build_container or self.command_args.get('--no-archive'):
+            # an outdated stash archive must not be used
+            # by stackbuild --from-archive
+            Path.wipe(stash_container_file_name)
+        else:
+            log.info(
+                f'Exporting stash container, {compression} compressed'
+            )
+            with self.metrics.phase('export', compression=compression):
+                SystemStashTask._export_stash_archive(
+                    oci, stash_container_file_name,
+                    f'{image_name}:{stash_container_tag}',
+                    compression, compression_threads
+                )
+        blob_store = StashBlobStore(StackBuildDefaults.get_stash_home())
+        if self.command_args.get('--blob-store'):
+            log.info('Adding stash root to blob store')
+            with self.metrics.phase('blob_store'):
+                stats = blob_store.add_root(
+                    image_name, self.command_args['--root'], exclude_list,
+                    manifest
+                )
+            self.metrics.add_saved(stats)
+            # an outdated stash in the containers storage
+            # must not take over as base for the next layer
+            Command.run(
+                ['podman', 'image', 'rm', stash_image_ref],
+                raise_on_error=False
+            )
+            layer_id = SystemStashTask._get_archive_id(
+                stash_container_file_name
+            )
+        else:
+            if blob_store.get_root(image_name):
+                log.info('Removing outdated stash root from blob store')
+                blob_store.remove_root(image_name)
+            log.info('Committing stash to local containers storage')
+            with self.metrics.phase('commit'):
+                Command.run(
+                    [
+                        'skopeo', 'copy',
+                        SystemStashTask._get_working_image_ref(oci),
+                        f'containers-storage:{stash_image_ref}'
+                    ]
+                )
+            layer_id = SystemStashTask._get_image_id(stash_image_ref)
+        if manifest:
+            manifest.meta['layer'] = layer_id
+            manifest.save(stash_manifest_file_name)
+        # the paths deleted from the base stashes are removed
+        # from the stashes below this one by stackbuild
+        deleted: List[str] = []
+        if manifest and base_manifests:
+            deleted = manifest.get_deleted(base_manifests, exclude_list)
+            log.info(
+                f'Recording {len(deleted)} paths deleted from base stashes'
+            )
+        StashDeletions(
+            StackBuildDefaults.get_stash_home(), image_name
+        ).set(deleted)
+        log.info('Updating stash index')
+        stash_data = self._get_stash_data(
+            stash_container_file_name, stash_image_ref, blob_store, image_name
+        )
+        stash_data['description'] = xml_state.xml_data.get_name()
+        if os.path.isfile(stash_container_file_name):
+            stash_data['compression'] = compression
+        StashIndex(StackBuildDefaults.get_stash_home()).add_stash(
+            image_name, stash_container_tag, stash_data
+        )
+
+    def _load_base_manifests(self) -> List['StashManifest']:
+        from kiwi_stackbuild_plugin.manifest import StashManifest
+        base_manifests = []
+        for base_name in self.command_args.get('--base') or []:
+            base_manifest = StashManifest.load(
+                os.path.join(
+                    StackBuildDefaults.get_stash_home(), base_name,
+                    f'{base_name}.manifest'
+                )
+            )
+            if not base_manifest:
+                raise KiwiStackBuildPluginStashNotFoundError(
+                    f'No manifest found for base stash {base_name!r}, '
+                    'base stashes must be created with '
+                    '--incremental or --blob-store'
+                )
+            base_manifests.append(base_manifest)
+        return base_manifests
+
+    def _create_stash_container(
+        self, base_image_ref: Optional[str],
+        manifest: Optional['StashManifest'],
+        previous_manifest: Optional['StashManifest'],
+        exclude_list: List[str], container_config: Dict
+    ) -> 'OCIBase':
+        from kiwi.oci_tools import OCI
         log.info('Initializing stash container')
         oci = OCI.new()
-        if os.path.isfile(stash_container_file_name):
+        if base_image_ref:
             log.info('--> Adding new layer on existing stash')
-            oci.import_container_image(
-                f'oci-archive:{stash_container_file_name}:'
-                f'{image_name}:{stash_container_tag}'
-            )
+            with self.metrics.phase('import'):
+                oci.import_container_image(base_image_ref)
         else:
             log.info('--> Creating initial layer')
-            oci.init_container()
-
-        oci.unpack()
-        oci.sync_rootfs(
-            self.command_args['--root'],
-            StackBuildDefaults.get_stash_exclude_list()
-        )
-        oci.repack(container_config)
-        oci.set_config(container_config)
-        oci.post_process()
-        log.info('Exporting stash container')
-        oci.export_container_image(
-            stash_container_file_name, 'oci-archive',
-            f'{image_name}:{stash_container_tag}'
-        )
-        log.info('Importing stash to local registry')
+            with self.metrics.phase('init'):
+                oci.init_container()
+
+        if manifest and previous_manifest and \
+                SystemStashTask._can_add_layer(oci):
+            # the layer of the changes is added to the stash
+            # as it is, the stash is not unpacked
+            log.info('--> Adding changes since previous layer')
+            changed, removed = manifest.diff(previous_manifest)
+            with self.metrics.phase('layer'):
+                SystemStashTask._add_changes_layer(
+                    oci, self.command_args['--root'], changed, removed,
+                    container_config
+                )
+            self.metrics.count_tree(self.command_args['--root'], changed)
+            with self.metrics.phase('repack'):
+                oci.set_config(container_config)
+                oci.post_process()
+        else:
+            with self.metrics.phase('unpack'):
+                oci.unpack()
+            if manifest and previous_manifest:
+                log.info('--> Syncing changes since previous layer')
+                changed, removed = manifest.diff(previous_manifest)
+                with self.metrics.phase('sync_rootfs'):
+                    SystemStashTask._sync_rootfs_changes(
+                        oci, self.command_args['--root'], changed, removed
+                    )
+                self.metrics.count_tree(
+                    self.command_args['--root'], changed
+                )
+            else:
+                with self.metrics.phase('sync_rootfs'):
+                    oci.sync_rootfs(
+                        self.command_args['--root'], exclude_list
+                    )
+                self.metrics.count_tree(self.command_args['--root'])
+            with self.metrics.phase('repack'):
+                SystemStashTask._repack(oci, container_config)
+                oci.set_config(container_config)
+                oci.post_process()
+        return oci
+
+    def _get_stash_data(
+        self, stash_container_file_name: str, stash_image_ref: str,
+        blob_store: 'StashBlobStore', image_name: str
+    ) -> Dict[str, Any]:
+        from kiwi_stackbuild_plugin.archive import StashArchive
+        stash_data: Dict[str, Any] = {
+            'layers': None,
+            'compressed_size': None,
+            'uncompressed_size': None
+        }
+        if os.path.isfile(stash_container_file_name):
+            layers = StashArchive(stash_container_file_name).get_layers()
+            stash_data['layers'] = len(layers)
+            stash_data['compressed_size'] = sum(
+                layer['size'] for layer in layers
+            )
+        image_info = Command.run(
+            [
+                'podman', 'image', 'inspect', '--format',
+                '{{.Size}} {{len .RootFS.Layers}}', stash_image_ref
+            ], raise_on_error=False
+        )
+        if image_info.returncode == 0:
+            size, layer_count = image_info.output.split()
+            stash_data['uncompressed_size'] = int(size)
+            stash_data['layers'] = int(layer_count)
+        elif self.command_args.get('--blob-store'):
+            stash_data['uncompressed_size'] = \
+                (blob_store.get_sizes(image_name) or {}).get('logical_size')
+        return stash_data
+
+    def _verify_stashes(self) -> None:
+        from kiwi.utils.output import DataOutput
+        from kiwi_stackbuild_plugin.archive import StashArchive
+        from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+        stash_dir = StackBuildDefaults.get_stash_home()
+        jobs = self._get_jobs_count('--jobs') or os.cpu_count() or 1
+        if self.command_args.get('--container-name'):
+            stash_names = [self.command_args['--container-name']]
+        elif os.path.isdir(stash_dir):
+            stash_names = [
+                stash_name for stash_name in sorted(os.listdir(stash_dir))
+                if not stash_name.startswith('.')
+            ]
+        else:
+            stash_names = []
+        blob_store = StashBlobStore(stash_dir)
+        result = {}
+        failed = []
+        for stash_name in stash_names:
+            log.info(f'Verifying stash: {stash_name!r}')
+            stash_result: Dict[str, Any] = {}
+            stash_container_file_name = os.path.join(
+                stash_dir, stash_name, f'{stash_name}.tar'
+            )
+            if os.path.isfile(stash_container_file_name):
+                stash_result['archive'] = StashArchive(
+                    stash_container_file_name
+                ).verify(jobs)
+            if blob_store.get_root(stash_name):
+                stash_result['blob_store'] = blob_store.verify_root(
+                    stash_name, jobs
+                )
+            if not os.path.isdir(os.path.join(stash_dir, stash_name)):
+                status = 'missing'
+            elif not stash_result:
+                # stashes kept only in the local containers
+                # storage provide no data to verify against
+                status = 'unverified'
+            elif any(stash_result.values()):
+                status = 'corrupt'
+            else:
+                status = 'ok'
+            stash_result['status'] = status
+            result[stash_name] = stash_result
+            if status in ('missing', 'corrupt'):
+                failed.append(stash_name)
+        DataOutput(result).display()
+        if failed:
+            raise KiwiStackBuildPluginStashCorrupted(
+                f'Verification failed for stash(es): {failed}'
+            )
+
+    def _collect_stashes(self) -> None:
+        from kiwi.utils.output import DataOutput
+        from kiwi_stackbuild_plugin.collect import StashCollector
+        for option in ('--max-size', '--keep'):
+            value = self.command_args.get(option) or '0'
+            if not value.isdigit():
+                raise KiwiStackBuildPluginInvalidArgument(
+                    f'{option} expects a number, got: {value!r}'
+                )
+        Privileges.check_for_root_permissions()
+        result = StashCollector(StackBuildDefaults.get_stash_home()).collect(
+            int(self.command_args['--max-size']),
+            int(self.command_args.get('--keep') or 0)
+        )
+        DataOutput(result).display()
+
+    def _get_jobs_count(self, option: str) -> Optional[int]:
+        value = self.command_args.get(option)
+        if not value:
+            return None
+        if not value.isdigit() or int(value) < 1:
+            raise KiwiStackBuildPluginInvalidArgument(
+                f'{option} expects a positive number, got: {value!r}'
+            )
+        return int(value)
+
+    @staticmethod
+    def _export_stash_archive(
+        oci: 'OCIBase', filename: str, image_ref: str, compression: str,
+        threads: Optional[int]
+    ) -> None:
+        # skopeo compresses the layers concurrently with
+        # as many threads as the go runtime may use. An OCI
+        # archive gets compressed layers unless uncompressed
+        # layers are accepted explicitly
+        if compression == 'none':
+            compression_options = ['--dest-oci-accept-uncompressed-layers']
+        else:
+            compression_options = [
+                '--dest-compress', '--dest-compress-format', compression
+            ]
+        custom_env = None
+        if threads:
+            custom_env = dict(os.environ, GOMAXPROCS=str(threads))
+        # skopeo doesn't support force overwrite
+        Path.wipe(filename)
+        Command.run(
+            ['skopeo', 'copy'] + compression_options + [
+                SystemStashTask._get_working_image_ref(oci),
+                f'oci-archive:{filename}:{image_ref}'
+            ], custom_env=custom_env
+        )
+
+    @staticmethod
+    def _get_image_id(image_ref: str) -> str:
+        image_info = Command.run(
+            ['podman', 'image', 'inspect', '--format', '{{.Id}}', image_ref],
+            raise_on_error=False
+        )
+        if image_info.returncode == 0:
+            return image_info.output.strip()
+        return ''
+
+    @staticmethod
+    def _get_archive_id(stash_container_file_name: str) -> str:
+        if not os.path.isfile(stash_container_file_name):
+            return ''
+        archive_stat = os.stat(stash_container_file_name)
+        return f'{archive_stat.st_size}:{archive_stat.st_mtime_ns}'
+
+    @staticmethod
+    def _get_working_image_ref(oci: 'OCIBase') -> str:
+        from kiwi.oci_tools.umoci import OCIUmoci
+        # umoci works on an OCI layout, buildah commits
+        # the working image into the containers storage
+        if isinstance(oci, OCIUmoci):
+            return f'oci:{oci.working_image}'
+        return f'containers-storage:{oci.working_image}'
+
+    @staticmethod
+    def _can_add_layer(oci: 'OCIBase') -> bool:
+        from kiwi.oci_tools.umoci import OCIUmoci
+        # umoci adds a layer tar to the OCI layout directly, buildah
+        # only mounts the root tree of the working container
+        return isinstance(oci, OCIUmoci)
+
+    @staticmethod
+    def _add_changes_layer(
+        oci: 'OCIBase', root_dir: str, changed: List[str], removed: List[str],
+        container_config: Dict
+    ) -> None:
+        from kiwi_stackbuild_plugin.layer import StashLayer
+        log.info(
+            '--> {0} changed and {1} removed paths'.format(
+                len(changed), len(removed)
+            )
+        )
+        with Temporary(prefix='kiwi_stash_layer.').new_file() as layer_file:
+            StashLayer(root_dir).create(layer_file.name, changed, removed)
+            history_flags = oci._process_oci_history_to_arguments(
+                container_config
+            )
+            history_flags.extend(['--history.created', oci.creation_date])
+            history_flags.extend(
+                SystemStashTask._get_umoci_compress_flags(oci)
+            )
+            Command.run(
+                ['umoci', 'raw', 'add-layer'] + history_flags + [
+                    '--image', oci.working_image, layer_file.name
+                ]
+            )
+
+    @staticmethod
+    def _repack(oci: 'OCIBase', container_config: Dict) -> None:
+        compress_flags = SystemStashTask._get_umoci_compress_flags(oci)
+        if not compress_flags:
+            oci.repack(container_config)
+            return
+        history_flags = oci._process_oci_history_to_arguments(
+            container_config
+        )
+        history_flags.extend(['--history.created', oci.creation_date])
         Command.run(
-            ['podman', 'load', '-i', stash_container_file_name]
+            ['umoci', 'repack'] + history_flags + compress_flags + [
+                '--image', oci.working_image, oci.oci_root_dir
+            ]
         )
 
+    @staticmethod
+    def _get_umoci_compress_flags(oci: 'OCIBase') -> List[str]:
+        from kiwi.oci_tools.umoci import OCIUmoci
+        from kiwi.utils.command_capabilities import CommandCapabilities
+        # umoci compresses new layers with a single threaded gzip
+        # by default, which the export compresses a second time.
+        # The layers are written uncompressed instead, such that
+        # the export compresses them once with all threads
+        if not isinstance(oci, OCIUmoci):
+            return []
+        if not CommandCapabilities.has_option_in_help(
+            'umoci', '--compress', ['repack', '--help'], raise_on_error=False
+        ):
+            return []
+        return ['--compress=none']
+
+    @staticmethod
+    def _sync_rootfs_changes(
+        oci: 'OCIBase', root_dir: str, changed: List[str], removed: List[str]
+    ) -> None:
+        from kiwi.utils.sync import DataSync
+        container_rootfs = SystemStashTask._get_container_rootfs(oci)
+        log.info(
+            '--> {0} changed and {1} removed paths'.format(
+                len(changed), len(removed)
+            )
+        )
+        for path in reversed(removed):
+            container_path = os.path.join(container_rootfs, path)
+            if os.path.isdir(container_path) and \
+                    not os.path.islink(container_path):
+                shutil.rmtree(container_path)
+            elif os.path.lexists(container_path):
+                os.unlink(container_path)
+        if changed:
+            with Temporary(prefix='kiwi_stash_changes.').new_file() as files:
+                files.write(b'\0'.join(os.fsencode(path) for path in changed))
+                files.flush()
+                DataSync(root_dir + os.sep, container_rootfs).sync_data(
+                    options=Defaults.get_sync_options() + [
+                        '--filter', '-x! user.*',
+                        '--filter', '-x! security.ima*',
+                        '--filter', '-x! security.capability*',
+                        '--from0', f'--files-from={files.name}'
+                    ]
+                )
+
+    @staticmethod
+    def _get_container_rootfs(oci: 'OCIBase') -> str:
+        from kiwi.oci_tools.umoci import OCIUmoci
+        # umoci unpacks into a runtime bundle holding the root tree
+        # in its rootfs directory, buildah mounts the root tree
+        if isinstance(oci, OCIUmoci):
+            return os.path.join(oci.oci_root_dir, 'rootfs')
+        return oci.oci_root_dir
+
     @staticmethod
     def _create_stash_target_dir(image_name: str) -> str:
         stash_target_dir = os.path.join(
@@ -0,0 +1,226 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import stat
+import errno
+import logging
+from typing import (
+    Dict, Iterator, List, Optional, Tuple
+)
+
+log = logging.getLogger('kiwi')
+
+# chunk size of the read/write fallback for copy_file_range
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class StackTree:
+    """
+    **Implements the tree operations shared by the stash copy engines**
+
+    Walking a stash root, grouping its hardlinks and copying file
+    data and metadata is the same for the reflink clone, the
+    parallel copy engine and the blob store. Metadata is copied
+    like rsync does with the kiwi sync options, file data is
+    copied in the kernel with copy_file_range and sparse files
+    stay sparse.
+    """
+    @staticmethod
+    def get_paths(source_dir: str) -> Iterator[str]:
+        """
+        Provides all paths of a root tree in parent first order
+
+        Like rsync with --one-file-system, mount points below
+        source_dir are listed but not descended into
+
+        :param str source_dir: root directory
+
+        :return: relative paths
+
+        :rtype: Iterator
+        """
+        root_device = os.lstat(source_dir).st_dev
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            rel_dir = os.path.relpath(dirpath, source_dir)
+            for dirname in dirnames[:]:
+                yield os.path.normpath(os.path.join(rel_dir, dirname))
+                if os.lstat(
+                    os.path.join(dirpath, dirname)
+                ).st_dev != root_device:
+                    dirnames.remove(dirname)
+            for filename in filenames:
+                yield os.path.normpath(os.path.join(rel_dir, filename))
+
+    @staticmethod
+    def get_link_group(
+        rel_path: str, source_stat: os.stat_result,
+        link_groups: Optional[Dict[str, str]]
+    ) -> Optional[object]:
+        """
+        Provides the hardlink group of a path
+
+        :param str rel_path: relative path
+        :param os.stat_result source_stat: lstat result of the path
+        :param dict link_groups:
+            relative path to link group mapping, see
+            StashBlobStore.get_link_groups. Paths sharing an
+            inode form a group if None
+
+        :return: link group or None if the path is not hardlinked
+
+        :rtype: object
+        """
+        if link_groups is not None:
+            return link_groups.get(rel_path)
+        if source_stat.st_nlink > 1:
+            return (source_stat.st_dev, source_stat.st_ino)
+        return None
+
+    @staticmethod
+    def get_xattrs(path: str) -> List[Tuple[str, bytes]]:
+        """
+        Provides the extended attributes of a path sorted by name
+
+        :param str path: path name, symlinks are not followed
+
+        :return: list of name and value tuples, empty if the
+            attributes can't be read
+
+        :rtype: list
+        """
+        try:
+            return [
+                (name, os.getxattr(path, name, follow_symlinks=False))
+                for name in sorted(os.listxattr(path, follow_symlinks=False))
+            ]
+        except OSError as issue:
+            log.debug(f'Reading extended attributes of {path} said: {issue}')
+            return []
+
+    @staticmethod
+    def copy_metadata(
+        source: str, target: str, source_stat: os.stat_result
+    ) -> None:
+        """
+        Copy owner, mode, times and extended attributes
+
+        The extended attributes include the POSIX ACLs, a failure
+        to set one of them is logged as warning
+
+        :param str source: source path name
+        :param str target: target path name
+        :param os.stat_result source_stat: lstat result of source
+        """
+        os.chown(
+            target, source_stat.st_uid, source_stat.st_gid,
+            follow_symlinks=False
+        )
+        if not stat.S_ISLNK(source_stat.st_mode):
+            os.chmod(target, stat.S_IMODE(source_stat.st_mode))
+            for name, value in StackTree.get_xattrs(source):
+                try:
+                    os.setxattr(target, name, value)
+                except OSError as issue:
+                    log.warning(
+                        f'Setting {name} on {target} failed with: {issue}'
+                    )
+        os.utime(
+            target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns),
+            follow_symlinks=False
+        )
+
+    @staticmethod
+    def copy_data(source: str, target: str, size: int) -> int:
+        """
+        Copy the data segments of a regular file into a new file
+
+        :param str source: source file name
+        :param str target: target file name, must not exist
+        :param int size: size of the source file
+
+        :return: bytes not copied because of holes
+
+        :rtype: int
+        """
+        holes = size
+        with open(source, 'rb') as source_file:
+            with open(target, 'xb') as target_file:
+                source_fd = source_file.fileno()
+                target_fd = target_file.fileno()
+                use_copy_file_range = True
+                for offset, count in StackTree._get_data_segments(
+                    source_fd, size
+                ):
+                    use_copy_file_range = StackTree._copy_range(
+                        source_fd, target_fd, offset, count,
+                        use_copy_file_range
+                    )
+                    holes -= count
+                # a hole at the end of the file has no data to copy
+                os.ftruncate(target_fd, size)
+        return holes
+
+    @staticmethod
+    def _get_data_segments(fd: int, size: int) -> Iterator[Tuple[int, int]]:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as issue:
+                if issue.errno == errno.ENXIO:
+                    # only a hole is left up to the end of the file
+                    return
+                # no hole detection support, the file is all data
+                yield offset, size - offset
+                return
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            yield start, end - start
+            offset = end
+
+    @staticmethod
+    def _copy_range(
+        source_fd: int, target_fd: int, offset: int, count: int,
+        use_copy_file_range: bool = True
+    ) -> bool:
+        # returns if copy_file_range can be used for the rest of
+        # the file, after a failure the file is read and written
+        while count > 0:
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(
+                        source_fd, target_fd, count, offset, offset
+                    )
+                except OSError as issue:
+                    # older kernels refuse to copy across filesystems
+                    log.debug(
+                        f'copy_file_range failed with: {issue}, '
+                        'using read/write for the file'
+                    )
+                    use_copy_file_range = False
+                    continue
+            else:
+                data = os.pread(
+                    source_fd, min(count, COPY_CHUNK_SIZE), offset
+                )
+                copied = os.pwrite(target_fd, data, offset)
+            if not copied:
+                # the source file was truncated while copying
+                break
+            offset += copied
+            count -= copied
+        return use_copy_file_range
@@ -0,0 +1,368 @@
+# Copyright (c) 2021 SUSE Linux GmbH.  All rights reserved.
+#
+# This file is part of kiwi-stackbuild.
+#
+# kiwi-stackbuild is free software: you can redistribute it and/or modify
+# it under the terms owf the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kiwi-stackbuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kiwi-stackbuild.  If not, see <http://www.gnu.org/licenses/>
+#
+import os
+import shutil
+import tarfile
+import logging
+from typing import (
+    Any, Dict, IO, List, Optional, Set, Tuple, cast
+)
+
+from kiwi_stackbuild_plugin.archive import StashArchive
+from kiwi_stackbuild_plugin.path_filter import StashPathFilter
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginUnpackFailed
+)
+
+log = logging.getLogger('kiwi')
+
+# OCI whiteout markers, see the OCI image layer specification
+WHITEOUT_PREFIX = '.wh.'
+WHITEOUT_OPAQUE = '.wh..wh..opq'
+
+# symlinks followed in a path before it is considered a loop
+MAX_SYMLINKS = 40
+
+# with hole punching blocks of zeros of regular files become holes
+SPARSE_BLOCK_SIZE = 4096
+READ_CHUNK_SIZE = 1024 * 1024
+
+# python versions with extraction filters warn if no filter is given,
+# the member paths are checked by the unpacker itself
+EXTRACT_OPTIONS: Dict[str, Any] = {
+    'filter': 'fully_trusted'
+} if hasattr(tarfile, 'data_filter') else {}
+
+
+class StashUnpacker:
+    """
+    **Implements unpacking of stash archive layers into a root tree**
+
+    The layers of a stash OCI archive are streamed from the
+    archive file and extracted in stack order, each in a single
+    pass, without loading the stash into the containers storage.
+    Files of a layer replace the files of the lower layers, OCI
+    whiteouts remove paths of the lower layers: a .wh.<name> entry
+    removes <name>, a .wh..wh..opq entry removes all content of
+    its directory not provided by the layer itself. Extended
+    attributes stored in the layer are applied to the files.
+    Symlinks of the lower layers are resolved inside of the root
+    tree like in a chroot, entries below a symlink are unpacked
+    to its target in the root tree. Hardlink entries are linked
+    to their target instead of written again. The holes of sparse file entries recorded in
+    the layer are kept. Layers written by the OCI tools store
+    sparse files in full, with hole punching enabled blocks of
+    zeros in regular files are skipped such that they become
+    holes. This also turns files allocated in full, like swap
+    files or preallocated databases, into sparse files. Layer
+    entries not selected by the optional path filter are
+    skipped, the layer stream itself is still read in full.
+
+    :param StashArchive archive: stash archive
+    :param StashPathFilter path_filter: include/exclude path filter
+    :param bool punch_holes: write blocks of zeros as holes
+    """
+    def __init__(
+        self, archive: StashArchive,
+        path_filter: Optional[StashPathFilter] = None,
+        punch_holes: bool = False
+    ) -> None:
+        self.archive = archive
+        self.path_filter = path_filter
+        self.punch_holes = punch_holes
+
+    def unpack(self, target_dir: str) -> Dict[str, int]:
+        """
+        Unpack all layers of the stash archive into target_dir
+
+        :param str target_dir: target root directory
+
+        :return: dict with the number of unpacked files, their
+            bytes, the number of applied whiteouts and the bytes
+            saved by hardlinks and by holes
+
+        :rtype: dict
+        """
+        stats = self._get_stats()
+        for layer in self.archive.get_layers():
+            log.info(f'--> Unpacking layer {layer["digest"]}')
+            with self.archive.open_layer(layer) as stream:
+                self.unpack_layer(stream, target_dir, stats)
+        return stats
+
+    def unpack_layer(
+        self, stream: IO[bytes], target_dir: str,
+        stats: Optional[Dict[str, int]] = None
+    ) -> None:
+        """
+        Unpack one uncompressed layer tar stream into target_dir
+
+        :param IO stream: layer tar stream
+        :param str target_dir: target root directory
+        :param dict stats: unpack counters to update
+        """
+        stats = stats if stats is not None else self._get_stats()
+        layer_paths: Set[str] = set()
+        directories: List[tarfile.TarInfo] = []
+        with tarfile.open(fileobj=stream, mode='r|') as layer:
+            for member in layer:
+                rel_path = self._get_rel_path(member.name)
+                if not rel_path:
+                    continue
+                rel_path = self._resolve_parent(target_dir, rel_path)
+                parent, name = os.path.split(rel_path)
+                if member.islnk():
+                    member.linkname = self._resolve_parent(
+                        target_dir, self._get_rel_path(member.linkname)
+                    )
+                if name == WHITEOUT_OPAQUE:
+                    self._remove_lower(target_dir, parent, layer_paths)
+                    stats['whiteouts'] += 1
+                    continue
+                if name.startswith(WHITEOUT_PREFIX):
+                    # a whiteout never removes entries of its own layer
+                    hidden = os.path.join(
+                        parent, name[len(WHITEOUT_PREFIX):]
+                    )
+                    if hidden in layer_paths:
+                        self._remove_lower(target_dir, hidden, layer_paths)
+                    else:
+                        self._remove(os.path.join(target_dir, hidden))
+                    stats['whiteouts'] += 1
+                    continue
+                if not self._is_selected(rel_path, member):
+                    continue
+                target = os.path.join(target_dir, rel_path)
+                # existing directories are merged, everything
+                # else is replaced by the layer entry
+                if os.path.lexists(target) and not (
+                    member.isdir() and self._is_dir(target)
+                ):
+                    self._remove(target)
+                member.name = rel_path
+                if member.isreg():
+                    stats['sparse_bytes'] += self._extract_file(
+                        layer, member, target, self.punch_holes
+                    )
+                else:
+                    layer.extract(
+                        member, target_dir, numeric_owner=True,
+                        **EXTRACT_OPTIONS
+                    )
+                if member.islnk():
+                    stats['hardlink_bytes'] += os.lstat(target).st_size
+                self._set_xattrs(target, member)
+                layer_paths.add(rel_path)
+                if member.isdir():
+                    directories.append(member)
+                else:
+                    stats['files'] += 1
+                    stats['bytes'] += member.size if member.isreg() else 0
+        # adding entries to a directory changes its modification
+        # time, the time from the layer is applied last
+        for member in reversed(directories):
+            os.utime(
+                os.path.join(target_dir, member.name),
+                (member.mtime, member.mtime)
+            )
+
+    @staticmethod
+    def remove_paths(target_dir: str, paths: List[str]) -> None:
+        """
+        Remove the given paths from target_dir
+
+        Symlinks in the parent directories of the paths are
+        resolved inside of target_dir like in a chroot
+
+        :param str target_dir: target root directory
+        :param list paths: paths relative to target_dir
+        """
+        for path in paths:
+            rel_path = StashUnpacker._get_rel_path(path)
+            if rel_path:
+                StashUnpacker._remove(
+                    os.path.join(
+                        target_dir,
+                        StashUnpacker._resolve_parent(target_dir, rel_path)
+                    )
+                )
+
+    @staticmethod
+    def _get_stats() -> Dict[str, int]:
+        return {
+            'files': 0, 'bytes': 0, 'whiteouts': 0,
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+
+    @staticmethod
+    def _extract_file(
+        layer: tarfile.TarFile, member: tarfile.TarInfo, target: str,
+        punch_holes: bool
+    ) -> int:
+        holes = 0
+        offset = 0
+        # extractfile provides a reader for every regular file
+        # member, the holes of a sparse member are read as zeros
+        source = cast(IO[bytes], layer.extractfile(member))
+        # the data segments of a sparse member as (offset, size) list
+        data_segments = cast(
+            List[Tuple[int, int]], member.sparse or [(0, member.size)]
+        )
+        # parent directory entries are optional in a layer
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'xb') as target_file:
+            for start, count in data_segments:
+                StashUnpacker._read(source, start - offset)
+                target_file.seek(start)
+                holes += start - offset + StashUnpacker._write(
+                    source, target_file, count, punch_holes
+                )
+                offset = start + count
+            holes += member.size - offset
+            # a hole at the end of the file needs the file size set
+            target_file.truncate(member.size)
+        layer.chown(member, target, True)
+        layer.chmod(member, target)
+        layer.utime(member, target)
+        return holes
+
+    @staticmethod
+    def _read(source: IO[bytes], count: int) -> None:
+        # the tar stream of a layer can only be read forward
+        while count > 0:
+            count -= len(source.read(min(count, READ_CHUNK_SIZE)))
+
+    @staticmethod
+    def _write(
+        source: IO[bytes], target_file: IO[bytes], count: int,
+        punch_holes: bool
+    ) -> int:
+        holes = 0
+        while count > 0:
+            chunk = source.read(min(count, READ_CHUNK_SIZE))
+            count -= len(chunk)
+            if not punch_holes:
+                target_file.write(chunk)
+                continue
+            for offset in range(0, len(chunk), SPARSE_BLOCK_SIZE):
+                block = chunk[offset:offset + SPARSE_BLOCK_SIZE]
+                if block.count(0) == len(block):
+                    target_file.seek(len(block), os.SEEK_CUR)
+                    holes += len(block)
+                else:
+                    target_file.write(block)
+        return holes
+
+    def _is_selected(self, rel_path: str, member: tarfile.TarInfo) -> bool:
+        if not self.path_filter:
+            return True
+        if not self.path_filter.is_selected(rel_path, member.isdir()):
+            return False
+        if member.islnk():
+            # the data of a hardlink is stored with its target
+            link_target = self._get_rel_path(member.linkname)
+            if not self.path_filter.is_selected(link_target, False):
+                log.debug(
+                    f'Skipping {rel_path}, hardlink target {link_target} '
+                    'is filtered'
+                )
+                return False
+        return True
+
+    def _remove_lower(
+        self, target_dir: str, rel_dir: str, layer_paths: Set[str]
+    ) -> None:
+        directory = os.path.join(target_dir, rel_dir)
+        if not self._is_dir(directory):
+            return
+        for name in os.listdir(directory):
+            rel_path = os.path.join(rel_dir, name)
+            if rel_path not in layer_paths:
+                self._remove(os.path.join(target_dir, rel_path))
+            else:
+                self._remove_lower(target_dir, rel_path, layer_paths)
+
+    @staticmethod
+    def _is_dir(path: str) -> bool:
+        return os.path.isdir(path) and not os.path.islink(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        if StashUnpacker._is_dir(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+    @staticmethod
+    def _get_rel_path(name: str) -> str:
+        rel_path = os.path.normpath(name.lstrip('/'))
+        if rel_path == os.curdir:
+            return ''
+        if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            raise KiwiStackBuildPluginUnpackFailed(
+                f'Layer member outside of the root tree: {name!r}'
+            )
+        return rel_path
+
+    @staticmethod
+    def _resolve_parent(target_dir: str, rel_path: str) -> str:
+        # symlinks of the lower layers are resolved like in a chroot
+        # of target_dir, absolute link targets and .. components
+        # stay inside of the root tree, e.g. lib -> /usr/lib
+        parent, name = os.path.split(rel_path)
+        resolved: List[str] = []
+        lookup = list(reversed(parent.split(os.sep)))
+        links = 0
+        while lookup:
+            component = lookup.pop()
+            if component in ('', os.curdir):
+                continue
+            if component == os.pardir:
+                if resolved:
+                    resolved.pop()
+                continue
+            path = os.path.join(target_dir, *resolved, component)
+            if not os.path.islink(path):
+                resolved.append(component)
+                continue
+            links += 1
+            if links > MAX_SYMLINKS:
+                raise KiwiStackBuildPluginUnpackFailed(
+                    f'Too many levels of symbolic links in {rel_path!r}'
+                )
+            link_target = os.readlink(path)
+            if os.path.isabs(link_target):
+                resolved = []
+            lookup.extend(reversed(link_target.split(os.sep)))
+        return os.path.join(*resolved, name)
+
+    @staticmethod
+    def _set_xattrs(target: str, member: tarfile.TarInfo) -> None:
+        if member.issym():
+            return
+        for key, value in member.pax_headers.items():
+            if key.startswith('SCHILY.xattr.'):
+                name = key[len('SCHILY.xattr.'):]
+                try:
+                    os.setxattr(
+                        target, name, value.encode('utf-8', 'surrogateescape')
+                    )
+                except OSError as issue:
+                    log.warning(
+                        f'Setting {name} on {target} failed with: {issue}'
+                    )
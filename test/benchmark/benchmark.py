@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+"""
+usage: benchmark.py [--scale=<factor>] [--seed=<number>]
+            [--work-dir=<directory>]
+            [--baseline=<file>|--save-baseline=<file>]
+            [--notes=<text>]
+
+Runs the system stash and system stackbuild code paths on synthetic
+root trees and reports the wall time of every phase and the sync
+throughput. podman, skopeo and the OCI tool are replaced by local
+fakes, the root tree syncs are real rsync calls. The import time of
+the task modules, which kiwi pays on every call, is measured in
+fresh python processes. Without rsync on the host only the import
+time is measured.
+
+A saved baseline records the host it was measured on: CPU, memory,
+kernel, filesystem of the work dir and rsync version, as timings
+are only comparable on the same kind of host.
+
+options:
+    --scale=<factor>
+        size factor of the synthetic root trees, defaults to 1
+    --seed=<number>
+        seed of the synthetic root tree content, defaults to 42
+    --work-dir=<directory>
+        directory to create the root trees and stashes in,
+        defaults to a temporary directory
+    --baseline=<file>
+        compare the results against the given baseline file,
+        defaults to baseline.json next to this script if one
+        was saved there
+    --save-baseline=<file>
+        store the results as baseline in the given file
+    --notes=<text>
+        free form notes about the host stored with the baseline,
+        e.g. other load on the machine
+"""
+import os
+import sys
+import json
+import time
+import random
+import subprocess
+import shutil
+import platform
+import tempfile
+from contextlib import ExitStack
+from typing import (
+    Any, Dict, List, Optional
+)
+from unittest.mock import patch
+
+import docopt
+
+from kiwi.defaults import Defaults
+from kiwi.oci_tools import OCI
+from kiwi.utils.sync import DataSync
+
+from kiwi_stackbuild_plugin.defaults import StackBuildDefaults
+from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+from kiwi_stackbuild_plugin.tasks.system_stash import SystemStashTask
+from kiwi_stackbuild_plugin.tasks.system_stackbuild import (
+    SystemStackbuildTask
+)
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+
+config_xml = os.path.join(
+    benchmark_dir, '..', 'data', 'image-root', 'image', 'config.xml'
+)
+
+# phases moving root tree data, used for the throughput
+sync_phases = ('sync_rootfs', 'sync', 'root_cache')
+
+# task modules imported by kiwi on every call
+task_modules = (
+    'kiwi_stackbuild_plugin.tasks.system_stash',
+    'kiwi_stackbuild_plugin.tasks.system_stackbuild'
+)
+
+import_time_code = '''
+import time
+import kiwi.cli
+import kiwi.tasks.base
+start_time = time.perf_counter()
+import {0}
+print(time.perf_counter() - start_time)
+'''
+
+
+class FakeOCI:
+    """
+    Stand-in for the OCI tool. The container root tree of a
+    stash is the directory <storage>/rootfs/<name> which the
+    fake podman reports as mount point of the stash image.
+    unpack and repack do not touch the data and are not
+    measured by this benchmark.
+    """
+    def __init__(self, storage_dir: str) -> None:
+        self.storage_dir = storage_dir
+        self.oci_root_dir = ''
+        self.working_image = ''
+
+    def init_container(self) -> None:
+        self.oci_root_dir = tempfile.mkdtemp(
+            prefix='work.', dir=self.storage_dir
+        )
+
+    def import_container_image(self, container_image_ref: str) -> None:
+        name = container_image_ref.split('/')[-1].split(':')[0]
+        self.oci_root_dir = os.path.join(self.storage_dir, 'rootfs', name)
+
+    def unpack(self) -> None:
+        pass
+
+    def sync_rootfs(
+        self, root_dir: str, exclude_list: Optional[List[str]] = None
+    ) -> None:
+        # same rsync call as kiwi's umoci based sync_rootfs
+        DataSync(root_dir + os.sep, self.oci_root_dir).sync_data(
+            options=Defaults.get_sync_options() + [
+                '--filter', '-x! user.*',
+                '--filter', '-x! security.ima*',
+                '--filter', '-x! security.capability*',
+                '--delete'
+            ],
+            exclude=exclude_list
+        )
+
+    def repack(self, oci_config: Dict) -> None:
+        name = oci_config['container_name']
+        rootfs = os.path.join(self.storage_dir, 'rootfs', name)
+        if self.oci_root_dir != rootfs:
+            shutil.rmtree(rootfs, ignore_errors=True)
+            os.makedirs(os.path.dirname(rootfs), exist_ok=True)
+            os.rename(self.oci_root_dir, rootfs)
+            self.oci_root_dir = rootfs
+        self.working_image = f'localhost/{name}'
+
+    def set_config(self, oci_config: Dict) -> None:
+        pass
+
+    def post_process(self) -> None:
+        pass
+
+
+def create_root_tree(root_dir: str, scale: float, seed: int) -> None:
+    """
+    Create a root tree looking like a real image: many small
+    files, some large blobs, hardlinks, symlinks and xattrs
+    """
+    generator = random.Random(seed)
+    os.makedirs(os.path.join(root_dir, 'image'))
+    shutil.copy(config_xml, os.path.join(root_dir, 'image', 'config.xml'))
+    small_files = []
+    for package in range(max(int(200 * scale), 1)):
+        package_dir = os.path.join(
+            root_dir, 'usr', 'share', 'doc', f'package-{package}'
+        )
+        os.makedirs(package_dir)
+        for number in range(25):
+            filename = os.path.join(package_dir, f'file-{number}')
+            _write_file(filename, generator.randbytes(
+                generator.randint(64, 8192)
+            ))
+            small_files.append(filename)
+    blob_dir = os.path.join(root_dir, 'usr', 'lib', 'blobs')
+    os.makedirs(blob_dir)
+    for number in range(4):
+        _write_file(
+            os.path.join(blob_dir, f'blob-{number}'),
+            generator.randbytes(int(8 * scale * 1024 * 1024))
+        )
+    link_dir = os.path.join(root_dir, 'usr', 'lib', 'links')
+    bin_dir = os.path.join(root_dir, 'usr', 'bin')
+    os.makedirs(link_dir)
+    os.makedirs(bin_dir)
+    for number, filename in enumerate(small_files[::20]):
+        os.link(filename, os.path.join(link_dir, f'link-{number}'))
+        os.symlink(
+            os.path.relpath(filename, bin_dir),
+            os.path.join(bin_dir, f'tool-{number}')
+        )
+    for filename in small_files[::10]:
+        try:
+            os.setxattr(filename, 'user.benchmark', b'synthetic')
+        except OSError:
+            # xattrs not supported by the work dir filesystem
+            break
+
+
+def modify_root_tree(root_dir: str, fraction: float, seed: int) -> int:
+    """
+    Rewrite the given fraction of the small files in the root tree
+
+    :return: number of modified files
+    """
+    generator = random.Random(seed)
+    doc_dir = os.path.join(root_dir, 'usr', 'share', 'doc')
+    small_files = sorted(
+        os.path.join(dirpath, filename)
+        for dirpath, dirnames, filenames in os.walk(doc_dir)
+        for filename in filenames
+    )
+    modified = generator.sample(
+        small_files, max(int(len(small_files) * fraction), 1)
+    )
+    for filename in modified:
+        _write_file(filename, generator.randbytes(
+            generator.randint(64, 8192)
+        ))
+    return len(modified)
+
+
+def run_task(task_class: Any, arguments: List[str], work_dir: str) -> Dict:
+    """
+    Run a kiwi task in process and collect its metrics report
+
+    :return: scenario result dict
+    """
+    metrics_file = os.path.join(work_dir, 'metrics.json')
+    with patch.object(
+        sys, 'argv', [sys.argv[0]] + arguments + [
+            '--metrics-file', metrics_file
+        ]
+    ):
+        task = task_class()
+    start_time = time.monotonic()
+    task.process()
+    wall_seconds = time.monotonic() - start_time
+    with open(metrics_file) as metrics:
+        report = json.load(metrics)
+    phases: Dict[str, float] = {}
+    for phase in report['phases']:
+        phases[phase['name']] = phases.get(phase['name'], 0) + \
+            phase['seconds']
+    synced_bytes = report['counters'].get('synced_bytes', 0)
+    sync_seconds = sum(
+        seconds for name, seconds in phases.items() if name in sync_phases
+    )
+    return {
+        'wall_seconds': round(wall_seconds, 6),
+        'phases': {
+            name: round(seconds, 6) for name, seconds in phases.items()
+        },
+        'synced_files': report['counters'].get('synced_files', 0),
+        'synced_bytes': synced_bytes,
+        'throughput_bytes_per_second': int(
+            synced_bytes / sync_seconds
+        ) if sync_seconds else 0
+    }
+
+
+def run_benchmark(work_dir: str, scale: float, seed: int) -> Dict:
+    """
+    Run all benchmark scenarios in the given work dir
+
+    :return: dict of scenario results
+    """
+    storage_dir = os.path.join(work_dir, 'storage')
+    stash_home = os.path.join(work_dir, 'stash-home')
+    root_a = os.path.join(work_dir, 'root-a')
+    root_b = os.path.join(work_dir, 'root-b')
+    os.makedirs(storage_dir)
+    create_root_tree(root_a, scale, seed)
+    create_root_tree(root_b, scale, seed + 1)
+    results = {}
+    with ExitStack() as stack:
+        stack.enter_context(patch.dict(os.environ, {
+            'KIWI_BENCHMARK_STORAGE': storage_dir,
+            'PATH': os.pathsep.join(
+                [os.path.join(benchmark_dir, 'fake-bin'), os.environ['PATH']]
+            )
+        }))
+        stack.enter_context(patch.object(
+            StackBuildDefaults, 'get_stash_home', return_value=stash_home
+        ))
+        stack.enter_context(patch.object(
+            OCI, 'new', side_effect=lambda: FakeOCI(storage_dir)
+        ))
+        stack.enter_context(patch(
+            'kiwi_stackbuild_plugin.tasks.system_stash.Privileges'
+        ))
+        stack.enter_context(patch(
+            'kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges'
+        ))
+        stack.enter_context(patch.object(StackKiwiTask, 'new'))
+        stash = ['system', 'stash', '--no-archive']
+        results['stash_initial'] = run_task(
+            SystemStashTask, stash + [
+                '--root', root_a, '--container-name', 'bench-a',
+                '--incremental'
+            ], work_dir
+        )
+        modify_root_tree(root_a, 0.01, seed)
+        results['stash_incremental'] = run_task(
+            SystemStashTask, stash + [
+                '--root', root_a, '--container-name', 'bench-a',
+                '--incremental'
+            ], work_dir
+        )
+        results['stash_blob_store'] = run_task(
+            SystemStashTask, stash + [
+                '--root', root_b, '--container-name', 'bench-b',
+                '--blob-store'
+            ], work_dir
+        )
+        results['stackbuild_single'] = run_task(
+            SystemStackbuildTask, [
+                'system', 'stackbuild', '--stash', 'bench-a',
+                '--target-dir', os.path.join(work_dir, 'target-single')
+            ], work_dir
+        )
+        results['stackbuild_parallel_copy'] = run_task(
+            SystemStackbuildTask, [
+                'system', 'stackbuild', '--stash', 'bench-a',
+                '--sync-jobs', str(os.cpu_count() or 1),
+                '--target-dir', os.path.join(work_dir, 'target-copy')
+            ], work_dir
+        )
+        results['stackbuild_merge'] = run_task(
+            SystemStackbuildTask, [
+                'system', 'stackbuild', '--stash', 'bench-a',
+                '--stash', 'bench-b',
+                '--target-dir', os.path.join(work_dir, 'target-merge')
+            ], work_dir
+        )
+        for scenario in ('stackbuild_root_cache_miss', 'stackbuild_root_cache_hit'):
+            results[scenario] = run_task(
+                SystemStackbuildTask, [
+                    'system', 'stackbuild', '--stash', 'bench-a',
+                    '--stash', 'bench-b', '--root-cache',
+                    '--target-dir', os.path.join(work_dir, scenario)
+                ], work_dir
+            )
+    return results
+
+
+def run_import_time(runs: int = 5) -> Dict:
+    """
+    Measure the import time of the task modules on top of the
+    kiwi modules loaded anyway, best of the given number of runs
+
+    :return: scenario result dict
+    """
+    phases = {}
+    for module in task_modules:
+        phases[module.rpartition('.')[2]] = round(
+            min(
+                float(
+                    subprocess.check_output(
+                        [sys.executable, '-c', import_time_code.format(module)]
+                    )
+                ) for run in range(runs)
+            ), 6
+        )
+    return {
+        'wall_seconds': round(sum(phases.values()), 6),
+        'phases': phases,
+        'synced_files': 0,
+        'synced_bytes': 0,
+        'throughput_bytes_per_second': 0
+    }
+
+
+def get_host(work_dir: str, notes: Optional[str]) -> Dict:
+    """
+    Describe the host the benchmark runs on
+
+    :return: dict of host properties
+    """
+    host: Dict[str, Any] = {
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cpu_model': _read_proc_value('/proc/cpuinfo', 'model name'),
+        'memory': _read_proc_value('/proc/meminfo', 'MemTotal'),
+        'work_dir_filesystem': subprocess.run(
+            ['stat', '--file-system', '--format', '%T', work_dir],
+            stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout.strip(),
+        'rsync': None
+    }
+    if shutil.which('rsync'):
+        host['rsync'] = subprocess.check_output(
+            ['rsync', '--version'], universal_newlines=True
+        ).splitlines()[0]
+    if notes:
+        host['notes'] = notes
+    return host
+
+
+def print_results(results: Dict, baseline: Optional[Dict]) -> None:
+    """
+    Print the scenario results, with the ratio to the
+    baseline result if a baseline is given
+    """
+    baseline_results = baseline['results'] if baseline else {}
+    for scenario, result in results.items():
+        base = baseline_results.get(scenario, {})
+        print(f'{scenario}:')
+        rows = [('wall', result['wall_seconds'], base.get('wall_seconds'))]
+        for name, seconds in result['phases'].items():
+            rows.append((name, seconds, base.get('phases', {}).get(name)))
+        for name, seconds, base_seconds in rows:
+            line = f'    {name:<20}{seconds:>10.3f}s'
+            if base_seconds:
+                line += f'{seconds / base_seconds:>10.2f}x'
+            print(line)
+        throughput = result['throughput_bytes_per_second']
+        if throughput:
+            line = '    {0:<20}{1:>10.1f}MiB/s ({2} files)'.format(
+                'throughput', throughput / 1024 / 1024,
+                result['synced_files']
+            )
+            if base.get('throughput_bytes_per_second'):
+                line += '{0:>10.2f}x'.format(
+                    throughput / base['throughput_bytes_per_second']
+                )
+            print(line)
+
+
+def _read_proc_value(filename: str, name: str) -> Optional[str]:
+    with open(filename) as proc_data:
+        for line in proc_data:
+            key, _, value = line.partition(':')
+            if key.strip() == name:
+                return value.strip()
+    return None
+
+
+def _write_file(filename: str, data: bytes) -> None:
+    with open(filename, 'wb') as target:
+        target.write(data)
+
+
+def main() -> None:
+    arguments = docopt.docopt(__doc__)
+    scale = float(arguments['--scale'] or 1)
+    seed = int(arguments['--seed'] or 42)
+    baseline_file = arguments['--baseline'] or os.path.join(
+        benchmark_dir, 'baseline.json'
+    )
+    baseline = None
+    if not arguments['--save-baseline'] and os.path.isfile(baseline_file):
+        with open(baseline_file) as baseline_data:
+            baseline = json.load(baseline_data)
+        if baseline['scale'] != scale or baseline['seed'] != seed:
+            print(
+                'Baseline {0} was recorded with scale {1} and seed {2}, '
+                'not compared'.format(
+                    baseline_file, baseline['scale'], baseline['seed']
+                )
+            )
+            baseline = None
+    work_dir = arguments['--work-dir'] or tempfile.gettempdir()
+    if arguments['--work-dir']:
+        os.makedirs(work_dir)
+    host = get_host(work_dir, arguments['--notes'])
+    if not host['rsync']:
+        # the stash and stackbuild scenarios sync root trees
+        print('rsync not found, only the import time is measured')
+        results = {}
+    elif arguments['--work-dir']:
+        results = run_benchmark(work_dir, scale, seed)
+    else:
+        with tempfile.TemporaryDirectory(prefix='kiwi_benchmark.') as work:
+            results = run_benchmark(work, scale, seed)
+    results['import_time'] = run_import_time()
+    print_results(results, baseline)
+    if arguments['--save-baseline']:
+        with open(arguments['--save-baseline'], 'w') as baseline_data:
+            json.dump(
+                {
+                    'scale': scale,
+                    'seed': seed,
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'host': host,
+                    'results': results
+                }, baseline_data, indent=4
+            )
+
+
+if __name__ == '__main__':
+    main()
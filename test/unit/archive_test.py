@@ -0,0 +1,200 @@
+import io
+import gzip
+import json
+import hashlib
+import tarfile
+import subprocess
+from pytest import raises
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.archive import StashArchive
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginUnpackFailed
+)
+
+
+class TestStashArchive:
+    def _blob(self, data):
+        return 'sha256:' + hashlib.sha256(data).hexdigest(), data
+
+    def _create_archive(self, filename, members):
+        with tarfile.open(filename, 'w') as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+    def _create_image(self, filename, layer=b'layer', index_type=None):
+        layer_digest, layer_data = self._blob(b'layer')
+        config_digest, config_data = self._blob(b'{}')
+        manifest_digest, manifest_data = self._blob(
+            json.dumps(
+                {
+                    'config': {
+                        'digest': config_digest, 'size': len(config_data)
+                    },
+                    'layers': [
+                        {'digest': layer_digest, 'size': len(layer_data)}
+                    ]
+                }
+            ).encode()
+        )
+        members = {
+            f'blobs/sha256/{manifest_digest[7:]}': manifest_data,
+            f'blobs/sha256/{config_digest[7:]}': config_data
+        }
+        descriptor = {'digest': manifest_digest, 'size': len(manifest_data)}
+        if index_type:
+            nested_digest, nested_data = self._blob(
+                json.dumps(
+                    {'mediaType': index_type, 'manifests': [descriptor]}
+                ).encode()
+            )
+            members[f'blobs/sha256/{nested_digest[7:]}'] = nested_data
+            descriptor = {'digest': nested_digest, 'size': len(nested_data)}
+        members = dict(
+            {'./index.json': json.dumps({'manifests': [descriptor]}).encode()},
+            **members
+        )
+        members[f'blobs/sha256/{layer_digest[7:]}'] = layer
+        self._create_archive(filename, members)
+        return layer_digest
+
+    def test_verify(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        self._create_image(filename)
+        archive = StashArchive(filename)
+        assert archive.verify(jobs=2) == {}
+        assert json.loads(archive.read('index.json'))['manifests']
+
+    def test_verify_nested_index(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        self._create_image(
+            filename, index_type='application/vnd.oci.image.index.v1+json'
+        )
+        assert StashArchive(filename).verify() == {}
+
+    def test_get_layers(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        layer_digest = self._create_image(
+            filename, index_type='application/vnd.oci.image.index.v1+json'
+        )
+        assert StashArchive(filename).get_layers() == [
+            {'digest': layer_digest, 'size': 5}
+        ]
+        self._create_archive(filename, {'index.json': b'{"manifests": []}'})
+        assert StashArchive(filename).get_layers() == []
+
+    def test_verify_corrupt_layer(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        layer_digest = self._create_image(filename, layer=b'LAYER')
+        assert StashArchive(filename).verify() == {
+            layer_digest: 'digest mismatch'
+        }
+
+    def test_verify_layer_size_mismatch(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        layer_digest = self._create_image(filename, layer=b'layer!')
+        assert StashArchive(filename).verify() == {
+            layer_digest: 'size mismatch: 6 != 5'
+        }
+
+    def test_verify_truncated(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        layer_digest = self._create_image(filename)
+        archive = StashArchive(filename)
+        offset, size = archive.get_members()[
+            f'blobs/sha256/{layer_digest[7:]}'
+        ]
+        with open(filename, 'r+b') as data:
+            data.truncate(offset + 1)
+        assert archive.verify()[layer_digest] == 'truncated'
+
+    def test_verify_missing_blobs(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        self._create_archive(
+            filename, {
+                'index.json': json.dumps(
+                    {
+                        'manifests': [
+                            {'digest': 'sha256:abc', 'size': 1},
+                            {'digest': 'md5:abc', 'size': 1}
+                        ]
+                    }
+                ).encode()
+            }
+        )
+        assert StashArchive(filename).verify() == {
+            'sha256:abc': 'missing',
+            'md5:abc': "unsupported digest algorithm 'md5'"
+        }
+
+    def test_verify_unreadable_index(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        self._create_archive(filename, {'index.json': b'{'})
+        assert 'index.json' in StashArchive(filename).verify()
+        with open(filename, 'wb') as data:
+            data.write(b'no archive')
+        assert 'index.json' in StashArchive(filename).verify()
+
+    def test_get_digest(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        self._create_image(filename)
+        index = json.loads(StashArchive(filename).read('index.json'))
+        assert StashArchive(filename).get_digest() == \
+            index['manifests'][0]['digest']
+
+    def test_open_layer(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        data = b'layer data' * 10000
+        self._create_archive(
+            filename, {
+                'blobs/sha256/plain': data,
+                'blobs/sha256/gzip': gzip.compress(data),
+                'trailing': b'not part of the layer'
+            }
+        )
+        archive = StashArchive(filename)
+        with archive.open_layer({'digest': 'sha256:plain'}) as stream:
+            assert stream.read() == data
+        with archive.open_layer(
+            {
+                'digest': 'sha256:gzip',
+                'mediaType': 'application/vnd.oci.image.layer.v1.tar+gzip'
+            }
+        ) as stream:
+            assert stream.read() == data
+
+    def test_open_layer_zstd(self, tmp_path):
+        filename = str(tmp_path / 'stash.tar')
+        data = b'layer data' * 10000
+        self._create_archive(filename, {'blobs/sha256/zstd': data})
+        archive = StashArchive(filename)
+        descriptor = {
+            'digest': 'sha256:zstd',
+            'mediaType': 'application/vnd.oci.image.layer.v1.tar+zstd'
+        }
+        popen = subprocess.Popen
+        # cat stands in for zstd to test the stream plumbing
+        with patch(
+            'subprocess.Popen',
+            side_effect=lambda command, **kwargs: popen(['cat'], **kwargs)
+        ) as mock_Popen:
+            with archive.open_layer(descriptor) as stream:
+                assert stream.read(10) == b'layer data'
+        mock_Popen.assert_called_once_with(
+            ['zstd', '--decompress', '--stdout'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        with patch(
+            'subprocess.Popen',
+            side_effect=lambda command, **kwargs: popen(['false'], **kwargs)
+        ):
+            with raises(KiwiStackBuildPluginUnpackFailed):
+                with archive.open_layer(descriptor) as stream:
+                    stream.read()
+        with patch('subprocess.Popen', side_effect=OSError('not found')):
+            with raises(KiwiStackBuildPluginUnpackFailed):
+                with archive.open_layer(descriptor) as stream:
+                    pass
@@ -0,0 +1,196 @@
+from pytest import raises
+from unittest.mock import (
+    Mock, patch, call
+)
+
+from kiwi_stackbuild_plugin.batch import StackBatch
+from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginBatchManifestInvalid
+)
+
+
+class TestStackBatch:
+    def setup(self):
+        self.global_args = {'--type': 'iso', '--profile': ['b', 'a', 'b']}
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def _manifest(self, tmp_path, content):
+        manifest = tmp_path / 'batch.yml'
+        manifest.write_text(content)
+        return str(manifest)
+
+    def test_load(self, tmp_path):
+        batch = StackBatch(
+            self._manifest(
+                tmp_path, '''
+builds:
+  - name: leap-oem
+    description: leap
+    type: oem
+    profiles: Desktop
+  - args: --signing-key /key
+'''
+            ), self.global_args
+        )
+        assert batch.builds == [
+            {
+                'name': 'leap-oem',
+                'description': str(tmp_path / 'leap'),
+                'type': 'oem',
+                'profiles': ['Desktop'],
+                'args': []
+            },
+            {
+                'name': 'build-2',
+                'description': None,
+                'type': 'iso',
+                'profiles': ['a', 'b'],
+                'args': ['--signing-key', '/key']
+            }
+        ]
+        assert batch.get_target_dirs('/target') == [
+            '/target/leap-oem', '/target/build-2'
+        ]
+
+    def test_load_invalid(self, tmp_path):
+        for content in (
+            'builds: [', 'builds: []', '- name: a', 'builds: [a]',
+            'builds: [{name: build}]', 'builds: [{name: ../a}]',
+            'builds: [{name: a}, {name: a}]',
+            'builds: [{name: a, args: [--no-such-option]}]'
+        ):
+            with raises(KiwiStackBuildPluginBatchManifestInvalid):
+                StackBatch(self._manifest(tmp_path, content), {})
+        with raises(KiwiStackBuildPluginBatchManifestInvalid):
+            StackBatch(str(tmp_path / 'missing.yml'), {})
+
+    @patch('kiwi_stackbuild_plugin.batch.Path')
+    @patch('kiwi_stackbuild_plugin.batch.DataSync')
+    @patch('kiwi_stackbuild_plugin.batch.StackReflink')
+    @patch('kiwi_stackbuild_plugin.batch.Command.run')
+    def test_run(
+        self, mock_Command_run, mock_StackReflink, mock_DataSync, mock_Path,
+        tmp_path
+    ):
+        target_dir = str(tmp_path / 'target')
+        batch = StackBatch(
+            self._manifest(
+                tmp_path, '''
+builds:
+  - name: leap-oem
+    description: /desc
+    type: oem
+    profiles: [Desktop]
+  - name: rebuild
+    args: [--signing-key, /key]
+'''
+            ), {'--temp-dir': '/tmp/kiwi', '--logfile': 'batch.log'}
+        )
+        mock_StackReflink.is_supported.side_effect = lambda source, target: \
+            'leap-oem' in target
+        mock_Command_run.side_effect = lambda command, raise_on_error: Mock(
+            returncode=0 if 'build' in command else 1
+        )
+        metrics = StackBuildMetrics('stackbuild')
+        result = batch.run('/root', target_dir, 2, metrics)
+        assert result == {
+            'leap-oem': {
+                'target_dir': f'{target_dir}/leap-oem',
+                'log_file': f'{target_dir}/leap-oem/build.log',
+                'status': 'ok'
+            },
+            'rebuild': {
+                'target_dir': f'{target_dir}/rebuild',
+                'log_file': f'{target_dir}/rebuild/build.log',
+                'status': 'failed'
+            }
+        }
+        assert sorted(mock_Path.create.call_args_list) == [
+            call(f'{target_dir}/leap-oem/build/image-root'),
+            call(f'{target_dir}/rebuild/build/image-root')
+        ]
+        mock_StackReflink.assert_called_once_with('/root')
+        mock_StackReflink.return_value.clone.assert_called_once_with(
+            f'{target_dir}/leap-oem/build/image-root'
+        )
+        mock_DataSync.assert_called_once_with(
+            '/root/', f'{target_dir}/rebuild/build/image-root'
+        )
+        assert sorted(mock_Command_run.call_args_list) == sorted(
+            [
+                call(
+                    [
+                        'kiwi-ng', '--logfile',
+                        f'{target_dir}/leap-oem/build.log',
+                        '--type', 'oem', '--profile', 'Desktop',
+                        '--temp-dir', '/tmp/kiwi',
+                        'system', 'build', '--description', '/desc',
+                        '--target-dir', f'{target_dir}/leap-oem',
+                        '--allow-existing-root'
+                    ], raise_on_error=False
+                ),
+                call(
+                    [
+                        'kiwi-ng', '--logfile',
+                        f'{target_dir}/rebuild/build.log',
+                        '--temp-dir', '/tmp/kiwi',
+                        'system', 'create', '--root',
+                        f'{target_dir}/rebuild/build/image-root',
+                        '--target-dir', f'{target_dir}/rebuild',
+                        '--signing-key', '/key'
+                    ], raise_on_error=False
+                )
+            ]
+        )
+        assert sorted(
+            (phase['name'], phase['build'], phase.get('method'))
+            for phase in metrics.get_report()['phases']
+        ) == [
+            ('clone', 'leap-oem', 'reflink'),
+            ('clone', 'rebuild', 'rsync'),
+            ('kiwi_build', 'leap-oem', None),
+            ('kiwi_create', 'rebuild', None)
+        ]
+
+    @patch('kiwi_stackbuild_plugin.batch.Path')
+    @patch('kiwi_stackbuild_plugin.batch.StackReflink')
+    @patch('kiwi_stackbuild_plugin.batch.Command.run')
+    def test_run_setup_failed(
+        self, mock_Command_run, mock_StackReflink, mock_Path, tmp_path
+    ):
+        target_dir = str(tmp_path / 'target')
+        batch = StackBatch(
+            self._manifest(
+                tmp_path, '''
+builds:
+  - name: broken
+  - name: rebuild
+'''
+            ), {}
+        )
+
+        def clone(build_root_dir):
+            if '/broken/' in build_root_dir:
+                raise OSError('No space left on device')
+
+        mock_StackReflink.is_supported.return_value = True
+        mock_StackReflink.return_value.clone.side_effect = clone
+        mock_Command_run.return_value = Mock(returncode=0)
+        result = batch.run('/root', target_dir, 2)
+        assert result == {
+            'broken': {
+                'target_dir': f'{target_dir}/broken',
+                'log_file': f'{target_dir}/broken/build.log',
+                'status': 'failed',
+                'error': 'OSError: No space left on device'
+            },
+            'rebuild': {
+                'target_dir': f'{target_dir}/rebuild',
+                'log_file': f'{target_dir}/rebuild/build.log',
+                'status': 'ok'
+            }
+        }
+        mock_Command_run.assert_called_once()
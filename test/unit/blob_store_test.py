@@ -0,0 +1,189 @@
+import os
+import stat
+from unittest.mock import (
+    Mock, patch
+)
+
+from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+from kiwi_stackbuild_plugin.tree import StackTree
+from kiwi_stackbuild_plugin.index import StashIndex
+
+
+class TestStashBlobStore:
+    def _create_root(self, root, files):
+        for name, data in files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as handle:
+                handle.write(data)
+            os.utime(path, ns=(0, 0))
+
+    def test_add_root(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        root = str(tmp_path / 'root')
+        self._create_root(
+            root, {
+                'usr/bin/a': 'same', 'usr/bin/b': 'same',
+                'etc/conf': 'conf', 'dev/null': 'excluded',
+                'proc/1/status': 'excluded'
+            }
+        )
+        os.link(
+            os.path.join(root, 'etc/conf'),
+            os.path.join(root, 'etc/conf.link')
+        )
+        os.symlink('usr/bin', os.path.join(root, 'bin'))
+        os.mkfifo(os.path.join(root, 'etc/fifo'))
+        os.chmod(os.path.join(root, 'usr'), 0o700)
+        store = StashBlobStore(stash_home)
+        assert store.add_root('base', root, ['dev/*', 'proc/*']) == {
+            'hardlink_bytes': 8, 'sparse_bytes': 0
+        }
+        stash_root = store.get_root('base')
+        assert stash_root == os.path.join(stash_home, 'base', 'root')
+        with open(os.path.join(stash_root, 'usr/bin/a')) as data:
+            assert data.read() == 'same'
+        assert os.path.isdir(os.path.join(stash_root, 'dev'))
+        assert not os.path.exists(os.path.join(stash_root, 'dev/null'))
+        assert os.listdir(os.path.join(stash_root, 'proc')) == []
+        assert os.readlink(os.path.join(stash_root, 'bin')) == 'usr/bin'
+        assert stat.S_ISFIFO(
+            os.lstat(os.path.join(stash_root, 'etc/fifo')).st_mode
+        )
+        assert stat.S_IMODE(
+            os.stat(os.path.join(stash_root, 'usr')).st_mode
+        ) == 0o700
+        a = os.stat(os.path.join(stash_root, 'usr/bin/a'))
+        b = os.stat(os.path.join(stash_root, 'usr/bin/b'))
+        assert a.st_ino == b.st_ino
+        assert a.st_mtime_ns == 0
+        conf = os.stat(os.path.join(stash_root, 'etc/conf'))
+        conf_link = os.stat(os.path.join(stash_root, 'etc/conf.link'))
+        assert conf.st_ino == conf_link.st_ino
+        # identical files share a blob but only real hardlinks
+        # of the root tree are recorded as link group
+        link_groups = store.get_link_groups('base')
+        assert sorted(link_groups) == ['etc/conf', 'etc/conf.link']
+        assert link_groups['etc/conf'] == link_groups['etc/conf.link']
+        assert store.get_link_groups('missing') is None
+        assert store.get_sizes('base') == {
+            'logical_size': 16, 'deduplicated_size': 8
+        }
+        # a second stash shares the identical files with the first one
+        assert store.add_root('app', root, ['dev/*', 'proc/*']) == {
+            'hardlink_bytes': 16, 'sparse_bytes': 0
+        }
+        assert store.get_sizes('app') == {
+            'logical_size': 16, 'deduplicated_size': 4
+        }
+        # the share of the first stash is updated in the stash
+        # index, reading the sizes loads no stash root index
+        with patch.object(store, '_load_index') as mock_load_index:
+            assert store.get_sizes('base')['deduplicated_size'] == 4
+            assert store.get_sizes('app')['deduplicated_size'] == 4
+        assert not mock_load_index.called
+        assert StashIndex(stash_home).get_stashes()['base'] == {
+            'logical_size': 16, 'deduplicated_size': 4
+        }
+        assert os.stat(os.path.join(stash_root, 'usr/bin/a')).st_nlink == 5
+        # removing a stash keeps blobs still referenced by others
+        store.remove_root('app')
+        assert store.get_root('app') is None
+        assert store.get_sizes('app') is None
+        assert store.get_sizes('base')['deduplicated_size'] == 8
+        assert os.stat(os.path.join(stash_root, 'usr/bin/a')).st_nlink == 3
+        store.remove_root('base')
+        blobs = [
+            files for dirpath, dirs, files in os.walk(
+                os.path.join(stash_home, '.blobs')
+            ) if files
+        ]
+        assert blobs == []
+
+    def test_add_root_sparse(self, tmp_path):
+        root = str(tmp_path / 'root')
+        os.makedirs(root)
+        with open(os.path.join(root, 'db'), 'wb') as data:
+            data.write(b'data')
+            data.truncate(1024 * 1024)
+        with open(os.path.join(tmp_path, 'stale'), 'w'):
+            pass
+        store = StashBlobStore(str(tmp_path / 'stash'))
+        key = store._get_key(
+            os.path.join(root, 'db'), os.lstat(os.path.join(root, 'db')),
+            None
+        )
+        blob_tmp = f'{store._get_blob_path(key)}.{os.getpid()}'
+        os.makedirs(os.path.dirname(blob_tmp))
+        os.link(os.path.join(tmp_path, 'stale'), blob_tmp)
+        stats = store.add_root('base', root)
+        assert stats['sparse_bytes'] >= 1024 * 1024 - 4096
+        with open(os.path.join(store.get_root('base'), 'db'), 'rb') as data:
+            assert data.read() == b'data' + bytes(1024 * 1024 - 4)
+
+    @patch('os.listxattr')
+    @patch('os.getxattr')
+    @patch('os.setxattr')
+    def test_add_root_xattrs(
+        self, mock_setxattr, mock_getxattr, mock_listxattr, tmp_path
+    ):
+        stash_home = str(tmp_path / 'stash')
+        root = str(tmp_path / 'root')
+        self._create_root(root, {'etc/conf': 'conf'})
+        mock_listxattr.return_value = ['security.capability']
+        mock_getxattr.return_value = b'cap'
+        mock_setxattr.side_effect = OSError
+        store = StashBlobStore(stash_home)
+        with patch('kiwi_stackbuild_plugin.tree.log') as mock_log:
+            store.add_root('base', root)
+            assert mock_log.warning.called
+
+    @patch('os.mknod')
+    @patch('os.lstat')
+    @patch('os.walk')
+    def test_add_root_device(
+        self, mock_os_walk, mock_os_lstat, mock_os_mknod, tmp_path
+    ):
+        stash_home = str(tmp_path / 'stash')
+        mock_os_walk.return_value = [('/root', [], ['null'])]
+        mock_os_lstat.return_value = Mock(
+            st_mode=stat.S_IFCHR | 0o666, st_rdev=0
+        )
+        store = StashBlobStore(stash_home)
+        with patch.object(StackTree, 'copy_metadata'):
+            store.add_root('base', '/root')
+        mock_os_mknod.assert_called_once_with(
+            os.path.join(stash_home, 'base', 'root', 'null'),
+            stat.S_IFCHR | 0o666, 0
+        )
+
+    def test_get_digest(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        root = str(tmp_path / 'root')
+        self._create_root(root, {'etc/a': 'a'})
+        store = StashBlobStore(stash_home)
+        assert store.get_digest('base') is None
+        store.add_root('base', root)
+        digest = store.get_digest('base')
+        assert len(digest) == 64
+        assert store.get_digest('base') == digest
+        index_file = os.path.join(stash_home, 'base', 'base.blobs')
+        os.utime(index_file, ns=(1, 1))
+        assert store.get_digest('base') != digest
+
+    def test_verify_root(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        root = str(tmp_path / 'root')
+        self._create_root(
+            root, {'etc/a': 'a', 'etc/b': 'b', 'etc/c': 'c'}
+        )
+        store = StashBlobStore(stash_home)
+        store.add_root('base', root)
+        assert store.verify_root('base', jobs=2) == {}
+        stash_root = store.get_root('base')
+        with open(os.path.join(stash_root, 'etc/a'), 'w') as handle:
+            handle.write('corrupt')
+        os.unlink(os.path.join(stash_root, 'etc/b'))
+        assert store.verify_root('base', jobs=2) == {
+            'etc/a': 'checksum mismatch', 'etc/b': 'missing'
+        }
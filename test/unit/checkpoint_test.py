@@ -0,0 +1,88 @@
+import json
+from pytest import raises
+
+from kiwi_stackbuild_plugin.checkpoint import StackCheckpoint
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginResumeFailed
+)
+
+
+class TestStackCheckpoint:
+    def setup(self):
+        self.stashes = [('base', 'sha256:a'), ('app', 'sha256:b')]
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def test_start(self, tmp_path):
+        checkpoint_file = str(tmp_path / 'checkpoint')
+        checkpoint = StackCheckpoint(checkpoint_file)
+        assert checkpoint.load() is False
+        assert not checkpoint.is_applied(0)
+        assert not checkpoint.is_complete()
+        assert checkpoint.start(self.stashes, ['include:usr']) == 0
+        checkpoint.set_applied(0)
+        assert checkpoint.is_applied(0)
+        assert not checkpoint.is_complete()
+        with open(checkpoint_file) as data:
+            assert json.load(data) == {
+                'filter': ['include:usr'],
+                'stashes': [
+                    {'name': 'base', 'digest': 'sha256:a', 'applied': True},
+                    {'name': 'app', 'digest': 'sha256:b', 'applied': False}
+                ]
+            }
+        # starting again keeps the applied stashes
+        assert checkpoint.start(self.stashes, ['include:usr']) == 1
+        checkpoint.set_complete()
+        assert checkpoint.is_complete()
+
+    def test_resume(self, tmp_path):
+        checkpoint_file = str(tmp_path / 'checkpoint')
+        checkpoint = StackCheckpoint(checkpoint_file)
+        checkpoint.start(self.stashes, [])
+        checkpoint.set_applied(0)
+        resumed = StackCheckpoint(checkpoint_file)
+        assert resumed.load() is True
+        assert resumed.start(self.stashes, []) == 1
+        assert resumed.is_applied(0)
+        assert not resumed.is_applied(1)
+
+    def test_resume_changed_stack(self, tmp_path):
+        checkpoint_file = str(tmp_path / 'checkpoint')
+        StackCheckpoint(checkpoint_file).start(self.stashes, [])
+        resumed = StackCheckpoint(checkpoint_file)
+        resumed.load()
+        with raises(KiwiStackBuildPluginResumeFailed):
+            resumed.start(self.stashes[:1], [])
+        with raises(KiwiStackBuildPluginResumeFailed):
+            resumed.start(self.stashes, ['exclude:srv'])
+
+    def test_resume_changed_stash(self, tmp_path):
+        checkpoint_file = str(tmp_path / 'checkpoint')
+        checkpoint = StackCheckpoint(checkpoint_file)
+        checkpoint.start(self.stashes, [])
+        checkpoint.set_applied(0)
+        resumed = StackCheckpoint(checkpoint_file)
+        resumed.load()
+        # a stash not applied yet may change
+        assert resumed.start(
+            [('base', 'sha256:a'), ('app', 'sha256:c')], []
+        ) == 1
+        with raises(KiwiStackBuildPluginResumeFailed):
+            resumed.start([('base', None), ('app', 'sha256:c')], [])
+        with raises(KiwiStackBuildPluginResumeFailed):
+            resumed.start([('base', 'sha256:d'), ('app', 'sha256:c')], [])
+
+    def test_load_unreadable(self, tmp_path):
+        checkpoint_file = tmp_path / 'checkpoint'
+        checkpoint_file.write_text('{')
+        with raises(KiwiStackBuildPluginResumeFailed):
+            StackCheckpoint(str(checkpoint_file)).load()
+
+    def test_set_applied_not_started(self, tmp_path):
+        checkpoint_file = tmp_path / 'checkpoint'
+        checkpoint = StackCheckpoint(str(checkpoint_file))
+        checkpoint.set_applied(0)
+        checkpoint.set_complete()
+        assert not checkpoint_file.exists()
@@ -0,0 +1,178 @@
+import os
+import threading
+from unittest.mock import (
+    Mock, patch, call
+)
+
+from kiwi.command import Command
+
+from kiwi_stackbuild_plugin.collect import StashCollector
+from kiwi_stackbuild_plugin.index import StashIndex
+from kiwi_stackbuild_plugin.lock import StashLock
+from kiwi_stackbuild_plugin.root_cache import StackRootCache
+
+
+class TestStashCollector:
+    def setup(self):
+        self.podman_result = Mock(returncode=1)
+        run = Command.run
+
+        def command_run(command, raise_on_error=True):
+            # podman is faked, the rm calls of Path.wipe are real
+            if command[0] == 'podman':
+                return self.podman_result
+            return run(command, raise_on_error=raise_on_error)
+
+        self.command_run_patch = patch(
+            'kiwi_stackbuild_plugin.collect.Command.run',
+            side_effect=command_run
+        )
+        self.mock_Command_run = self.command_run_patch.start()
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def teardown_method(self, cls):
+        self.command_run_patch.stop()
+
+    def _create_stash(self, stash_home, name, size, last_used=None):
+        stash_dir = os.path.join(stash_home, name)
+        os.makedirs(stash_dir)
+        with open(os.path.join(stash_dir, f'{name}.tar'), 'wb') as archive:
+            archive.write(b'x' * size)
+        if last_used:
+            with patch('time.time', return_value=last_used):
+                StashIndex(stash_home).add_stash(name, 'latest', {})
+        else:
+            os.utime(stash_dir, (1, 1))
+
+    def test_get_stashes(self, tmp_path):
+        stash_home = str(tmp_path)
+        self._create_stash(stash_home, 'new', 10, last_used=30)
+        self._create_stash(stash_home, 'old', 20)
+        self.podman_result = Mock(returncode=0, output='100\n')
+        assert StashCollector(stash_home).get_stashes() == [
+            {'name': 'old', 'tags': ['latest'], 'size': 120, 'last_used': 1},
+            {'name': 'new', 'tags': ['latest'], 'size': 110, 'last_used': 30}
+        ]
+        self.mock_Command_run.assert_any_call(
+            [
+                'podman', 'image', 'inspect', '--format', '{{.Size}}',
+                'localhost/new:latest'
+            ], raise_on_error=False
+        )
+
+    def test_get_stashes_blob_store(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        root = tmp_path / 'root'
+        root.mkdir()
+        (root / 'file').write_bytes(b'x' * 8)
+        collector = StashCollector(stash_home)
+        collector.blob_store.add_root('base', str(root))
+        stashes = collector.get_stashes()
+        assert len(stashes) == 1
+        # deduplicated size plus the blob store index file
+        assert stashes[0]['size'] == 8 + os.path.getsize(
+            os.path.join(stash_home, 'base', 'base.blobs')
+        )
+        assert StashCollector(str(tmp_path / 'none')).get_stashes() == []
+
+    def test_collect(self, tmp_path):
+        stash_home = str(tmp_path)
+        self._create_stash(stash_home, 'a', 10, last_used=10)
+        self._create_stash(stash_home, 'b', 10, last_used=20)
+        self._create_stash(stash_home, 'c', 10, last_used=30)
+        self._create_stash(stash_home, 'd', 10, last_used=40)
+        stash_lock = StashLock(stash_home, 'b')
+        stash_lock.acquire()
+        collector = StashCollector(stash_home)
+        assert collector.collect(15, keep=1) == {
+            'size_before': 40,
+            'evicted': ['a', 'c'],
+            'evicted_root_cache': [],
+            'in_use': ['b'],
+            'size_after': 20
+        }
+        stash_lock.release()
+        assert sorted(os.listdir(stash_home)) == [
+            '.index.json', '.index.lock', '.locks', 'b', 'd'
+        ]
+        assert sorted(StashIndex(stash_home).get_stashes()) == ['b', 'd']
+        assert call(
+            ['podman', 'image', 'rm', 'localhost/a:latest'],
+            raise_on_error=False
+        ) in self.mock_Command_run.call_args_list
+        assert collector.collect(0, keep=5)['evicted'] == []
+        assert collector.collect(100)['evicted'] == []
+
+    def test_collect_blob_store(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        root = tmp_path / 'root'
+        root.mkdir()
+        (root / 'file').write_bytes(b'x' * 8)
+        collector = StashCollector(stash_home)
+        collector.blob_store.add_root('base', str(root))
+        assert collector.collect(0)['evicted'] == ['base']
+        assert os.listdir(os.path.join(stash_home, '.blobs')) != []
+        assert [
+            files for dirpath, dirs, files in os.walk(
+                os.path.join(stash_home, '.blobs')
+            ) if files
+        ] == []
+
+    def test_collect_root_cache(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        self._create_stash(stash_home, 'base', 10, last_used=10)
+        root = tmp_path / 'root'
+        root.mkdir()
+        (root / 'file').write_bytes(b'x' * 8)
+        root_cache = StackRootCache(stash_home)
+        for key in ('old', 'new', 'newest', 'used'):
+            root_cache.add_root(key, str(root))
+        os.utime(os.path.join(stash_home, '.root-cache', 'old'), (1, 1))
+        os.utime(os.path.join(stash_home, '.root-cache', 'new'), (2, 2))
+        os.utime(os.path.join(stash_home, '.root-cache', 'newest'), (3, 3))
+        os.utime(os.path.join(stash_home, '.root-cache', 'used'), (1, 1))
+        entry_lock = StashLock(
+            root_cache.cache_dir, 'used', root_cache.cache_dir
+        )
+        entry_lock.acquire()
+        result = StashCollector(stash_home).collect(26)
+        entry_lock.release()
+        assert result['evicted_root_cache'] == ['old', 'new']
+        assert result['evicted'] == []
+        assert result['size_after'] == 26
+        assert [
+            entry['key'] for entry in root_cache.get_entries()
+        ] == ['used', 'newest']
+
+    def test_collect_lock_while_evicting(self, tmp_path):
+        stash_home = str(tmp_path)
+        self._create_stash(stash_home, 'a', 10, last_used=1)
+        collector = StashCollector(stash_home)
+        evicting = threading.Event()
+        evict = collector._evict
+        user_locked = []
+
+        def stackbuild():
+            # a stackbuild waiting for the stash being evicted
+            evicting.wait(1)
+            user_locked.append(StashLock(stash_home, 'a').acquire())
+
+        def evict_stash(name, tags):
+            evicting.set()
+            # the stackbuild is blocked while the stash is removed
+            assert not StashLock(stash_home, 'a').acquire(blocking=False)
+            evict(name, tags)
+            assert os.path.isfile(
+                os.path.join(stash_home, '.locks', 'a.lock')
+            )
+
+        user = threading.Thread(target=stackbuild)
+        user.start()
+        with patch.object(collector, '_evict', side_effect=evict_stash):
+            assert collector.collect(0)['evicted'] == ['a']
+        user.join()
+        # the evicted stash is not handed out to the waiting stackbuild
+        assert user_locked == [False]
+        assert not os.path.isdir(os.path.join(stash_home, 'a'))
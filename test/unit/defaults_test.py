@@ -9,3 +9,15 @@ class TestDefaults:
         assert StackBuildDefaults.is_container_name_valid(
             'Leap-15.3_appliance'
         ) is False
+
+    def test_get_pull_jobs(self):
+        assert StackBuildDefaults.get_pull_jobs() == 4
+
+    def test_get_server_defaults(self):
+        assert StackBuildDefaults.get_server_socket() == \
+            '/run/kiwi-stackbuild.sock'
+        assert StackBuildDefaults.get_server_workers() == 2
+
+    def test_get_stash_compression(self):
+        assert StackBuildDefaults.get_stash_compression() in \
+            StackBuildDefaults.get_stash_compressions()
@@ -0,0 +1,21 @@
+import os
+
+from kiwi_stackbuild_plugin.deletions import StashDeletions
+
+
+class TestStashDeletions:
+    def test_set_get(self, tmp_path):
+        (tmp_path / 'app').mkdir()
+        deletions = StashDeletions(str(tmp_path), 'app')
+        assert deletions.get() == []
+        deletions.set(['usr/bin/b', 'etc/obsolete'])
+        assert deletions.get() == ['etc/obsolete', 'usr/bin/b']
+        assert os.listdir(tmp_path / 'app') == ['app.deleted']
+        deletions.set([])
+        assert os.listdir(tmp_path / 'app') == []
+        assert deletions.get() == []
+
+    def test_get_unreadable(self, tmp_path):
+        (tmp_path / 'app').mkdir()
+        (tmp_path / 'app' / 'app.deleted').write_text('{')
+        assert StashDeletions(str(tmp_path), 'app').get() == []
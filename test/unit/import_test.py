@@ -0,0 +1,50 @@
+import sys
+import json
+import subprocess
+
+from pytest import mark
+
+import_check_code = '''
+import sys
+import json
+import kiwi.cli
+import kiwi.tasks.base
+loaded = set(sys.modules)
+import {0}
+print(json.dumps(sorted(set(sys.modules) - loaded)))
+'''
+
+# modules only needed by some code paths of the tasks
+heavy_modules = (
+    'concurrent.futures',
+    'kiwi.oci_tools',
+    'kiwi.tasks.system_build',
+    'kiwi.utils.output',
+    'kiwi.utils.sync',
+    'kiwi_stackbuild_plugin.archive',
+    'kiwi_stackbuild_plugin.blob_store',
+    'kiwi_stackbuild_plugin.layer',
+    'kiwi_stackbuild_plugin.manifest',
+    'kiwi_stackbuild_plugin.merge',
+    'kiwi_stackbuild_plugin.server',
+    'socketserver',
+    'sqlite3',
+    'tarfile'
+)
+
+
+class TestImport:
+    @mark.parametrize('module', [
+        'kiwi_stackbuild_plugin.tasks.system_stash',
+        'kiwi_stackbuild_plugin.tasks.system_stackbuild'
+    ])
+    def test_task_module_imports(self, module):
+        # kiwi imports all task plugin modules on every call
+        loaded = json.loads(
+            subprocess.check_output(
+                [sys.executable, '-c', import_check_code.format(module)]
+            )
+        )
+        assert module in loaded
+        for heavy_module in heavy_modules:
+            assert heavy_module not in loaded
@@ -0,0 +1,67 @@
+import os
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.index import StashIndex
+
+
+class TestStashIndex:
+    def test_add_stash(self, tmp_path):
+        stash_home = str(tmp_path / 'stash')
+        index = StashIndex(stash_home)
+        assert index.get_stashes() == {}
+        with patch('time.time', return_value=10.5):
+            index.add_stash('base', 'latest', {'layers': 1})
+        with patch('time.time', return_value=20):
+            index.add_stash('base', 'v1', {'layers': 2})
+        assert index.get_stashes() == {
+            'base': {
+                'layers': 2, 'tags': ['latest', 'v1'],
+                'created': 20, 'last_used': 20
+            }
+        }
+        assert sorted(os.listdir(stash_home)) == [
+            '.index.json', '.index.lock'
+        ]
+
+    def test_update_stashes(self, tmp_path):
+        index = StashIndex(str(tmp_path))
+        with patch('time.time', return_value=10):
+            index.add_stash('base', 'latest', {'size': 1})
+        index.update_stashes(
+            {
+                'base': {'size': None, 'logical_size': 2},
+                'app': {'logical_size': 4},
+                'gone': {'logical_size': None}
+            }
+        )
+        assert index.get_stashes() == {
+            'base': {
+                'tags': ['latest'], 'created': 10, 'last_used': 10,
+                'logical_size': 2
+            },
+            'app': {'logical_size': 4}
+        }
+
+    def test_touch(self, tmp_path):
+        index = StashIndex(str(tmp_path))
+        with patch('time.time', return_value=10):
+            index.add_stash('base', 'latest', {})
+        with patch('time.time', return_value=30):
+            index.touch('base')
+            index.touch('unknown')
+        assert index.get_stashes() == {
+            'base': {'tags': ['latest'], 'created': 10, 'last_used': 30}
+        }
+
+    def test_get_stashes_unreadable(self, tmp_path):
+        index = StashIndex(str(tmp_path))
+        with open(index.index_file, 'w') as index_file:
+            index_file.write('{')
+        assert index.get_stashes() == {}
+
+    def test_remove_stash(self, tmp_path):
+        index = StashIndex(str(tmp_path))
+        index.add_stash('base', 'latest', {})
+        index.remove_stash('base')
+        index.remove_stash('base')
+        assert index.get_stashes() == {}
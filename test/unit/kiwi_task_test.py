@@ -0,0 +1,146 @@
+import sys
+import logging
+from docopt import DocoptExit
+from pytest import raises
+from unittest.mock import (
+    Mock, patch
+)
+
+import kiwi.tasks.system_build
+from kiwi.tasks.system_build import SystemBuildTask
+from kiwi.tasks.system_create import SystemCreateTask
+
+from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginInvalidArgument,
+    KiwiStackBuildPluginKiwiTaskFailed
+)
+
+
+class TestStackKiwiTask:
+    def setup(self):
+        self.runtime_task = Mock()
+        self.runtime_task.checks_before_command_args = {
+            'check_image_version_provided': []
+        }
+        self.runtime_task.checks_after_command_args = {
+            'check_repositories_configured': []
+        }
+        self.kiwi_task = StackKiwiTask(self.runtime_task)
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def test_validate(self):
+        command_args = StackKiwiTask.validate(
+            'create', ['--root', '/root', '--target-dir', '/target']
+        )
+        assert command_args['create'] is True
+        assert command_args['--root'] == '/root'
+        assert command_args['--target-dir'] == '/target'
+        with raises(DocoptExit):
+            StackKiwiTask.validate('build', ['--no-such-option'])
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            StackKiwiTask.validate('prepare', [])
+
+    def test_new(self):
+        argv = list(sys.argv)
+        command_args = StackKiwiTask.validate(
+            'build', ['--description', '/desc', '--target-dir', '/target']
+        )
+        global_args = {'--profile': ['a'], '--type': 'iso'}
+        task = self.kiwi_task.new('build', command_args, global_args)
+        assert isinstance(task, SystemBuildTask)
+        assert task.command_args is command_args
+        assert task.global_args is global_args
+        assert task.runtime_checker is None
+        assert task.runtime_config is self.runtime_task.runtime_config
+        assert task.cli is self.runtime_task.cli
+        assert task.task is kiwi.tasks.system_build
+        assert task.checks_before_command_args == \
+            self.runtime_task.checks_before_command_args
+        # the checks dicts are changed by the task, each task has its own
+        assert task.checks_before_command_args is not \
+            self.runtime_task.checks_before_command_args
+        assert task.checks_after_command_args == {
+            'check_repositories_configured': []
+        }
+        assert isinstance(
+            self.kiwi_task.new('create', {}, global_args), SystemCreateTask
+        )
+        assert sys.argv == argv
+
+    def test_new_sets_all_task_attributes(self):
+        # fails if a kiwi release sets task attributes in
+        # CliTask.__init__ which are not provided by new()
+        with patch.object(
+            sys, 'argv', [
+                'kiwi-ng', 'system', 'create',
+                '--root', '/root', '--target-dir', '/target'
+            ]
+        ):
+            cli_task = SystemCreateTask(should_perform_task_setup=False)
+        task = StackKiwiTask(cli_task).new(
+            'create', cli_task.command_args, cli_task.global_args
+        )
+        assert sorted(vars(task)) == sorted(vars(cli_task))
+
+    def test_get_command_line(self):
+        assert StackKiwiTask.get_command_line(
+            'create', ['--root', 'root'],
+            {'--type': 'iso', '--profile': ['a', 'b']}, 'build.log'
+        ) == [
+            'kiwi-ng', '--logfile', 'build.log', '--type', 'iso',
+            '--profile', 'a', '--profile', 'b',
+            'system', 'create', '--root', 'root'
+        ]
+        assert StackKiwiTask.get_command_line(
+            'create', [], {'--type': None, '--profile': []}, 'build.log'
+        ) == ['kiwi-ng', '--logfile', 'build.log', 'system', 'create']
+        # all global arguments but the log target are passed on
+        assert StackKiwiTask.get_command_line(
+            'build', [], {
+                '--type': None, '--profile': [], '--temp-dir': '/tmp',
+                '--debug': True, '--color-output': False,
+                '--logfile': 'server.log', '--logsocket': '/socket',
+                'system': True, '--help': False
+            }, 'build.log'
+        ) == [
+            'kiwi-ng', '--logfile', 'build.log', '--temp-dir', '/tmp',
+            '--debug', 'system', 'build'
+        ]
+
+    def test_process_forked(self, tmp_path):
+        log_file = str(tmp_path / 'build.log')
+        done_file = tmp_path / 'done'
+        task = Mock()
+        task.process = lambda: done_file.write_text('done')
+        StackKiwiTask.process_forked(task, log_file)
+        assert done_file.read_text() == 'done'
+        task.process = Mock(side_effect=Exception('failed'))
+        with raises(KiwiStackBuildPluginKiwiTaskFailed):
+            StackKiwiTask.process_forked(task, log_file)
+        with open(log_file) as log_data:
+            assert 'Exception: failed' in log_data.read()
+
+    @patch('logging.shutdown')
+    @patch('os._exit')
+    def test_process_child(self, mock_exit, mock_logging_shutdown):
+        file_handler = Mock()
+        task = Mock()
+        with patch('kiwi_stackbuild_plugin.kiwi_task.log') as mock_log:
+            mock_log.log_handlers = {'file': file_handler, 'info': Mock()}
+            StackKiwiTask._process_child(task, 'build.log')
+            mock_log.removeHandler.assert_called_once_with(file_handler)
+            mock_log.set_logfile.assert_called_once_with('build.log')
+            mock_log.setLogLevel.assert_called_once_with(
+                logging.CRITICAL, except_for=['file']
+            )
+            task.process.assert_called_once_with()
+            mock_exit.assert_called_once_with(0)
+            mock_logging_shutdown.assert_called_once_with()
+            mock_exit.reset_mock()
+            task.process.side_effect = KeyboardInterrupt
+            StackKiwiTask._process_child(task, 'build.log')
+            mock_exit.assert_called_once_with(1)
+            mock_log.error.assert_called_once_with('KeyboardInterrupt: ')
@@ -0,0 +1,86 @@
+import os
+import tarfile
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.layer import StashLayer
+from kiwi_stackbuild_plugin.unpack import StashUnpacker
+
+
+class TestStashLayer:
+    def _create(self, root, files):
+        for name, data in files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as handle:
+                handle.write(data)
+
+    def test_create(self, tmp_path):
+        root = str(tmp_path / 'root')
+        lower = str(tmp_path / 'lower')
+        layer_file = str(tmp_path / 'layer.tar')
+        self._create(
+            lower, {
+                'etc/conf': 'old', 'etc/gone': 'gone',
+                'etc/gone.d/file': 'gone', 'srv/data/file': 'dir',
+                'usr/bin/tool': 'tool'
+            }
+        )
+        self._create(
+            root, {
+                'etc/conf': 'new', 'etc/app.d/app': 'app',
+                'srv/data': 'file replacing a directory',
+                'usr/bin/tool': 'tool'
+            }
+        )
+        os.symlink('usr/bin', os.path.join(root, 'bin'))
+        stats = StashLayer(root).create(
+            layer_file, [
+                'bin', 'etc', 'etc/app.d', 'etc/app.d/app', 'etc/conf',
+                'srv/data'
+            ], ['etc/gone', 'etc/gone.d', 'etc/gone.d/file', 'srv/data/file']
+        )
+        assert stats == {'entries': 6, 'whiteouts': 2}
+        with tarfile.open(layer_file) as layer:
+            members = {member.name: member for member in layer}
+        assert sorted(members) == [
+            'bin', 'etc', 'etc/.wh.gone', 'etc/.wh.gone.d', 'etc/app.d',
+            'etc/app.d/app', 'etc/conf', 'srv/data'
+        ]
+        assert members['etc/conf'].uname == ''
+        assert members['etc/conf'].uid == os.getuid()
+        # the layer applied on the lower layer yields the root tree
+        with open(layer_file, 'rb') as stream:
+            StashUnpacker(None).unpack_layer(stream, lower)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path) as data:
+                    with open(
+                        os.path.join(lower, os.path.relpath(path, root))
+                    ) as lower_data:
+                        assert lower_data.read() == data.read()
+        assert sorted(os.listdir(os.path.join(lower, 'etc'))) == [
+            'app.d', 'conf'
+        ]
+        assert os.readlink(os.path.join(lower, 'bin')) == 'usr/bin'
+
+    def test_create_xattrs(self, tmp_path):
+        root = str(tmp_path / 'root')
+        layer_file = str(tmp_path / 'layer.tar')
+        self._create(root, {'file': 'data'})
+        with patch(
+            'os.listxattr', return_value=['security.selinux', 'user.stash']
+        ), patch('os.getxattr', return_value=b'value'):
+            StashLayer(root).create(layer_file, ['file'], [])
+        with tarfile.open(layer_file) as layer:
+            xattrs = {
+                name: value for name, value in
+                layer.getmember('file').pax_headers.items()
+                if name.startswith('SCHILY.xattr.')
+            }
+        assert xattrs == {'SCHILY.xattr.user.stash': 'value'}
+        with patch('os.listxattr', side_effect=OSError('not supported')):
+            StashLayer(root).create(layer_file, ['file'], [])
+        with tarfile.open(layer_file) as layer:
+            assert 'SCHILY.xattr.user.stash' not in \
+                layer.getmember('file').pax_headers
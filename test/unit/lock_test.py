@@ -0,0 +1,53 @@
+import os
+import threading
+
+from kiwi_stackbuild_plugin.lock import StashLock
+
+
+class TestStashLock:
+    def test_acquire(self, tmp_path):
+        (tmp_path / 'base').mkdir()
+        user_lock = StashLock(str(tmp_path), 'base')
+        other_user_lock = StashLock(str(tmp_path), 'base')
+        evict_lock = StashLock(str(tmp_path), 'base')
+        assert user_lock.acquire()
+        assert other_user_lock.acquire()
+        assert not evict_lock.acquire(exclusive=True, blocking=False)
+        assert evict_lock.lock is None
+        user_lock.release()
+        other_user_lock.release()
+        assert evict_lock.acquire(exclusive=True, blocking=False)
+        assert not user_lock.acquire(blocking=False)
+        evict_lock.release()
+        evict_lock.release()
+
+    def test_acquire_no_stash(self, tmp_path):
+        assert not StashLock(str(tmp_path), 'base').acquire()
+
+    def test_acquire_lock_dir(self, tmp_path):
+        (tmp_path / 'base').mkdir()
+        user_lock = StashLock(str(tmp_path), 'base', str(tmp_path))
+        assert user_lock.lock_file == str(tmp_path / 'base.lock')
+        assert user_lock.acquire()
+        (tmp_path / 'base').rmdir()
+        assert os.path.isfile(user_lock.lock_file)
+        user_lock.release()
+
+    def test_acquire_stash_removed(self, tmp_path):
+        (tmp_path / 'base').mkdir()
+        evict_lock = StashLock(str(tmp_path), 'base')
+        assert evict_lock.lock_file == str(tmp_path / '.locks' / 'base.lock')
+        assert evict_lock.acquire(exclusive=True)
+        user_lock = StashLock(str(tmp_path), 'base')
+        user_locked = []
+        user = threading.Thread(
+            target=lambda: user_locked.append(user_lock.acquire())
+        )
+        user.start()
+        (tmp_path / 'base').rmdir()
+        assert os.path.isfile(evict_lock.lock_file)
+        evict_lock.release()
+        user.join()
+        # the stash was removed while waiting for the lock
+        assert user_locked == [False]
+        assert user_lock.lock is None
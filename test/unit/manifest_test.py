@@ -0,0 +1,152 @@
+import os
+import hashlib
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.manifest import StashManifest
+
+
+class TestStashManifest:
+    def _create_root(self, root, files):
+        for name, data in files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as handle:
+                handle.write(data)
+            os.utime(path, ns=(0, 0))
+
+    def test_from_root_save_load(self, tmp_path):
+        root = str(tmp_path / 'root')
+        self._create_root(
+            root, {'etc/conf': 'conf', 'dev/null': '', 'proc/1/stat': ''}
+        )
+        os.symlink('etc/conf', os.path.join(root, 'conf'))
+        os.mkfifo(os.path.join(root, 'fifo'))
+        manifest = StashManifest.from_root(root, ['dev/*', 'proc/*'])
+        assert sorted(manifest.entries) == [
+            'conf', 'dev', 'etc', 'etc/conf', 'fifo', 'proc'
+        ]
+        assert manifest.entries['etc/conf'][0] == 'f'
+        conf_stat = os.lstat(os.path.join(root, 'etc/conf'))
+        assert manifest.entries['etc/conf'][4:] == [
+            4, 0, hashlib.sha256(b'conf').hexdigest(), '',
+            conf_stat.st_ino, conf_stat.st_ctime_ns
+        ]
+        assert manifest.get_checksum('etc/conf') == \
+            hashlib.sha256(b'conf').hexdigest()
+        assert manifest.get_checksum('etc') is None
+        assert manifest.get_checksum('missing') is None
+        assert manifest.entries['conf'][0] == 'l'
+        assert manifest.entries['conf'][6] == 'etc/conf'
+        assert manifest.entries['fifo'][0] == 'o'
+        assert manifest.entries['etc'][0] == 'd'
+        manifest_file = str(tmp_path / 'root.manifest')
+        manifest.save(manifest_file)
+        # saving twice replaces the former manifest and
+        # leftovers of an interrupted save are dropped
+        with open(f'{manifest_file}.{os.getpid()}', 'w'):
+            pass
+        manifest.save(manifest_file)
+        loaded = StashManifest.load(manifest_file)
+        assert loaded.entries == manifest.entries
+        assert loaded.meta == manifest.meta
+        assert StashManifest.load(str(tmp_path / 'missing')) is None
+        with open(manifest_file, 'w') as invalid:
+            invalid.write('{"json": "manifest"}')
+        assert StashManifest.load(manifest_file) is None
+
+    def test_from_root_reuses_checksums(self, tmp_path):
+        root = str(tmp_path / 'root')
+        self._create_root(root, {'a': 'a', 'b': 'b', 'c': 'c'})
+        with patch('time.time_ns', return_value=2**62):
+            previous = StashManifest.from_root(root)
+        # replaced content with restored mtime is detected
+        with open(os.path.join(root, 'b.new'), 'w') as handle:
+            handle.write('x')
+        os.utime(os.path.join(root, 'b.new'), ns=(0, 0))
+        os.replace(os.path.join(root, 'b.new'), os.path.join(root, 'b'))
+        with patch.object(
+            StashManifest, 'get_file_checksum', return_value='new'
+        ) as mock_get_file_checksum:
+            manifest = StashManifest.from_root(root, previous=previous)
+        mock_get_file_checksum.assert_called_once_with(
+            os.path.join(root, 'b')
+        )
+        assert manifest.entries['a'] == previous.entries['a']
+        assert manifest.entries['b'][6] == 'new'
+        # entries changed after the manifest was created are hashed again
+        previous.meta['created_ns'] = '0'
+        with patch.object(
+            StashManifest, 'get_file_checksum', return_value='new'
+        ) as mock_get_file_checksum:
+            StashManifest.from_root(root, previous=previous)
+        assert mock_get_file_checksum.call_count == 3
+        # checksums of a root tree on another device are not reused
+        previous.meta['device'] = 'other'
+        with patch.object(
+            StashManifest, 'get_file_checksum', return_value='new'
+        ) as mock_get_file_checksum:
+            StashManifest.from_root(root, previous=previous)
+        assert mock_get_file_checksum.call_count == 3
+
+    def test_diff(self):
+        previous = StashManifest(
+            {
+                'etc': ['d', 16877, 0, 0, 4096, 1, '', '', 1, 1],
+                'etc/conf': ['f', 33188, 0, 0, 1, 1, 'x', '', 2, 1],
+                'etc/gone': ['f', 33188, 0, 0, 1, 1, 'y', '', 3, 1],
+                'etc/attr': ['f', 33188, 0, 0, 1, 1, 'y', '', 7, 1],
+            }
+        )
+        manifest = StashManifest(
+            {
+                'etc': ['d', 16877, 0, 0, 4096, 1, '', '', 4, 2],
+                'etc/conf': ['f', 33188, 0, 0, 1, 2, 'z', '', 5, 2],
+                'etc/new': ['f', 33188, 0, 0, 1, 1, 'y', '', 6, 2],
+                'etc/attr': ['f', 33188, 0, 0, 1, 1, 'y', 'a', 7, 2],
+            }
+        )
+        assert manifest.diff(previous) == (
+            ['etc/attr', 'etc/conf', 'etc/new'], ['etc/gone']
+        )
+
+    def test_get_deleted(self):
+        entry = ['f', 33188, 0, 0, 1, 1, 'x', '', 1, 1]
+        base = StashManifest(
+            {
+                'etc': entry, 'etc/app': entry, 'etc/app/conf': entry,
+                'etc/app-data': entry, 'etc/motd': entry,
+                'usr': entry, 'usr/share': entry, 'usr/share/doc': entry,
+                'usr/share/doc/README': entry
+            }
+        )
+        app = StashManifest({'etc': entry, 'etc/motd': entry, 'opt': entry})
+        manifest = StashManifest(
+            {'etc': entry, 'usr': entry, 'usr/share': entry, 'opt': entry}
+        )
+        assert manifest.get_deleted(
+            [base, app], ['usr/share/doc']
+        ) == ['etc/app', 'etc/app-data', 'etc/motd']
+        assert manifest.get_deleted([]) == []
+
+    def test_diff_xattrs(self, tmp_path):
+        root = str(tmp_path / 'root')
+        self._create_root(root, {'bin/tool': 'tool', 'etc/conf': 'conf'})
+        os.symlink('bin/tool', os.path.join(root, 'tool'))
+        previous = StashManifest.from_root(root)
+        tool = os.path.join(root, 'bin/tool')
+        os.setxattr(tool, 'user.stash', b'value')
+        manifest = StashManifest.from_root(root, previous=previous)
+        assert manifest.diff(previous) == (['bin/tool'], [])
+        assert manifest.entries['bin/tool'][:7] == \
+            previous.entries['bin/tool'][:7]
+        # attributes not kept in the layers are ignored
+        listxattr = os.listxattr
+        with patch(
+            'os.listxattr', side_effect=lambda path, follow_symlinks:
+            listxattr(path, follow_symlinks=False) + ['security.selinux']
+        ):
+            same = StashManifest.from_root(root, previous=manifest)
+        assert same.diff(manifest) == ([], [])
+        with patch('os.listxattr', side_effect=OSError('not supported')):
+            unsupported = StashManifest.from_root(root)
+        assert unsupported.entries['bin/tool'][7] == ''
@@ -0,0 +1,293 @@
+import os
+from contextlib import contextmanager
+from unittest.mock import (
+    patch, call, ANY
+)
+
+from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+from kiwi_stackbuild_plugin.checkpoint import StackCheckpoint
+from kiwi_stackbuild_plugin.merge import StackMerge
+from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+from kiwi_stackbuild_plugin.path_filter import StashPathFilter
+
+
+class TestStackMerge:
+    def setup(self):
+        self.reflink_patch = patch(
+            'kiwi_stackbuild_plugin.merge.StackReflink.is_supported',
+            return_value=False
+        )
+        self.reflink_patch.start()
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def teardown_method(self, cls):
+        self.reflink_patch.stop()
+
+    def _create(self, root, files=(), dirs=()):
+        for name in dirs:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+        for name in files:
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as data:
+                data.write(name)
+
+    def test_get_plan(self, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        site = str(tmp_path / 'site')
+        self._create(
+            base, files=['usr/bin/a', 'usr/bin/b', 'etc/conf', 'opt/x/y']
+        )
+        self._create(
+            app, files=['usr/bin/b', 'etc/conf/app', 'opt/x']
+        )
+        self._create(
+            site, files=['usr/bin/b'], dirs=['srv']
+        )
+        os.symlink('usr/bin', os.path.join(site, 'bin'))
+        merge = StackMerge([base, app, site])
+        plan = [sorted(paths) for paths in merge.get_plan()]
+        assert plan == [
+            ['usr/bin/a'],
+            ['etc', 'etc/conf', 'etc/conf/app', 'opt', 'opt/x'],
+            ['bin', 'srv', 'usr', 'usr/bin', 'usr/bin/b']
+        ]
+        # plan is computed only once
+        assert merge.get_plan() is merge.get_plan()
+
+    def test_get_plan_one_file_system(self, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        self._create(base, files=['srv/data/old', 'etc/conf'])
+        self._create(app, files=['srv/data/new', 'etc/app'])
+        scandir = os.scandir
+
+        class MountPoint:
+            def __init__(self, entry):
+                self.name = entry.name
+                self.is_dir = entry.is_dir
+                self.entry_stat = entry.stat(follow_symlinks=False)
+
+            def stat(self, follow_symlinks=True):
+                mounted_device = (self.entry_stat.st_dev + 1,)
+                return os.stat_result(
+                    self.entry_stat[:2] + mounted_device + self.entry_stat[3:10]
+                )
+
+        @contextmanager
+        def scandir_mounted(path):
+            # srv/data is a mount point in both stash roots
+            with scandir(path) as entries:
+                yield [
+                    MountPoint(entry) if entry.name == 'data' else entry
+                    for entry in entries
+                ]
+
+        with patch('os.scandir', side_effect=scandir_mounted):
+            plan = [sorted(paths) for paths in StackMerge(
+                [base, app]
+            ).get_plan()]
+        assert plan == [
+            ['etc/conf'], ['etc', 'etc/app', 'srv', 'srv/data']
+        ]
+
+    def test_get_plan_deleted(self, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        site = str(tmp_path / 'site')
+        self._create(
+            base, files=[
+                'usr/bin/a', 'usr/bin/b', 'etc/conf/base', 'etc/motd',
+                'opt/x/y', 'srv/www/index'
+            ]
+        )
+        self._create(app, files=['etc/conf/app', 'srv/www/new'])
+        self._create(site, files=['usr/bin/c'])
+        merge = StackMerge(
+            [base, app, site], deleted={
+                app: ['etc/conf', 'opt/x', 'srv/www', 'usr/bin/a'],
+                site: ['etc/motd']
+            }
+        )
+        plan = [sorted(paths) for paths in merge.get_plan()]
+        # deleted paths provided by an upper stash are kept, a
+        # deleted directory has no content of the lower stashes
+        assert plan == [
+            ['opt', 'usr/bin/b'],
+            [
+                'etc', 'etc/conf', 'etc/conf/app', 'srv', 'srv/www',
+                'srv/www/new'
+            ],
+            ['usr', 'usr/bin', 'usr/bin/c']
+        ]
+        assert merge.deletions == 5
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    def test_sync_data_deleted(self, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        self._create(base, files=['etc/conf', 'etc/obsolete'])
+        self._create(app, dirs=['etc'])
+        merge = StackMerge([base, app], deleted={app: ['etc/obsolete']})
+        merge.sync_data('/image-root')
+        assert merge.deletions == 1
+        assert merge.get_plan() == [['etc/conf'], ['etc']]
+        assert mock_DataSync.call_args_list == [
+            call(base + os.sep, '/image-root'),
+            call(app + os.sep, '/image-root')
+        ]
+
+    def test_get_plan_path_filter(self, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        self._create(
+            base, files=['usr/bin/a', 'usr/share/doc/a', 'etc/conf', 'srv/x']
+        )
+        self._create(app, files=['usr/share/doc/b', 'usr/bin/b', 'etc/app'])
+        plan = StackMerge(
+            [base, app], StashPathFilter(['usr', 'etc'], ['usr/share/doc'])
+        ).get_plan()
+        assert [sorted(paths) for paths in plan] == [
+            ['etc/conf', 'usr/bin/a'],
+            ['etc', 'etc/app', 'usr', 'usr/bin', 'usr/bin/b', 'usr/share']
+        ]
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    def test_sync_data(self, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        self._create(base, files=['etc/conf'])
+        self._create(app, files=['etc/conf'])
+        merge = StackMerge([base, app])
+        merge.sync_data('/image-root')
+        mock_DataSync.assert_called_once_with(
+            app + os.sep, '/image-root'
+        )
+        mock_DataSync.return_value.sync_data.assert_called_once_with(
+            options=[
+                '--archive', '--hard-links', '--xattrs', '--acls',
+                '--one-file-system', '--inplace',
+                '--from0', ANY
+            ]
+        )
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    def test_sync_data_checkpoint(self, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        lib = str(tmp_path / 'lib')
+        app = str(tmp_path / 'app')
+        self._create(base, files=['usr/base'])
+        self._create(lib, files=['etc/conf'])
+        self._create(app, files=['etc/conf'])
+        checkpoint = StackCheckpoint(str(tmp_path / 'checkpoint'))
+        checkpoint.start([('base', 'a'), ('lib', 'b'), ('app', 'c')], [])
+        checkpoint.set_applied(0)
+        StackMerge([base, lib, app]).sync_data(
+            '/image-root', checkpoint=checkpoint
+        )
+        mock_DataSync.assert_called_once_with(
+            app + os.sep, '/image-root'
+        )
+        assert checkpoint.is_complete()
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    def test_sync_data_files_from(self, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        self._create(base, files=['etc/conf'])
+        files_from = []
+
+        def sync_data(options):
+            with open(options[-1].split('=', 1)[1], 'rb') as files:
+                files_from.append(sorted(files.read().split(b'\0')))
+
+        mock_DataSync.return_value.sync_data.side_effect = sync_data
+        StackMerge([base]).sync_data('/image-root')
+        assert mock_DataSync.call_args_list == [
+            call(base + os.sep, '/image-root')
+        ]
+        assert files_from == [[b'etc', b'etc/conf']]
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    def test_sync_data_metrics(self, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        self._create(base, files=['etc/conf', 'etc/base'])
+        self._create(app, files=['etc/conf'])
+        metrics = StackBuildMetrics('stackbuild', count_io=True)
+        StackMerge([base, app]).sync_data('/image-root', metrics)
+        report = metrics.get_report()
+        assert [
+            (phase['name'], phase.get('stash_root'))
+            for phase in report['phases']
+        ] == [('merge_plan', None), ('sync', base), ('sync', app)]
+        assert report['counters'] == {
+            'synced_files': 2, 'synced_bytes': 8 + 8
+        }
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    @patch('kiwi_stackbuild_plugin.merge.StackReflink')
+    def test_sync_data_reflink(self, mock_StackReflink, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        self._create(base, files=['etc/conf', 'etc/base'])
+        self._create(app, files=['etc/conf'])
+        mock_StackReflink.is_supported.side_effect = [True, False]
+        metrics = StackBuildMetrics('stackbuild')
+        StackMerge([base, app]).sync_data('/image-root', metrics)
+        mock_StackReflink.assert_called_once_with(base)
+        mock_StackReflink.return_value.clone.assert_called_once_with(
+            '/image-root', ['etc/base'], None
+        )
+        mock_DataSync.assert_called_once_with(app + os.sep, '/image-root')
+        assert [
+            phase.get('method') for phase in metrics.get_report()['phases']
+        ] == [None, 'reflink', 'rsync']
+
+    def test_sync_data_parallel_copy(self, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        target = str(tmp_path / 'target')
+        self._create(base, files=['etc/conf', 'etc/base'])
+        self._create(app, files=['etc/conf'])
+        with open(os.path.join(app, 'etc', 'conf'), 'w') as data:
+            data.write('app')
+        metrics = StackBuildMetrics('stackbuild')
+        StackMerge([base, app], sync_jobs=2).sync_data(target, metrics)
+        assert sorted(os.listdir(os.path.join(target, 'etc'))) == [
+            'base', 'conf'
+        ]
+        with open(os.path.join(target, 'etc', 'conf')) as data:
+            assert data.read() == 'app'
+        assert [
+            phase.get('method') for phase in metrics.get_report()['phases']
+        ] == [None, 'copy', 'copy']
+
+    @patch('kiwi_stackbuild_plugin.merge.DataSync')
+    def test_sync_data_link_groups(self, mock_DataSync, tmp_path):
+        base = str(tmp_path / 'base')
+        app = str(tmp_path / 'app')
+        target = str(tmp_path / 'target')
+        self._create(base, files=['a/__init__.py', 'b/__init__.py'])
+        self._create(app, files=['etc/conf'])
+        for package in ('a', 'b'):
+            init = os.path.join(base, package, '__init__.py')
+            open(init, 'w').close()
+            os.utime(init, ns=(0, 0))
+        store = StashBlobStore(str(tmp_path / 'stash'))
+        store.add_root('base', base)
+        stash_root = store.get_root('base')
+        # the blob store root is copied even without sync jobs
+        # because rsync would hardlink the identical files
+        StackMerge(
+            [stash_root, app], link_groups={
+                stash_root: store.get_link_groups('base')
+            }
+        ).sync_data(target)
+        assert not os.path.samefile(
+            os.path.join(target, 'a', '__init__.py'),
+            os.path.join(target, 'b', '__init__.py')
+        )
+        mock_DataSync.assert_called_once_with(app + os.sep, target)
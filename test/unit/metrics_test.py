@@ -0,0 +1,58 @@
+import os
+import json
+from pytest import raises
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.metrics import StackBuildMetrics
+
+
+class TestStackBuildMetrics:
+    @patch('time.monotonic')
+    def test_phase(self, mock_monotonic):
+        mock_monotonic.side_effect = [0, 1, 3, 10, 14, 20]
+        metrics = StackBuildMetrics('stackbuild')
+        with metrics.phase('mount', stash='base'):
+            pass
+        with raises(ValueError):
+            with metrics.phase('sync'):
+                raise ValueError
+        report = metrics.get_report()
+        assert report['command'] == 'stackbuild'
+        assert report['total_seconds'] == 20
+        assert report['phases'] == [
+            {'stash': 'base', 'name': 'mount', 'seconds': 2},
+            {'name': 'sync', 'seconds': 4}
+        ]
+        assert report['peak_rss_bytes'] > 0
+        assert report['peak_child_rss_bytes'] >= 0
+
+    def test_count_tree(self, tmp_path):
+        os.makedirs(tmp_path / 'etc' / 'conf.d')
+        (tmp_path / 'etc' / 'conf').write_bytes(b'1234')
+        (tmp_path / 'etc' / 'conf.d' / 'a').write_bytes(b'12')
+        metrics = StackBuildMetrics('stash', count_io=True)
+        metrics.count_tree(str(tmp_path))
+        metrics.count_tree(str(tmp_path), ['etc', 'etc/conf'])
+        assert metrics.get_report()['counters'] == {
+            'synced_files': 3, 'synced_bytes': 10
+        }
+
+    def test_count_tree_disabled(self, tmp_path):
+        metrics = StackBuildMetrics('stash')
+        metrics.count_tree(str(tmp_path / 'none'))
+        assert metrics.get_report()['counters'] == {}
+
+    def test_add_saved(self):
+        metrics = StackBuildMetrics('stackbuild')
+        metrics.add_saved({'hardlink_bytes': 0, 'sparse_bytes': 0})
+        metrics.add_saved({'hardlink_bytes': 4, 'sparse_bytes': 4096})
+        assert metrics.get_report()['counters'] == {
+            'hardlink_saved_bytes': 4, 'sparse_saved_bytes': 4096
+        }
+
+    def test_write(self, tmp_path):
+        metrics = StackBuildMetrics('stash')
+        metrics.add('synced_files', 2)
+        metrics.write(str(tmp_path / 'report.json'))
+        with open(tmp_path / 'report.json') as report:
+            assert json.load(report)['counters'] == {'synced_files': 2}
@@ -0,0 +1,80 @@
+import threading
+from unittest.mock import Mock
+
+from kiwi_stackbuild_plugin.mount_pool import StackMountPool
+
+
+class TestStackMountPool:
+    def setup(self):
+        self.base = ('base', '', 'id-base')
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def test_acquire_release(self):
+        pool = StackMountPool()
+        mount = Mock(return_value='/mount/base')
+        umount = Mock()
+        other_umount = Mock()
+        assert pool.acquire(self.base, mount, umount) == '/mount/base'
+        assert pool.acquire(self.base, mount, other_umount) == '/mount/base'
+        mount.assert_called_once_with()
+        assert pool.get_references() == {self.base: 2}
+        pool.release(self.base)
+        assert not umount.called
+        pool.release(self.base)
+        # the stash is umounted by the job which mounted it
+        umount.assert_called_once_with()
+        assert not other_umount.called
+        assert pool.get_references() == {}
+        pool.release(self.base)
+        umount.assert_called_once_with()
+
+    def test_acquire_other_image(self):
+        pool = StackMountPool()
+        assert pool.acquire(
+            self.base, Mock(return_value='/mount/base'), Mock()
+        ) == '/mount/base'
+        # same stash name, other registry or updated image
+        for stash_key in (
+            ('base', 'registry.uri', 'id-base'), ('base', '', 'id-new')
+        ):
+            assert pool.acquire(
+                stash_key, Mock(return_value=f'/mount/{stash_key[2]}'), Mock()
+            ) == f'/mount/{stash_key[2]}'
+        assert pool.get_references() == {
+            self.base: 1, ('base', 'registry.uri', 'id-base'): 1,
+            ('base', '', 'id-new'): 1
+        }
+
+    def test_acquire_concurrent(self):
+        pool = StackMountPool()
+        mounted = threading.Event()
+        mount_calls = []
+
+        def mount():
+            mount_calls.append('base')
+            mounted.wait(1)
+            return '/mount/base'
+
+        threads = [
+            threading.Thread(
+                target=pool.acquire, args=(self.base, mount, Mock())
+            ) for count in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        mounted.set()
+        for thread in threads:
+            thread.join()
+        assert mount_calls == ['base']
+        assert pool.get_references() == {self.base: 4}
+
+    def test_acquire_mount_failed(self):
+        pool = StackMountPool()
+        mount = Mock(side_effect=Exception)
+        try:
+            pool.acquire(self.base, mount, Mock())
+        except Exception:
+            pass
+        assert pool.get_references() == {}
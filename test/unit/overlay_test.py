@@ -0,0 +1,60 @@
+from unittest.mock import (
+    patch, call, mock_open
+)
+
+from kiwi_stackbuild_plugin.overlay import StackOverlay
+
+
+class TestStackOverlay:
+    def setup(self):
+        self.overlay = StackOverlay(
+            ['/lower/a', '/lower/b'], '/target/build/image-root',
+            '/target/build/overlay'
+        )
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def test_is_supported(self):
+        with patch('builtins.open', mock_open(
+            read_data='nodev\tsysfs\nnodev\toverlay\n'
+        )):
+            assert StackOverlay.is_supported() is True
+        with patch('builtins.open', mock_open(
+            read_data='nodev\tsysfs\n\text4\n'
+        )):
+            assert StackOverlay.is_supported() is False
+        with patch('builtins.open') as mock_open_file:
+            mock_open_file.side_effect = OSError
+            assert StackOverlay.is_supported() is False
+
+    @patch('kiwi_stackbuild_plugin.overlay.Path.create')
+    @patch('kiwi_stackbuild_plugin.overlay.Command.run')
+    def test_mount_umount(self, mock_Command_run, mock_Path_create):
+        with self.overlay as overlay:
+            overlay.mount()
+        assert mock_Path_create.call_args_list == [
+            call('/target/build/overlay/upper'),
+            call('/target/build/overlay/work'),
+            call('/target/build/image-root')
+        ]
+        assert mock_Command_run.call_args_list == [
+            call(
+                [
+                    'mount', '-t', 'overlay', 'overlay',
+                    '/target/build/image-root', '-o',
+                    'lowerdir=/lower/b:/lower/a,'
+                    'upperdir=/target/build/overlay/upper,'
+                    'workdir=/target/build/overlay/work'
+                ]
+            ),
+            call(
+                ['umount', '/target/build/image-root'],
+                raise_on_error=False
+            )
+        ]
+
+    @patch('kiwi_stackbuild_plugin.overlay.Command.run')
+    def test_umount_not_mounted(self, mock_Command_run):
+        self.overlay.umount()
+        assert not mock_Command_run.called
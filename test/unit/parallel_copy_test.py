@@ -0,0 +1,188 @@
+import os
+import stat
+import shutil
+from pytest import mark
+from unittest.mock import patch
+
+from kiwi.defaults import Defaults
+from kiwi.utils.sync import DataSync
+
+from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+from kiwi_stackbuild_plugin.parallel_copy import StackParallelCopy
+
+
+class TestStackParallelCopy:
+    def _create_root(self, root):
+        os.makedirs(os.path.join(root, 'usr', 'bin'))
+        tool = os.path.join(root, 'usr', 'bin', 'tool')
+        with open(tool, 'w') as data:
+            data.write('tool')
+        os.chmod(tool, 0o750)
+        os.link(tool, os.path.join(root, 'usr', 'bin', 'link'))
+        os.symlink('usr/bin', os.path.join(root, 'bin'))
+        os.mkfifo(os.path.join(root, 'fifo'))
+        os.makedirs(os.path.join(root, 'private'))
+        os.chmod(os.path.join(root, 'private'), 0o700)
+        with open(os.path.join(root, 'sparse'), 'wb') as data:
+            data.seek(1024 * 1024)
+            data.write(b'data')
+            data.truncate(4 * 1024 * 1024)
+        for name in range(5):
+            with open(os.path.join(root, 'usr', f'file{name}'), 'w') as data:
+                data.write(f'file{name}')
+        for path in ('usr/bin/tool', 'fifo', 'private', 'usr/bin', 'usr'):
+            os.utime(os.path.join(root, path), ns=(10, 10))
+
+    def test_copy(self, tmp_path):
+        root = str(tmp_path / 'root')
+        target = str(tmp_path / 'target')
+        self._create_root(root)
+        os.utime(os.path.join(root, 'usr'), ns=(10, 10))
+        with patch(
+            'kiwi_stackbuild_plugin.parallel_copy.WORK_UNIT_FILES', 2
+        ):
+            stats = StackParallelCopy(root, 4).copy(target)
+        assert stats['hardlink_bytes'] == 4
+        assert stats['sparse_bytes'] >= 4 * 1024 * 1024 - 4096
+        assert sorted(os.listdir(target)) == [
+            'bin', 'fifo', 'private', 'sparse', 'usr'
+        ]
+        tool = os.path.join(target, 'usr', 'bin', 'tool')
+        with open(tool) as data:
+            assert data.read() == 'tool'
+        assert stat.S_IMODE(os.lstat(tool).st_mode) == 0o750
+        assert os.lstat(tool).st_mtime_ns == 10
+        assert os.path.samefile(tool, os.path.join(target, 'usr/bin/link'))
+        assert os.readlink(os.path.join(target, 'bin')) == 'usr/bin'
+        assert stat.S_ISFIFO(os.lstat(os.path.join(target, 'fifo')).st_mode)
+        private = os.lstat(os.path.join(target, 'private'))
+        assert stat.S_IMODE(private.st_mode) == 0o700
+        assert private.st_mtime_ns == 10
+        assert os.lstat(os.path.join(target, 'usr')).st_mtime_ns == 10
+        for name in range(5):
+            with open(os.path.join(target, 'usr', f'file{name}')) as data:
+                assert data.read() == f'file{name}'
+        with open(os.path.join(root, 'sparse'), 'rb') as source_data:
+            with open(os.path.join(target, 'sparse'), 'rb') as data:
+                assert data.read() == source_data.read()
+        assert os.lstat(os.path.join(target, 'sparse')).st_blocks <= \
+            os.lstat(os.path.join(root, 'sparse')).st_blocks
+
+    def test_copy_link_groups(self, tmp_path):
+        root = str(tmp_path / 'root')
+        target = str(tmp_path / 'target')
+        self._create_root(root)
+        for package in ('a', 'b'):
+            init = os.path.join(root, package, '__init__.py')
+            os.makedirs(os.path.dirname(init))
+            open(init, 'w').close()
+            os.utime(init, ns=(10, 10))
+        # identical files share a blob inode in the blob store root
+        store = StashBlobStore(str(tmp_path / 'stash'))
+        store.add_root('base', root)
+        stash_root = store.get_root('base')
+        assert os.path.samefile(
+            os.path.join(stash_root, 'a', '__init__.py'),
+            os.path.join(stash_root, 'b', '__init__.py')
+        )
+        stats = StackParallelCopy(stash_root, 2).copy(
+            target, link_groups=store.get_link_groups('base')
+        )
+        assert stats['hardlink_bytes'] == 4
+        init_a = os.path.join(target, 'a', '__init__.py')
+        init_b = os.path.join(target, 'b', '__init__.py')
+        assert not os.path.samefile(init_a, init_b)
+        with open(init_a, 'w') as data:
+            data.write('changed')
+        assert os.lstat(init_b).st_size == 0
+        tool = os.path.join(target, 'usr', 'bin', 'tool')
+        assert os.path.samefile(tool, os.path.join(target, 'usr/bin/link'))
+
+    def test_copy_paths(self, tmp_path):
+        root = str(tmp_path / 'root')
+        target = str(tmp_path / 'target')
+        self._create_root(root)
+        os.makedirs(os.path.join(target, 'usr', 'bin'))
+        for name in ('tool', 'link'):
+            with open(os.path.join(target, 'usr', 'bin', name), 'w') as data:
+                data.write('outdated')
+        StackParallelCopy(root).copy(
+            target, ['usr/bin/tool', 'usr/bin/link', 'private']
+        )
+        assert sorted(os.listdir(target)) == ['private', 'usr']
+        tool = os.path.join(target, 'usr', 'bin', 'tool')
+        with open(tool) as data:
+            assert data.read() == 'tool'
+        assert os.path.samefile(tool, os.path.join(target, 'usr/bin/link'))
+
+    def test_get_work_units(self):
+        small = os.stat_result((0,) * 6 + (1,) + (0,) * 3)
+        large = os.stat_result((0,) * 6 + (64 * 1024 * 1024,) + (0,) * 3)
+        with patch(
+            'kiwi_stackbuild_plugin.parallel_copy.WORK_UNIT_FILES', 2
+        ):
+            assert list(StackParallelCopy._get_work_units([
+                ('a', small), ('b', small), ('c', large), ('d', small)
+            ])) == [
+                [('a', small), ('b', small)], [('c', large)], [('d', small)]
+            ]
+
+    @mark.skipif(not shutil.which('rsync'), reason='rsync not installed')
+    def test_copy_same_as_rsync(self, tmp_path):
+        root = str(tmp_path / 'root')
+        self._create_root(root)
+        os.mknod(
+            os.path.join(root, 'null'), stat.S_IFCHR | 0o666,
+            os.makedev(1, 3)
+        )
+        try:
+            os.setxattr(
+                os.path.join(root, 'usr', 'bin', 'tool'),
+                'user.stash', b'tool'
+            )
+        except OSError:
+            # xattrs not supported by the test filesystem
+            pass
+        os.utime(os.path.join(root, 'usr', 'bin'), ns=(10, 10))
+        copy_target = str(tmp_path / 'copy')
+        rsync_target = str(tmp_path / 'rsync')
+        StackParallelCopy(root, 4).copy(copy_target)
+        os.makedirs(rsync_target)
+        DataSync(root + os.sep, rsync_target).sync_data(
+            options=Defaults.get_sync_options()
+        )
+        assert self._get_tree(copy_target) == self._get_tree(rsync_target)
+
+    def _get_tree(self, root):
+        # type, metadata, content, xattrs and hardlink group of
+        # every entry, the hardlink group is the first path found
+        tree = {}
+        inodes = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for entry in sorted(dirnames + filenames):
+                path = os.path.join(dirpath, entry)
+                rel_path = os.path.relpath(path, root)
+                entry_stat = os.lstat(path)
+                data = None
+                if stat.S_ISREG(entry_stat.st_mode):
+                    with open(path, 'rb') as entry_data:
+                        data = entry_data.read()
+                elif stat.S_ISLNK(entry_stat.st_mode):
+                    data = os.readlink(path)
+                tree[rel_path] = (
+                    entry_stat.st_mode, entry_stat.st_uid,
+                    entry_stat.st_gid, entry_stat.st_rdev,
+                    None if stat.S_ISLNK(entry_stat.st_mode)
+                    else entry_stat.st_mtime_ns,
+                    data, sorted(
+                        (name, os.getxattr(path, name))
+                        for name in os.listxattr(path, follow_symlinks=False)
+                    ) if not stat.S_ISLNK(entry_stat.st_mode) else None,
+                    self._get_link_group(inodes, rel_path, entry_stat)
+                )
+        return tree
+
+    def _get_link_group(self, inodes, rel_path, entry_stat):
+        if stat.S_ISDIR(entry_stat.st_mode) or entry_stat.st_nlink == 1:
+            return None
+        return inodes.setdefault(entry_stat.st_ino, rel_path)
@@ -0,0 +1,39 @@
+from kiwi_stackbuild_plugin.path_filter import StashPathFilter
+
+
+class TestStashPathFilter:
+    def test_no_filter(self):
+        path_filter = StashPathFilter()
+        assert not path_filter
+        assert path_filter.is_selected('usr/bin/tool', False)
+        assert path_filter.get_key_data() == []
+
+    def test_exclude(self):
+        path_filter = StashPathFilter(
+            exclude_list=['/usr/share/doc/', 'var/cache/*']
+        )
+        assert path_filter
+        assert path_filter.is_selected('usr/share', True)
+        assert not path_filter.is_selected('usr/share/doc', True)
+        assert not path_filter.is_selected('usr/share/doc/README', False)
+        assert path_filter.is_selected('var/cache', True)
+        assert not path_filter.is_selected('var/cache/zypp', True)
+
+    def test_include(self):
+        path_filter = StashPathFilter(
+            include_list=['etc', 'usr/lib*/firmware'],
+            exclude_list=['etc/ssh']
+        )
+        assert path_filter.is_selected('etc', True)
+        assert path_filter.is_selected('etc/conf', False)
+        assert not path_filter.is_selected('etc/ssh/key', False)
+        # parent directories leading to an include are selected
+        assert path_filter.is_selected('usr', True)
+        assert path_filter.is_selected('usr/lib64', True)
+        assert not path_filter.is_selected('usr/bin', True)
+        assert not path_filter.is_selected('usr/lib64', False)
+        assert path_filter.is_selected('usr/lib64/firmware/blob', False)
+        assert not path_filter.is_selected('var', True)
+        assert path_filter.get_key_data() == [
+            'include:etc', 'include:usr/lib*/firmware', 'exclude:etc/ssh'
+        ]
@@ -0,0 +1,136 @@
+import os
+import stat
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.blob_store import StashBlobStore
+from kiwi_stackbuild_plugin.reflink import (
+    StackReflink, FICLONE
+)
+
+
+def fake_ficlone(target_fd, request, source_fd):
+    # the test filesystem may not support reflinks, copy the data
+    assert request == FICLONE
+    os.lseek(source_fd, 0, os.SEEK_SET)
+    while True:
+        data = os.read(source_fd, 65536)
+        if not data:
+            break
+        os.write(target_fd, data)
+
+
+class TestStackReflink:
+    def _create_root(self, root):
+        os.makedirs(os.path.join(root, 'usr', 'bin'))
+        tool = os.path.join(root, 'usr', 'bin', 'tool')
+        with open(tool, 'w') as data:
+            data.write('tool')
+        os.chmod(tool, 0o750)
+        os.link(tool, os.path.join(root, 'usr', 'bin', 'link'))
+        os.symlink('usr/bin', os.path.join(root, 'bin'))
+        os.mkfifo(os.path.join(root, 'fifo'))
+        os.makedirs(os.path.join(root, 'private'))
+        os.chmod(os.path.join(root, 'private'), 0o700)
+        for path in ('usr/bin/tool', 'fifo', 'private', 'usr/bin', 'usr'):
+            os.utime(os.path.join(root, path), ns=(10, 10))
+
+    @patch('kiwi_stackbuild_plugin.reflink.fcntl.ioctl')
+    def test_is_supported(self, mock_ioctl, tmp_path):
+        root = str(tmp_path / 'root')
+        target = tmp_path / 'target'
+        target.mkdir()
+        assert not StackReflink.is_supported(root, str(target))
+        self._create_root(root)
+        mock_ioctl.side_effect = fake_ficlone
+        assert StackReflink.is_supported(root, str(target))
+        mock_ioctl.side_effect = OSError('Operation not supported')
+        assert not StackReflink.is_supported(root, str(target))
+        assert os.listdir(target) == []
+
+    @patch('kiwi_stackbuild_plugin.reflink.fcntl.ioctl')
+    def test_clone(self, mock_ioctl, tmp_path):
+        mock_ioctl.side_effect = fake_ficlone
+        root = str(tmp_path / 'root')
+        target = str(tmp_path / 'target')
+        self._create_root(root)
+        StackReflink(root).clone(target)
+        assert sorted(os.listdir(target)) == ['bin', 'fifo', 'private', 'usr']
+        tool = os.path.join(target, 'usr', 'bin', 'tool')
+        with open(tool) as data:
+            assert data.read() == 'tool'
+        assert stat.S_IMODE(os.lstat(tool).st_mode) == 0o750
+        assert os.lstat(tool).st_mtime_ns == 10
+        assert os.path.samefile(tool, os.path.join(target, 'usr/bin/link'))
+        assert os.readlink(os.path.join(target, 'bin')) == 'usr/bin'
+        assert stat.S_ISFIFO(os.lstat(os.path.join(target, 'fifo')).st_mode)
+        private = os.lstat(os.path.join(target, 'private'))
+        assert stat.S_IMODE(private.st_mode) == 0o700
+        assert private.st_mtime_ns == 10
+        assert os.lstat(os.path.join(target, 'usr')).st_mtime_ns == 10
+
+    @patch('kiwi_stackbuild_plugin.reflink.fcntl.ioctl')
+    def test_clone_link_groups(self, mock_ioctl, tmp_path):
+        mock_ioctl.side_effect = fake_ficlone
+        root = str(tmp_path / 'root')
+        target = str(tmp_path / 'target')
+        self._create_root(root)
+        for package in ('a', 'b'):
+            init = os.path.join(root, package, '__init__.py')
+            os.makedirs(os.path.dirname(init))
+            open(init, 'w').close()
+            os.utime(init, ns=(10, 10))
+        # identical files share a blob inode in the blob store root
+        store = StashBlobStore(str(tmp_path / 'stash'))
+        store.add_root('base', root)
+        stash_root = store.get_root('base')
+        StackReflink(stash_root).clone(
+            target, link_groups=store.get_link_groups('base')
+        )
+        init_a = os.path.join(target, 'a', '__init__.py')
+        init_b = os.path.join(target, 'b', '__init__.py')
+        assert not os.path.samefile(init_a, init_b)
+        assert os.lstat(init_a).st_nlink == 1
+        tool = os.path.join(target, 'usr', 'bin', 'tool')
+        assert os.path.samefile(tool, os.path.join(target, 'usr/bin/link'))
+
+    @patch('kiwi_stackbuild_plugin.reflink.fcntl.ioctl')
+    def test_clone_paths(self, mock_ioctl, tmp_path):
+        mock_ioctl.side_effect = fake_ficlone
+        root = str(tmp_path / 'root')
+        target = str(tmp_path / 'target')
+        self._create_root(root)
+        os.makedirs(os.path.join(target, 'usr', 'bin'))
+        with open(os.path.join(target, 'usr', 'bin', 'tool'), 'w') as data:
+            data.write('outdated')
+        StackReflink(root).clone(target, ['usr/bin/tool', 'private'])
+        assert sorted(os.listdir(target)) == ['private', 'usr']
+        with open(os.path.join(target, 'usr', 'bin', 'tool')) as data:
+            assert data.read() == 'tool'
+
+    @patch('kiwi_stackbuild_plugin.reflink.fcntl.ioctl')
+    def test_clone_one_file_system(self, mock_ioctl, tmp_path):
+        mock_ioctl.side_effect = fake_ficlone
+        root = str(tmp_path / 'root')
+        self._create_root(root)
+        lstat = os.lstat
+
+        def mounted_private(path):
+            path_stat = lstat(path)
+            if path == os.path.join(root, 'private'):
+                return os.stat_result(
+                    path_stat[:2] + (path_stat.st_dev + 1,) + path_stat[3:10],
+                    {
+                        'st_atime_ns': path_stat.st_atime_ns,
+                        'st_mtime_ns': path_stat.st_mtime_ns
+                    }
+                )
+            return path_stat
+
+        with open(os.path.join(root, 'private', 'data'), 'w') as data:
+            data.write('data')
+        target = str(tmp_path / 'target')
+        with patch('os.lstat', side_effect=mounted_private):
+            StackReflink(root).clone(target)
+        assert os.listdir(os.path.join(target, 'private')) == []
+        with open(os.path.join(target, 'usr', 'bin', 'tool')) as data:
+            assert data.read() == 'tool'
@@ -0,0 +1,118 @@
+import os
+from pytest import raises
+from unittest.mock import patch
+
+from kiwi.exceptions import KiwiCommandError
+
+from kiwi_stackbuild_plugin.root_cache import StackRootCache
+from kiwi_stackbuild_plugin.lock import StashLock
+
+
+class TestStackRootCache:
+    def setup(self):
+        self.digests = ['sha256:base', 'sha256:runtime']
+
+    def setup_method(self, cls):
+        self.setup()
+
+    def _create_root(self, root):
+        (root / 'usr' / 'bin').mkdir(parents=True)
+        (root / 'usr' / 'bin' / 'tool').write_bytes(b'tool')
+        os.link(root / 'usr' / 'bin' / 'tool', root / 'usr' / 'bin' / 'link')
+        os.symlink('tool', root / 'usr' / 'bin' / 'alias')
+
+    def test_get_key(self):
+        key = StackRootCache.get_key(self.digests)
+        assert len(key) == 64
+        assert key == StackRootCache.get_key(list(self.digests))
+        assert key != StackRootCache.get_key(list(reversed(self.digests)))
+
+    def test_add_root_and_materialize(self, tmp_path):
+        root = tmp_path / 'root'
+        self._create_root(root)
+        root_cache = StackRootCache(str(tmp_path / 'stash'))
+        key = root_cache.get_key(self.digests)
+        assert not root_cache.has_root(key)
+        assert not root_cache.materialize(key, str(tmp_path / 'target'))
+        # entry without root, e.g. while being removed
+        os.makedirs(os.path.join(root_cache.cache_dir, key))
+        assert not root_cache.materialize(key, str(tmp_path / 'target'))
+        os.rmdir(os.path.join(root_cache.cache_dir, key))
+        root_cache.add_root(key, str(root))
+        assert root_cache.has_root(key)
+        assert sorted(os.listdir(root_cache.cache_dir)) == [
+            key, f'{key}.lock'
+        ]
+        # an existing entry is kept
+        root_cache.add_root(key, str(tmp_path / 'none'))
+        target = tmp_path / 'target'
+        assert root_cache.materialize(key, str(target))
+        tool = target / 'usr' / 'bin' / 'tool'
+        assert tool.read_bytes() == b'tool'
+        assert os.path.samefile(tool, target / 'usr' / 'bin' / 'link')
+        assert os.readlink(target / 'usr' / 'bin' / 'alias') == 'tool'
+        # the target is a copy, not linked to the cached root
+        assert not os.path.samefile(
+            tool, os.path.join(
+                root_cache.cache_dir, key, 'root', 'usr', 'bin', 'tool'
+            )
+        )
+
+    def test_add_root_concurrent(self, tmp_path):
+        root = tmp_path / 'root'
+        self._create_root(root)
+        root_cache = StackRootCache(str(tmp_path / 'stash'))
+        with patch('os.rename', side_effect=OSError('exists')):
+            root_cache.add_root('key', str(root))
+        assert os.listdir(root_cache.cache_dir) == []
+
+    def test_add_root_failed(self, tmp_path, caplog):
+        root_cache = StackRootCache(str(tmp_path / 'stash'))
+        with patch.object(
+            StackRootCache, '_copy_tree', side_effect=KiwiCommandError('cp')
+        ):
+            root_cache.add_root('key', str(tmp_path / 'root'))
+        assert 'Root cache entry key not added: cp' in caplog.text
+        assert os.listdir(root_cache.cache_dir) == []
+
+    def test_materialize_failed(self, tmp_path):
+        root = tmp_path / 'root'
+        self._create_root(root)
+        root_cache = StackRootCache(str(tmp_path / 'stash'))
+        root_cache.add_root('key', str(root))
+        with patch.object(
+            StackRootCache, '_copy_tree', side_effect=KiwiCommandError('cp')
+        ):
+            with raises(KiwiCommandError):
+                root_cache.materialize('key', str(tmp_path / 'target'))
+        # the entry lock is released
+        entry_lock = StashLock(
+            root_cache.cache_dir, 'key', root_cache.cache_dir
+        )
+        assert entry_lock.acquire(exclusive=True, blocking=False)
+
+    def test_get_entries_and_remove(self, tmp_path):
+        root = tmp_path / 'root'
+        self._create_root(root)
+        root_cache = StackRootCache(str(tmp_path / 'stash'))
+        assert root_cache.get_entries() == []
+        root_cache.add_root('b', str(root))
+        root_cache.add_root('a', str(root))
+        os.makedirs(os.path.join(root_cache.cache_dir, 'incomplete'))
+        os.utime(os.path.join(root_cache.cache_dir, 'a'), (2, 2))
+        os.utime(os.path.join(root_cache.cache_dir, 'b'), (1, 1))
+        assert root_cache.get_entries() == [
+            {'key': 'b', 'size': 12, 'last_used': 1},
+            {'key': 'a', 'size': 12, 'last_used': 2}
+        ]
+        entry_lock = StashLock(
+            root_cache.cache_dir, 'a', root_cache.cache_dir
+        )
+        entry_lock.acquire()
+        assert not root_cache.remove('a')
+        entry_lock.release()
+        assert root_cache.remove('a')
+        # the lock file is kept next to the removed entry
+        assert os.path.isfile(os.path.join(root_cache.cache_dir, 'a.lock'))
+        assert not root_cache.remove('a')
+        assert [entry['key'] for entry in root_cache.get_entries()] == ['b']
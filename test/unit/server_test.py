@@ -0,0 +1,103 @@
+import os
+import json
+import socket
+import threading
+from pytest import raises
+from unittest.mock import Mock
+
+from kiwi_stackbuild_plugin.server import StackBuildServer
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginServerError
+)
+
+
+class TestStackBuildServer:
+    def _request(self, socket_path, data):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(data + b'\n')
+            return json.loads(client.makefile('rb').readline())
+
+    def test_serve(self, tmp_path):
+        socket_path = str(tmp_path / 'stackbuild.sock')
+        job_done = threading.Event()
+        jobs = []
+
+        def new_job(request):
+            if request['args'] == ['invalid']:
+                raise ValueError('invalid job')
+
+            def job():
+                jobs.append(request['args'])
+                if request['args'] == ['fail']:
+                    raise Exception('job failed')
+                job_done.set()
+            return job
+
+        server = StackBuildServer(socket_path, new_job, workers=1)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        while server.server is None:
+            pass
+        assert oct(os.stat(socket_path).st_mode & 0o777) == '0o600'
+        assert self._request(
+            socket_path, b'{"command": "submit", "args": ["--stash", "a"]}'
+        ) == {'job': 1}
+        assert job_done.wait(5)
+        assert self._request(
+            socket_path, b'{"command": "submit", "args": ["invalid"]}'
+        ) == {'error': 'ValueError: invalid job'}
+        assert self._request(
+            socket_path, b'{"command": "submit", "args": ["fail"]}'
+        ) == {'job': 2}
+        assert self._request(socket_path, b'{')['error'].startswith(
+            'Invalid request:'
+        )
+        assert self._request(socket_path, b'{"command": "build"}') == {
+            'error': "Unknown request command: 'build'"
+        }
+        assert self._request(socket_path, b'[]') == {
+            'error': 'Unknown request command: None'
+        }
+        assert self._request(
+            socket_path, b'{"command": "status", "job": 3}'
+        ) == {'error': "KiwiStackBuildPluginServerError: Unknown job: 3"}
+        assert self._request(
+            socket_path, b'{"command": "shutdown"}'
+        ) == {'shutdown': True}
+        thread.join(5)
+        assert not thread.is_alive()
+        assert not os.path.exists(socket_path)
+        assert jobs == [['--stash', 'a'], ['fail']]
+        assert server.get_job(1)['state'] == 'done'
+        failed_job = server.get_job(2)
+        assert failed_job['state'] == 'failed'
+        assert failed_job['error'] == 'Exception: job failed'
+        assert failed_job['finished']
+        assert [
+            job['job'] for job in server.handle({'command': 'list'})['jobs']
+        ] == [1, 2]
+
+    def test_serve_socket_in_use(self, tmp_path):
+        socket_path = str(tmp_path / 'stackbuild.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(socket_path)
+            listener.listen()
+            with raises(KiwiStackBuildPluginServerError):
+                StackBuildServer(socket_path, Mock()).serve()
+
+    def test_serve_stale_socket(self, tmp_path):
+        socket_path = str(tmp_path / 'stackbuild.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(socket_path)
+        server = StackBuildServer(socket_path, Mock())
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        while server.server is None:
+            pass
+        server.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_shutdown_not_serving(self):
+        StackBuildServer('socket', Mock()).shutdown()
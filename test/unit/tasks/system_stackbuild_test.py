@@ -1,13 +1,23 @@
+import json
 import sys
+import threading
+from docopt import DocoptExit
 from pytest import raises
 from unittest.mock import (
-    Mock, patch, call
+    MagicMock, Mock, patch, call
 )
 
+from kiwi.tasks.system_create import SystemCreateTask
+
 from kiwi_stackbuild_plugin.tasks.system_stackbuild import SystemStackbuildTask
+from kiwi_stackbuild_plugin.kiwi_task import StackKiwiTask
+from kiwi_stackbuild_plugin.mount_pool import StackMountPool
 from kiwi_stackbuild_plugin.exceptions import (
     KiwiStackBuildPluginTargetDirExists,
-    KiwiStackBuildPluginRootSyncFailed
+    KiwiStackBuildPluginRootSyncFailed,
+    KiwiStackBuildPluginInvalidArgument,
+    KiwiStackBuildPluginBatchBuildFailed,
+    KiwiStackBuildPluginResumeFailed
 )
 
 
@@ -23,6 +33,38 @@ class TestSystemStackbuildTask:
 
     def setup_method(self, cls):
         self.setup()
+        self.stash_index_patch = patch(
+            'kiwi_stackbuild_plugin.index.StashIndex'
+        )
+        self.mock_StashIndex = self.stash_index_patch.start()
+        self.stash_lock_patch = patch(
+            'kiwi_stackbuild_plugin.lock.StashLock'
+        )
+        self.mock_StashLock = self.stash_lock_patch.start()
+        self.reflink_patch = patch(
+            'kiwi_stackbuild_plugin.reflink.StackReflink'
+        )
+        self.mock_StackReflink = self.reflink_patch.start()
+        self.mock_StackReflink.is_supported.return_value = False
+        self.checkpoint_patch = patch(
+            'kiwi_stackbuild_plugin.checkpoint.StackCheckpoint'
+        )
+        self.mock_StackCheckpoint = self.checkpoint_patch.start()
+        self.checkpoint = self.mock_StackCheckpoint.return_value
+        self.checkpoint.start.return_value = 0
+        self.checkpoint.is_applied.return_value = False
+        self.deletions_patch = patch(
+            'kiwi_stackbuild_plugin.deletions.StashDeletions'
+        )
+        self.mock_StashDeletions = self.deletions_patch.start()
+        self.mock_StashDeletions.return_value.get.return_value = []
+
+    def teardown_method(self, cls):
+        self.stash_index_patch.stop()
+        self.stash_lock_patch.stop()
+        self.reflink_patch.stop()
+        self.checkpoint_patch.stop()
+        self.deletions_patch.stop()
 
     def _init_command_args(self):
         self.task.command_args = {}
@@ -30,6 +72,21 @@ class TestSystemStackbuildTask:
         self.task.command_args['stackbuild'] = False
         self.task.command_args['--stash'] = []
         self.task.command_args['--from-registry'] = None
+        self.task.command_args['--overlay'] = False
+        self.task.command_args['--root-cache'] = False
+        self.task.command_args['--resume'] = False
+        self.task.command_args['--from-archive'] = False
+        self.task.command_args['--punch-holes'] = False
+        self.task.command_args['--include'] = []
+        self.task.command_args['--exclude'] = []
+        self.task.command_args['--pull-jobs'] = None
+        self.task.command_args['--sync-jobs'] = None
+        self.task.command_args['--batch'] = None
+        self.task.command_args['--jobs'] = None
+        self.task.command_args['--metrics-file'] = None
+        self.task.command_args['--serve'] = False
+        self.task.command_args['--socket'] = None
+        self.task.command_args['--workers'] = None
         self.task.command_args['--target-dir'] = None
         self.task.command_args['--description'] = None
         self.task.command_args['<kiwi_build_command_args>'] = [
@@ -64,14 +121,14 @@ class TestSystemStackbuildTask:
         with raises(KiwiStackBuildPluginTargetDirExists):
             self.task.process()
 
-    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.DataSync')
+    @patch('kiwi.utils.sync.DataSync')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.SystemCreateTask')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
     @patch('os.path.exists')
     def test_process_root_sync_failed(
-        self, mock_os_path_exists, mock_SystemCreateTask, mock_Command_run,
+        self, mock_os_path_exists, mock_StackKiwiTask, mock_Command_run,
         mock_Path_create, mock_Privileges, mock_DataSync
     ):
         self._init_command_args()
@@ -83,19 +140,18 @@ class TestSystemStackbuildTask:
         mock_DataSync.side_effect = Exception
 
         kiwi_task = Mock()
-        mock_SystemCreateTask.return_value = kiwi_task
+        mock_StackKiwiTask.return_value.new.return_value = kiwi_task
         with raises(KiwiStackBuildPluginRootSyncFailed):
             self.task.process()
 
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.SystemCreateTask')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
     @patch('os.path.exists')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.patch.object')
     def test_process_rebuild(
-        self, mock_patch_object, mock_os_path_exists,
-        mock_SystemCreateTask, mock_Command_run,
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
         mock_Path_create, mock_Privileges
     ):
         self._init_command_args()
@@ -106,11 +162,20 @@ class TestSystemStackbuildTask:
         mock_os_path_exists.return_value = False
         mock_Command_run.return_value.output = '/podman/mount/path'
         kiwi_task = Mock()
-        mock_SystemCreateTask.return_value = kiwi_task
+        mock_StackKiwiTask.return_value.new.return_value = kiwi_task
+        mock_StackKiwiTask.validate.side_effect = StackKiwiTask.validate
+        mock_StackKiwiTask._get_task.side_effect = StackKiwiTask._get_task
+        mock_StackKiwiTask.tasks = StackKiwiTask.tasks
         self.task.process()
         assert mock_Command_run.call_args_list == [
             call(['podman', 'pull', 'registry.uri/name']),
             call(['podman', 'image', 'mount', 'name']),
+            call(
+                [
+                    'podman', 'image', 'inspect',
+                    '--format', '{{.Id}}', 'name'
+                ], raise_on_error=False
+            ),
             call(
                 [
                     'rsync', '--archive', '--hard-links', '--xattrs',
@@ -124,30 +189,61 @@ class TestSystemStackbuildTask:
                 raise_on_error=False
             )
         ]
-        mock_SystemCreateTask.assert_called_once_with(
-            should_perform_task_setup=False
+        self.mock_StackCheckpoint.assert_called_once_with(
+            '/some/target-dir/build/stackbuild.checkpoint'
         )
+        self.checkpoint.start.assert_called_once_with([('name', None)], [])
+        self.checkpoint.set_applied.assert_called_once_with(0)
+        mock_StackKiwiTask.assert_called_once_with(self.task)
         kiwi_task.process.assert_called_once_with()
-        mock_patch_object.assert_called_once_with(
-            sys, 'argv', [
-                'kiwi-ng', '--type', 'iso',
-                '--profile', 'a', '--profile', 'b',
-                'system', 'create',
-                '--root', '/some/target-dir/build/image-root',
-                '--target-dir', '/some/target-dir',
-                '--signing-key', 'some-key'
-            ]
-        )
+        command, command_args, global_args = \
+            mock_StackKiwiTask.return_value.new.call_args[0]
+        assert command == 'create'
+        assert command_args['--root'] == '/some/target-dir/build/image-root'
+        assert command_args['--target-dir'] == '/some/target-dir'
+        assert command_args['--signing-key'] == ['some-key']
+        assert global_args['--type'] == 'iso'
+        assert global_args['--profile'] == ['a', 'b']
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    def test_process_rebuild_metrics(
+        self, mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, tmp_path
+    ):
+        stash_root = tmp_path / 'mount'
+        stash_root.mkdir()
+        (stash_root / 'file').write_bytes(b'data')
+        metrics_file = tmp_path / 'metrics.json'
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = str(tmp_path / 'target')
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        self.task.command_args['--metrics-file'] = str(metrics_file)
+        mock_Command_run.return_value.output = str(stash_root)
+        mock_StackKiwiTask.return_value.new.return_value.process.side_effect = Exception
+        with raises(Exception):
+            self.task.process()
+        with open(metrics_file) as metrics:
+            report = json.load(metrics)
+        assert report['command'] == 'stackbuild'
+        assert [phase['name'] for phase in report['phases']] == [
+            'pull', 'mount', 'sync', 'umount', 'kiwi_create'
+        ]
+        assert report['phases'][0]['stash'] == 'name'
+        assert report['counters'] == {'synced_files': 1, 'synced_bytes': 4}
 
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
     @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.SystemBuildTask')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
     @patch('os.path.exists')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.patch.object')
     def test_process_new_build(
-        self, mock_patch_object, mock_os_path_exists,
-        mock_SystemBuildTask, mock_Command_run,
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
         mock_Path_create, mock_Privileges
     ):
         self._init_command_args()
@@ -159,11 +255,20 @@ class TestSystemStackbuildTask:
         mock_os_path_exists.return_value = False
         mock_Command_run.return_value.output = '/podman/mount/path'
         kiwi_task = Mock()
-        mock_SystemBuildTask.return_value = kiwi_task
+        mock_StackKiwiTask.return_value.new.return_value = kiwi_task
+        mock_StackKiwiTask.validate.side_effect = StackKiwiTask.validate
+        mock_StackKiwiTask._get_task.side_effect = StackKiwiTask._get_task
+        mock_StackKiwiTask.tasks = StackKiwiTask.tasks
         self.task.process()
         assert mock_Command_run.call_args_list == [
             call(['podman', 'pull', 'registry.uri/name']),
             call(['podman', 'image', 'mount', 'name']),
+            call(
+                [
+                    'podman', 'image', 'inspect',
+                    '--format', '{{.Id}}', 'name'
+                ], raise_on_error=False
+            ),
             call(
                 [
                     'rsync', '--archive', '--hard-links', '--xattrs',
@@ -177,17 +282,1072 @@ class TestSystemStackbuildTask:
                 raise_on_error=False
             )
         ]
-        mock_SystemBuildTask.assert_called_once_with(
-            should_perform_task_setup=False
+        mock_StackKiwiTask.assert_called_once_with(self.task)
+        kiwi_task.process.assert_called_once_with()
+        command, command_args, global_args = \
+            mock_StackKiwiTask.return_value.new.call_args[0]
+        assert command == 'build'
+        assert command_args['--description'] == '/path/to/kiwi/description'
+        assert command_args['--target-dir'] == '/some/target-dir'
+        assert command_args['--allow-existing-root'] is True
+        assert command_args['--signing-key'] == ['some-key']
+        assert global_args['--type'] == 'iso'
+        assert global_args['--profile'] == ['a', 'b']
+
+    @patch('kiwi_stackbuild_plugin.overlay.StackOverlay')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_overlay(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackOverlay
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--overlay'] = True
+        mock_os_path_exists.return_value = False
+        mock_StackOverlay.is_supported.return_value = True
+        overlay = mock_StackOverlay.return_value
+        overlay.__enter__.return_value = overlay
+        mount_points = ['/podman/mount/a', '/podman/mount/b']
+
+        def command_run(command, raise_on_error=True):
+            result = Mock()
+            if command[:3] == ['podman', 'image', 'mount']:
+                result.output = mount_points.pop(0)
+            return result
+
+        mock_Command_run.side_effect = command_run
+        kiwi_task = Mock()
+        mock_StackKiwiTask.return_value.new.return_value = kiwi_task
+
+        def check_mounted():
+            # kiwi must run while the overlay is active
+            overlay.mount.assert_called_once_with()
+            assert not overlay.__exit__.called
+
+        kiwi_task.process.side_effect = check_mounted
+        self.task.process()
+        mock_StackOverlay.assert_called_once_with(
+            ['/podman/mount/a', '/podman/mount/b'],
+            '/some/target-dir/build/image-root',
+            '/some/target-dir/build/overlay'
         )
         kiwi_task.process.assert_called_once_with()
-        mock_patch_object.assert_called_once_with(
-            sys, 'argv', [
-                'kiwi-ng', '--type', 'iso',
-                '--profile', 'a', '--profile', 'b',
-                'system', 'build',
-                '--description', '/path/to/kiwi/description',
-                '--target-dir', '/some/target-dir',
-                '--allow-existing-root', '--signing-key', 'some-key'
+        assert overlay.__exit__.called
+        assert mock_Command_run.call_args_list == [
+            call(['podman', 'image', 'mount', 'a']),
+            call(['podman', 'image', 'mount', 'b']),
+            call(
+                ['podman', 'image', 'umount', '--force', 'a'],
+                raise_on_error=False
+            ),
+            call(
+                ['podman', 'image', 'umount', '--force', 'b'],
+                raise_on_error=False
+            )
+        ]
+
+    @patch('kiwi_stackbuild_plugin.overlay.StackOverlay')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_overlay_not_supported(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackOverlay
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--overlay'] = True
+        mock_os_path_exists.return_value = False
+        mock_StackOverlay.is_supported.return_value = False
+        mock_Command_run.return_value.output = '/podman/mount/path'
+        self.task.process()
+        assert not mock_StackOverlay.called
+        assert call(
+            [
+                'rsync', '--archive', '--hard-links', '--xattrs',
+                '--acls', '--one-file-system', '--inplace',
+                '/podman/mount/path/',
+                '/some/target-dir/build/image-root'
             ]
+        ) in mock_Command_run.call_args_list
+
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.overlay.StackOverlay')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_overlay_deleted_paths(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackOverlay,
+        mock_StackMerge, caplog
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--overlay'] = True
+        mock_os_path_exists.return_value = False
+        self.mock_StashDeletions.return_value.get.side_effect = [
+            [], ['etc/obsolete']
+        ]
+        mock_Command_run.return_value.output = '/podman/mount/path'
+        self.task.process()
+        assert 'using copy based sync' in caplog.text
+        assert not mock_StackOverlay.is_supported.called
+        assert mock_StackMerge.return_value.sync_data.called
+
+    @patch('kiwi_stackbuild_plugin.server.StackBuildServer')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    def test_process_serve(self, mock_Privileges, mock_StackBuildServer):
+        self._init_command_args()
+        self.task.command_args['--serve'] = True
+        self.task.command_args['--workers'] = '3'
+        self.task.process()
+        mock_StackBuildServer.assert_called_once_with(
+            '/run/kiwi-stackbuild.sock', self.task._new_server_job, 3
+        )
+        mock_StackBuildServer.return_value.serve.assert_called_once_with()
+        assert isinstance(self.task.mount_pool, StackMountPool)
+
+    def test_new_server_job(self):
+        self._init_command_args()
+        self.task.mount_pool = StackMountPool()
+        job = self.task._new_server_job(
+            {
+                'args': ['--stash', 'a', '--target-dir', '/target', '--resume'],
+                'type': 'oem',
+                'profiles': ['x']
+            }
+        ).__self__
+        assert isinstance(job, SystemStackbuildTask)
+        assert job.command_args['--stash'] == ['a']
+        assert job.command_args['--resume'] is True
+        assert job.global_args['--type'] == 'oem'
+        assert job.global_args['--profile'] == ['x']
+        assert job.mount_pool is self.task.mount_pool
+        assert self.task.global_args['--type'] == 'iso'
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task._new_server_job({'args': '--stash a'})
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task._new_server_job({'args': ['--serve']})
+        with raises(DocoptExit):
+            self.task._new_server_job({'args': ['--stash', 'a']})
+
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask.process_forked')
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('os.path.exists')
+    def test_process_server_job(
+        self, mock_os_path_exists, mock_Command_run, mock_Path_create,
+        mock_Privileges, mock_StackMerge, mock_process_forked
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        mock_os_path_exists.return_value = False
+        self.task.mount_pool = StackMountPool()
+        shared_umount = Mock()
+        self.task.mount_pool.acquire(
+            ('a', '', 'id-a'), lambda: '/podman/mount/shared-a', shared_umount
         )
+        # b was mounted for an image since replaced by a new stash
+        self.task.mount_pool.acquire(
+            ('b', '', 'id-b-old'), lambda: '/podman/mount/old-b', Mock()
+        )
+
+        def command_run(command, raise_on_error=True):
+            result = Mock(returncode=0)
+            if command[:3] == ['podman', 'image', 'mount']:
+                result.output = '/podman/mount/b'
+            elif command[:3] == ['podman', 'image', 'inspect']:
+                result.output = f'id-{command[-1]}\n'
+            return result
+
+        mock_Command_run.side_effect = command_run
+        self.task.process()
+        mock_StackMerge.assert_called_once_with(
+            ['/podman/mount/shared-a', '/podman/mount/b'],
+            self.task.path_filter, 0, {}, {}
+        )
+        assert call(['podman', 'image', 'mount', 'id-b']) in \
+            mock_Command_run.call_args_list
+        for stash_ref in ('a', 'id-a', 'b'):
+            assert call(['podman', 'image', 'mount', stash_ref]) not in \
+                mock_Command_run.call_args_list
+        assert mock_Command_run.call_args_list[-1] == call(
+            ['podman', 'image', 'umount', '--force', 'id-b'],
+            raise_on_error=False
+        )
+        # the kiwi task runs in a process forked from the server
+        kiwi_task, log_file = mock_process_forked.call_args[0]
+        assert isinstance(kiwi_task, SystemCreateTask)
+        assert log_file == '/some/target-dir/build.log'
+        assert kiwi_task.command_args['--root'] == \
+            '/some/target-dir/build/image-root'
+        assert kiwi_task.command_args['--signing-key'] == ['some-key']
+        assert kiwi_task.global_args['--type'] == 'iso'
+        assert kiwi_task.global_args['--profile'] == ['a', 'b']
+        # the stashes mounted by the other jobs stay mounted
+        assert self.task.mount_pool.get_references() == {
+            ('a', '', 'id-a'): 1, ('b', '', 'id-b-old'): 1
+        }
+        assert not shared_umount.called
+
+    def test_get_stash_mount_shared(self):
+        self._init_command_args()
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        self.task.mount_pool = StackMountPool()
+        self.task.shared_stashes = []
+        self.task.metrics = MagicMock()
+        with patch(
+            'kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run'
+        ) as mock_Command_run:
+            mock_Command_run.return_value = Mock(
+                returncode=1, output='/podman/mount/a'
+            )
+            assert self.task._get_stash_mount('a') == '/podman/mount/a'
+            # the image id is unknown, the image is keyed by reference
+            mock_Command_run.assert_called_with(
+                ['podman', 'image', 'mount', 'registry.uri/a']
+            )
+        assert self.task.shared_stashes == [
+            ('a', 'registry.uri', 'registry.uri/a')
+        ]
+        assert self.task.mount_pool.get_references() == {
+            ('a', 'registry.uri', 'registry.uri/a'): 1
+        }
+
+    def test_get_stash_mount_blob_store(self):
+        self._init_command_args()
+        self.task.mount_pool = StackMountPool()
+        self.task.shared_stashes = []
+        with patch.object(
+            SystemStackbuildTask, '_get_blob_store_root',
+            return_value='/blobs/a'
+        ):
+            assert self.task._get_stash_mount('a') == '/blobs/a'
+        # blob store roots are not mounted
+        assert self.task.mount_pool.get_references() == {}
+        assert self.task.shared_stashes == []
+
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_merged_stashes(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackMerge
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        mock_os_path_exists.return_value = False
+        mount_points = ['/podman/mount/a', '/podman/mount/b']
+        self.mock_StashDeletions.return_value.get.side_effect = [
+            [], ['etc/obsolete']
+        ]
+
+        def command_run(command, raise_on_error=True):
+            result = Mock()
+            if command[:3] == ['podman', 'image', 'mount']:
+                result.output = mount_points.pop(0)
+            return result
+
+        mock_Command_run.side_effect = command_run
+        kiwi_task = Mock()
+        mock_StackKiwiTask.return_value.new.return_value = kiwi_task
+        self.task.process()
+        assert self.mock_StashDeletions.call_args_list == [
+            call('/var/tmp/kiwi-stash', 'a'),
+            call('/var/tmp/kiwi-stash', 'b')
+        ]
+        mock_StackMerge.assert_called_once_with(
+            ['/podman/mount/a', '/podman/mount/b'],
+            self.task.path_filter, 0, {}, {
+                '/podman/mount/b': ['etc/obsolete']
+            }
+        )
+        mock_StackMerge.return_value.sync_data.assert_called_once_with(
+            '/some/target-dir/build/image-root', self.task.metrics,
+            self.checkpoint
+        )
+        assert mock_Command_run.call_args_list == [
+            call(['podman', 'image', 'mount', 'a']),
+            call(['podman', 'image', 'mount', 'b']),
+            call(
+                ['podman', 'image', 'inspect', '--format', '{{.Id}}', 'a'],
+                raise_on_error=False
+            ),
+            call(
+                ['podman', 'image', 'inspect', '--format', '{{.Id}}', 'b'],
+                raise_on_error=False
+            ),
+            call(
+                ['podman', 'image', 'umount', '--force', 'a'],
+                raise_on_error=False
+            ),
+            call(
+                ['podman', 'image', 'umount', '--force', 'b'],
+                raise_on_error=False
+            )
+        ]
+        kiwi_task.process.assert_called_once_with()
+        assert self.mock_StashLock.call_args_list == [
+            call('/var/tmp/kiwi-stash', 'a'),
+            call('/var/tmp/kiwi-stash', 'b')
+        ]
+        stash_lock = self.mock_StashLock.return_value
+        assert stash_lock.acquire.call_count == 2
+        assert stash_lock.release.call_count == 2
+
+    def test_lock_stashes_missing_stash(self, caplog):
+        self._init_command_args()
+        self.task.command_args['--stash'] = ['a']
+        self.task.stash_locks = []
+        self.mock_StashLock.return_value.acquire.return_value = False
+        self.task._lock_stashes()
+        assert self.task.stash_locks == []
+        assert "Stash 'a' not found in stash home" in caplog.text
+
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('os.path.exists')
+    def test_process_merged_stashes_sync_failed(
+        self, mock_os_path_exists, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackMerge
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        mock_os_path_exists.return_value = False
+        mock_StackMerge.return_value.sync_data.side_effect = Exception
+        with raises(KiwiStackBuildPluginRootSyncFailed):
+            self.task.process()
+        assert call(
+            ['podman', 'image', 'umount', '--force', 'b'],
+            raise_on_error=False
+        ) in mock_Command_run.call_args_list
+
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_parallel_registry_pull(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackMerge
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        self.task.command_args['--pull-jobs'] = '2'
+        mock_os_path_exists.return_value = False
+        # both pulls have to be in flight at the same time
+        # to pass the barrier
+        pulls_in_flight = threading.Barrier(2, timeout=5)
+
+        def command_run(command, raise_on_error=True):
+            result = Mock()
+            if command[:2] == ['podman', 'pull']:
+                pulls_in_flight.wait()
+            elif command[:3] == ['podman', 'image', 'mount']:
+                result.output = f'/podman/mount/{command[3]}'
+            return result
+
+        mock_Command_run.side_effect = command_run
+        self.task.process()
+        mock_StackMerge.assert_called_once_with(
+            ['/podman/mount/a', '/podman/mount/b'],
+            self.task.path_filter, 0, {}, {}
+        )
+        for stash in ('a', 'b'):
+            pull = call(['podman', 'pull', f'registry.uri/{stash}'])
+            mount = call(['podman', 'image', 'mount', stash])
+            calls = mock_Command_run.call_args_list
+            assert calls.index(pull) < calls.index(mount)
+        assert self.mock_StashIndex.return_value.touch.call_args_list == [
+            call('a'), call('b')
+        ]
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('os.path.exists')
+    def test_process_invalid_pull_jobs(
+        self, mock_os_path_exists, mock_Command_run,
+        mock_Path_create, mock_Privileges
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        mock_os_path_exists.return_value = False
+        for pull_jobs in ('0', 'many'):
+            self.task.command_args['--pull-jobs'] = pull_jobs
+            with raises(KiwiStackBuildPluginInvalidArgument):
+                self.task.process()
+        assert not mock_Command_run.called
+
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_from_blob_store(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackMerge,
+        mock_StashBlobStore
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        mock_os_path_exists.return_value = False
+        mock_StashBlobStore.return_value.get_root.side_effect = [
+            '/var/tmp/kiwi-stash/a/root', None
+        ]
+        mock_StashBlobStore.return_value.get_link_groups.return_value = {
+            'etc/conf': 'etc/conf', 'etc/conf.link': 'etc/conf'
+        }
+        mock_Command_run.return_value.output = '/podman/mount/b'
+        self.task.process()
+        mock_StackMerge.assert_called_once_with(
+            ['/var/tmp/kiwi-stash/a/root', '/podman/mount/b'],
+            self.task.path_filter, 0, {
+                '/var/tmp/kiwi-stash/a/root': {
+                    'etc/conf': 'etc/conf', 'etc/conf.link': 'etc/conf'
+                }
+            }, {}
+        )
+        assert mock_Command_run.call_args_list == [
+            call(['podman', 'image', 'mount', 'b']),
+            call(
+                ['podman', 'image', 'umount', '--force', 'b'],
+                raise_on_error=False
+            )
+        ]
+
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_root_cache_hit(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StashBlobStore,
+        mock_StackRootCache
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--root-cache'] = True
+        mock_os_path_exists.return_value = False
+        mock_StashBlobStore.return_value.get_digest.side_effect = [
+            'digest-a', None, 'digest-a', None
+        ]
+        mock_Command_run.return_value = Mock(returncode=0, output='id-b\n')
+        mock_StackRootCache.get_key.return_value = 'key'
+        root_cache = mock_StackRootCache.return_value
+        root_cache.materialize.return_value = True
+        self.task.process()
+        mock_StackRootCache.get_key.assert_called_once_with(
+            ['digest-a', 'id-b']
+        )
+        root_cache.materialize.assert_called_once_with(
+            'key', '/some/target-dir/build/image-root'
+        )
+        assert not root_cache.add_root.called
+        assert mock_Command_run.call_args_list == [
+            call(
+                ['podman', 'image', 'inspect', '--format', '{{.Id}}', 'b'],
+                raise_on_error=False
+            )
+        ] * 2
+        self.checkpoint.start.assert_called_once_with(
+            [('a', 'digest-a'), ('b', 'id-b')], []
+        )
+        self.checkpoint.set_complete.assert_called_once_with()
+        assert self.mock_StashIndex.return_value.touch.call_args_list == [
+            call('a'), call('b')
+        ]
+        mock_StackKiwiTask.return_value.new.return_value.process.assert_called_once_with()
+
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_root_cache_miss(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackRootCache
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--root-cache'] = True
+        mock_os_path_exists.return_value = False
+        mock_Command_run.return_value = Mock(
+            returncode=0, output='/podman/mount/path'
+        )
+        mock_StackRootCache.get_key.return_value = 'key'
+        root_cache = mock_StackRootCache.return_value
+        root_cache.materialize.return_value = False
+        self.task.process()
+        assert call(['podman', 'image', 'mount', 'name']) in \
+            mock_Command_run.call_args_list
+        root_cache.add_root.assert_called_once_with(
+            'key', '/some/target-dir/build/image-root'
+        )
+        mock_StackKiwiTask.return_value.new.return_value.process.assert_called_once_with()
+
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_root_cache_not_used(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackRootCache
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--root-cache'] = True
+        mock_os_path_exists.return_value = False
+        # stash image not found
+        mock_Command_run.return_value = Mock(returncode=1, output='')
+        self.task.process()
+        # stashes pulled from a registry
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        self.task.process()
+        root_cache = mock_StackRootCache.return_value
+        assert not root_cache.materialize.called
+        assert not root_cache.add_root.called
+
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('os.path.exists')
+    def test_process_root_cache_failed(
+        self, mock_os_path_exists, mock_Path_create, mock_Privileges,
+        mock_StashBlobStore, mock_StackRootCache
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--root-cache'] = True
+        mock_os_path_exists.return_value = False
+        mock_StashBlobStore.return_value.get_digest.return_value = 'digest'
+        mock_StackRootCache.return_value.materialize.side_effect = Exception
+        with raises(KiwiStackBuildPluginRootSyncFailed):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_reflink(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        mock_os_path_exists.return_value = False
+        mock_Command_run.return_value.output = '/podman/mount/path'
+        self.mock_StackReflink.is_supported.return_value = True
+        self.task.process()
+        self.mock_StackReflink.is_supported.assert_called_once_with(
+            '/podman/mount/path', '/some/target-dir/build/image-root'
+        )
+        self.mock_StackReflink.assert_called_once_with('/podman/mount/path')
+        self.mock_StackReflink.return_value.clone.assert_called_once_with(
+            '/some/target-dir/build/image-root', link_groups=None
+        )
+        assert mock_Command_run.call_args_list == [
+            call(['podman', 'image', 'mount', 'name']),
+            call(
+                [
+                    'podman', 'image', 'inspect',
+                    '--format', '{{.Id}}', 'name'
+                ], raise_on_error=False
+            ),
+            call(
+                ['podman', 'image', 'umount', '--force', 'name'],
+                raise_on_error=False
+            )
+        ]
+
+    @patch('kiwi_stackbuild_plugin.parallel_copy.StackParallelCopy')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_parallel_copy(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackParallelCopy
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--sync-jobs'] = '8'
+        mock_os_path_exists.return_value = False
+        mock_Command_run.return_value.output = '/podman/mount/path'
+        mock_StackParallelCopy.return_value.copy.return_value = {
+            'hardlink_bytes': 0, 'sparse_bytes': 4096
+        }
+        self.task.process()
+        mock_StackParallelCopy.assert_called_once_with(
+            '/podman/mount/path', 8
+        )
+        assert self.task.metrics.counters['sparse_saved_bytes'] == 4096
+        mock_StackParallelCopy.return_value.copy.assert_called_once_with(
+            '/some/target-dir/build/image-root', link_groups=None
+        )
+
+    @patch('kiwi.utils.sync.DataSync')
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.parallel_copy.StackParallelCopy')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_blob_store_link_groups(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackParallelCopy,
+        mock_StashBlobStore, mock_DataSync
+    ):
+        # a blob store root is never synced by rsync which
+        # would hardlink all files sharing a blob
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        mock_os_path_exists.return_value = False
+        mock_StashBlobStore.return_value.get_root.return_value = \
+            '/var/tmp/kiwi-stash/name/root'
+        mock_StashBlobStore.return_value.get_link_groups.return_value = None
+        mock_StackParallelCopy.return_value.copy.return_value = {
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        self.task.process()
+        mock_StackParallelCopy.assert_called_once_with(
+            '/var/tmp/kiwi-stash/name/root', 1
+        )
+        mock_StackParallelCopy.return_value.copy.assert_called_once_with(
+            '/some/target-dir/build/image-root', link_groups={}
+        )
+        assert not mock_DataSync.called
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    def test_process_invalid_sync_jobs(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--sync-jobs'] = '0'
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.unpack.StashUnpacker')
+    @patch('kiwi_stackbuild_plugin.archive.StashArchive')
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.isfile')
+    @patch('os.path.exists')
+    def test_process_rebuild_from_archive(
+        self, mock_os_path_exists, mock_os_path_isfile,
+        mock_StackKiwiTask, mock_Command_run, mock_Path_create,
+        mock_Privileges, mock_StackRootCache, mock_StashArchive,
+        mock_StashUnpacker, tmp_path
+    ):
+        metrics_file = tmp_path / 'metrics.json'
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-archive'] = True
+        self.task.command_args['--punch-holes'] = True
+        self.task.command_args['--root-cache'] = True
+        self.task.command_args['--metrics-file'] = str(metrics_file)
+        mock_os_path_exists.return_value = False
+        mock_os_path_isfile.return_value = True
+        mock_StashArchive.return_value.get_digest.side_effect = [
+            'sha256:a', 'sha256:b', 'sha256:a', 'sha256:b'
+        ]
+        mock_StackRootCache.get_key.return_value = 'key'
+        mock_StackRootCache.return_value.materialize.return_value = False
+        self.mock_StashDeletions.return_value.get.side_effect = [
+            [], ['etc/obsolete']
+        ]
+        mock_StashUnpacker.return_value.unpack.return_value = {
+            'files': 2, 'bytes': 10, 'whiteouts': 1,
+            'hardlink_bytes': 4, 'sparse_bytes': 4096
+        }
+        with patch(
+            'kiwi_stackbuild_plugin.tasks.system_stackbuild.'
+            'StackBuildDefaults.get_stash_home',
+            return_value='/var/tmp/kiwi-stash'
+        ):
+            self.task.process()
+        mock_StackRootCache.get_key.assert_called_once_with(
+            ['sha256:a', 'sha256:b', 'deleted:b:etc/obsolete']
+        )
+        mock_StashUnpacker.remove_paths.assert_called_once_with(
+            '/some/target-dir/build/image-root', ['etc/obsolete']
+        )
+        assert mock_StashArchive.call_args_list == [
+            call('/var/tmp/kiwi-stash/a/a.tar'),
+            call('/var/tmp/kiwi-stash/b/b.tar')
+        ] * 3
+        assert mock_StashUnpacker.call_args_list == [
+            call(
+                mock_StashArchive.return_value, self.task.path_filter, True
+            )
+        ] * 2
+        assert mock_StashUnpacker.return_value.unpack.call_args_list == [
+            call('/some/target-dir/build/image-root'),
+            call('/some/target-dir/build/image-root')
+        ]
+        self.checkpoint.start.assert_called_once_with(
+            [('a', 'sha256:a'), ('b', 'sha256:b')], []
+        )
+        assert self.checkpoint.set_applied.call_args_list == [
+            call(0), call(1)
+        ]
+        assert not mock_Command_run.called
+        mock_StackRootCache.return_value.add_root.assert_called_once_with(
+            'key', '/some/target-dir/build/image-root'
+        )
+        assert self.mock_StashLock.return_value.release.call_count == 2
+        with open(metrics_file) as metrics:
+            report = json.load(metrics)
+        assert [phase['name'] for phase in report['phases']] == [
+            'root_cache', 'unpack', 'unpack', 'root_cache_add', 'kiwi_create'
+        ]
+        assert report['counters'] == {
+            'synced_files': 4, 'synced_bytes': 20,
+            'hardlink_saved_bytes': 8, 'sparse_saved_bytes': 8192
+        }
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('os.path.isfile')
+    @patch('os.path.exists')
+    def test_process_from_archive_not_found(
+        self, mock_os_path_exists, mock_os_path_isfile, mock_Path_create,
+        mock_Privileges
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-archive'] = True
+        mock_os_path_exists.return_value = False
+        mock_os_path_isfile.return_value = False
+        with raises(KiwiStackBuildPluginRootSyncFailed):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    def test_process_from_archive_invalid_combination(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-archive'] = True
+        self.task.command_args['--overlay'] = True
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    def test_process_punch_holes_without_archive(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--punch-holes'] = True
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.merge.StackMerge')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_rebuild_path_filter(
+        self, mock_os_path_exists,
+        mock_StackKiwiTask, mock_Command_run, mock_Path_create,
+        mock_Privileges, mock_StackMerge
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        self.task.command_args['--include'] = ['/usr', 'etc']
+        self.task.command_args['--exclude'] = ['usr/share/doc']
+        mock_os_path_exists.return_value = False
+        mock_Command_run.return_value.output = '/podman/mount/path'
+        self.task.process()
+        # a filtered single stash is synced by the merge planner
+        mock_StackMerge.assert_called_once_with(
+            ['/podman/mount/path'], self.task.path_filter, 0, {}, {}
+        )
+        assert self.task.path_filter.include_list == ['usr', 'etc']
+        assert self.task.path_filter.exclude_list == ['usr/share/doc']
+
+    @patch('kiwi_stackbuild_plugin.unpack.StashUnpacker')
+    @patch('kiwi_stackbuild_plugin.archive.StashArchive')
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.isfile')
+    @patch('os.path.exists')
+    def test_process_rebuild_from_archive_path_filter(
+        self, mock_os_path_exists, mock_os_path_isfile,
+        mock_StackKiwiTask, mock_Path_create, mock_Privileges,
+        mock_StackRootCache, mock_StashArchive, mock_StashUnpacker
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-archive'] = True
+        self.task.command_args['--root-cache'] = True
+        self.task.command_args['--include'] = ['usr']
+        mock_os_path_exists.return_value = False
+        mock_os_path_isfile.return_value = True
+        mock_StashArchive.return_value.get_digest.return_value = 'sha256:a'
+        mock_StackRootCache.return_value.materialize.return_value = False
+        mock_StashUnpacker.return_value.unpack.return_value = {
+            'files': 2, 'bytes': 10, 'whiteouts': 0,
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        self.task.process()
+        # the filters are part of the root cache key
+        mock_StackRootCache.get_key.assert_called_once_with(
+            ['sha256:a', 'include:usr']
+        )
+        mock_StashUnpacker.assert_called_once_with(
+            mock_StashArchive.return_value, self.task.path_filter, False
+        )
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    def test_process_path_filter_overlay(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--overlay'] = True
+        self.task.command_args['--exclude'] = ['usr/share/doc']
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    def test_process_resume_overlay(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--overlay'] = True
+        self.task.command_args['--resume'] = True
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('os.path.exists')
+    def test_process_resume_no_checkpoint(
+        self, mock_os_path_exists, mock_Privileges
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--resume'] = True
+        mock_os_path_exists.return_value = True
+        self.checkpoint.load.return_value = False
+        with raises(KiwiStackBuildPluginResumeFailed):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_resume_complete(
+        self, mock_os_path_exists, mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--resume'] = True
+        mock_os_path_exists.return_value = True
+        mock_Command_run.return_value = Mock(returncode=0, output='id\n')
+        self.checkpoint.load.return_value = True
+        self.checkpoint.start.return_value = 1
+        self.task.process()
+        self.checkpoint.start.assert_called_once_with([('name', 'id')], [])
+        assert mock_Command_run.call_args_list == [
+            call(
+                ['podman', 'image', 'inspect', '--format', '{{.Id}}', 'name'],
+                raise_on_error=False
+            )
+        ]
+        mock_StackKiwiTask.return_value.new.return_value.process.assert_called_once_with()
+
+    @patch('kiwi_stackbuild_plugin.unpack.StashUnpacker')
+    @patch('kiwi_stackbuild_plugin.archive.StashArchive')
+    @patch('kiwi_stackbuild_plugin.root_cache.StackRootCache')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.isfile')
+    @patch('os.path.exists')
+    def test_process_resume_from_archive(
+        self, mock_os_path_exists, mock_os_path_isfile, mock_StackKiwiTask,
+        mock_Path_create, mock_Privileges, mock_StackRootCache,
+        mock_StashArchive, mock_StashUnpacker
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['a', 'b']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-archive'] = True
+        self.task.command_args['--root-cache'] = True
+        self.task.command_args['--resume'] = True
+        mock_os_path_exists.return_value = True
+        mock_os_path_isfile.return_value = True
+        mock_StackRootCache.get_key.return_value = 'key'
+        mock_StashUnpacker.return_value.unpack.return_value = {
+            'files': 2, 'bytes': 10, 'whiteouts': 0,
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        self.checkpoint.load.return_value = True
+        self.checkpoint.start.return_value = 1
+        self.checkpoint.is_applied.side_effect = [True, False]
+        with patch(
+            'kiwi_stackbuild_plugin.tasks.system_stackbuild.'
+            'StackBuildDefaults.get_stash_home',
+            return_value='/var/tmp/kiwi-stash'
+        ):
+            self.task.process()
+        # the partial image root is never replaced by the cached root
+        assert not mock_StackRootCache.return_value.materialize.called
+        mock_StashUnpacker.return_value.unpack.assert_called_once_with(
+            '/some/target-dir/build/image-root'
+        )
+        assert mock_StashArchive.call_args_list[-1] == call(
+            '/var/tmp/kiwi-stash/b/b.tar'
+        )
+        self.checkpoint.set_applied.assert_called_once_with(1)
+        mock_StackRootCache.return_value.add_root.assert_called_once_with(
+            'key', '/some/target-dir/build/image-root'
+        )
+        mock_StackKiwiTask.return_value.new.return_value.process.assert_called_once_with()
+
+    @patch('kiwi_stackbuild_plugin.batch.StackBatch')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Path.create')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stackbuild.Command.run')
+    @patch('kiwi_stackbuild_plugin.kiwi_task.StackKiwiTask')
+    @patch('os.path.exists')
+    def test_process_batch(
+        self, mock_os_path_exists, mock_StackKiwiTask, mock_Command_run,
+        mock_Path_create, mock_Privileges, mock_StackBatch
+    ):
+        self._init_command_args()
+        self.task.command_args['stackbuild'] = True
+        self.task.command_args['--stash'] = ['name']
+        self.task.command_args['--target-dir'] = '/some/target-dir'
+        self.task.command_args['--from-registry'] = 'registry.uri'
+        self.task.command_args['--batch'] = 'batch.yml'
+        self.task.command_args['--jobs'] = '2'
+        mock_os_path_exists.return_value = False
+        mock_Command_run.return_value.output = '/podman/mount/path'
+        batch = mock_StackBatch.return_value
+        batch.builds = [{'name': 'a'}, {'name': 'b'}]
+        batch.get_target_dirs.return_value = [
+            '/some/target-dir/a', '/some/target-dir/b'
+        ]
+        batch.run.return_value = {
+            'a': {'status': 'ok'}, 'b': {'status': 'ok'}
+        }
+        self.task.process()
+        mock_StackBatch.assert_called_once_with(
+            'batch.yml', self.task.global_args
+        )
+        batch.run.assert_called_once_with(
+            '/some/target-dir/build/image-root', '/some/target-dir', 2,
+            self.task.metrics
+        )
+        assert not mock_StackKiwiTask.called
+
+        batch.run.return_value = {
+            'a': {'status': 'ok'}, 'b': {'status': 'failed'}
+        }
+        with raises(KiwiStackBuildPluginBatchBuildFailed):
+            self.task.process()
+
+        mock_os_path_exists.side_effect = lambda path: path.endswith('/b')
+        with raises(KiwiStackBuildPluginTargetDirExists):
+            self.task.process()
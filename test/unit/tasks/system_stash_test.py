@@ -1,13 +1,19 @@
+import os
 import sys
+import json
 from pytest import raises
 from unittest.mock import (
-    Mock, patch
+    Mock, patch, call, ANY
 )
 from tempfile import NamedTemporaryFile
 from kiwi_stackbuild_plugin.tasks.system_stash import SystemStashTask
 from kiwi_stackbuild_plugin.exceptions import (
-    KiwiStackBuildPluginContainerNameInvalid
+    KiwiStackBuildPluginContainerNameInvalid,
+    KiwiStackBuildPluginInvalidArgument,
+    KiwiStackBuildPluginStashCorrupted,
+    KiwiStackBuildPluginStashNotFoundError
 )
+from kiwi_stackbuild_plugin.defaults import StackBuildDefaults
 
 
 class TestSystemStashTask:
@@ -21,6 +27,26 @@ class TestSystemStashTask:
 
     def setup_method(self, cls):
         self.setup()
+        self.stash_index_patch = patch(
+            'kiwi_stackbuild_plugin.index.StashIndex'
+        )
+        self.mock_StashIndex = self.stash_index_patch.start()
+        self.stash_deletions_patch = patch(
+            'kiwi_stackbuild_plugin.deletions.StashDeletions'
+        )
+        self.mock_StashDeletions = self.stash_deletions_patch.start()
+        self.stash_archive_patch = patch(
+            'kiwi_stackbuild_plugin.archive.StashArchive'
+        )
+        self.mock_StashArchive = self.stash_archive_patch.start()
+        self.mock_StashArchive.return_value.get_layers.return_value = [
+            {'digest': 'sha256:abc', 'size': 42}
+        ]
+
+    def teardown_method(self, cls):
+        self.stash_index_patch.stop()
+        self.stash_deletions_patch.stop()
+        self.stash_archive_patch.stop()
 
     def _init_command_args(self):
         self.task.command_args = {}
@@ -29,6 +55,20 @@ class TestSystemStashTask:
         self.task.command_args['--root'] = None
         self.task.command_args['--tag'] = None
         self.task.command_args['--container-name'] = None
+        self.task.command_args['--blob-store'] = False
+        self.task.command_args['--incremental'] = False
+        self.task.command_args['--base'] = []
+        self.task.command_args['--archive'] = False
+        self.task.command_args['--no-archive'] = False
+        self.task.command_args['--compression'] = None
+        self.task.command_args['--compression-threads'] = None
+        self.task.command_args['--verify'] = False
+        self.task.command_args['--jobs'] = None
+        self.task.command_args['--gc'] = False
+        self.task.command_args['--max-size'] = None
+        self.task.command_args['--keep'] = None
+        self.task.command_args['--exclude'] = []
+        self.task.command_args['--metrics-file'] = None
 
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Help')
     def test_process_help(self, mock_Help):
@@ -42,7 +82,7 @@ class TestSystemStashTask:
             'kiwi::system::stash'
         )
 
-    @patch('kiwi_stackbuild_plugin.tasks.system_stash.DataOutput')
+    @patch('kiwi.utils.output.DataOutput')
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
     @patch('os.listdir')
     def test_process_stash_list(
@@ -57,6 +97,122 @@ class TestSystemStashTask:
         self.task.process()
         stashes.display.assert_called_once_with()
 
+    @patch('kiwi.utils.output.DataOutput')
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('os.path.isdir')
+    @patch('os.listdir')
+    def test_process_stash_list_sizes(
+        self, mock_os_listdir, mock_os_path_isdir, mock_StashBlobStore,
+        mock_DataOutput
+    ):
+        mock_os_listdir.return_value = ['b', '.blobs', 'a', 'c']
+        mock_os_path_isdir.return_value = True
+        self.mock_StashIndex.return_value.get_stashes.return_value = {
+            'a': {'logical_size': 2, 'deduplicated_size': 1},
+            'b': {'layers': 1, 'tags': ['latest']}
+        }
+        self._init_command_args()
+        self.task.command_args['--list'] = True
+        self.task.process()
+        self.mock_StashIndex.assert_called_once_with('/var/tmp/kiwi-stash')
+        mock_DataOutput.assert_called_once_with(
+            {
+                '/var/tmp/kiwi-stash': {
+                    'a': {'logical_size': 2, 'deduplicated_size': 1},
+                    'b': {'layers': 1, 'tags': ['latest']},
+                    'c': {}
+                }
+            }
+        )
+        # the blob store is not looked at
+        assert not mock_StashBlobStore.called
+
+    @patch('kiwi.utils.output.DataOutput')
+    def test_process_verify(self, mock_DataOutput, tmp_path):
+        stash_home = tmp_path / 'stash'
+        for name in ('archive', 'blobs', 'storage', '.blobs'):
+            (stash_home / name).mkdir(parents=True)
+        (stash_home / 'archive' / 'archive.tar').write_bytes(b'')
+        self._init_command_args()
+        self.task.command_args['--verify'] = True
+        self.task.command_args['--jobs'] = '2'
+        with patch.object(
+            StackBuildDefaults, 'get_stash_home',
+            return_value=str(stash_home)
+        ), patch(
+            'kiwi_stackbuild_plugin.archive.StashArchive'
+        ) as mock_StashArchive, patch(
+            'kiwi_stackbuild_plugin.blob_store.StashBlobStore'
+        ) as mock_StashBlobStore:
+            mock_StashArchive.return_value.verify.return_value = {}
+            blob_store = mock_StashBlobStore.return_value
+            blob_store.get_root.side_effect = \
+                lambda name: 'root' if name == 'blobs' else None
+            blob_store.verify_root.return_value = {}
+            self.task.process()
+            mock_StashArchive.assert_called_once_with(
+                str(stash_home / 'archive' / 'archive.tar')
+            )
+            mock_StashArchive.return_value.verify.assert_called_once_with(2)
+            blob_store.verify_root.assert_called_once_with('blobs', 2)
+            mock_DataOutput.assert_called_once_with(
+                {
+                    'archive': {'archive': {}, 'status': 'ok'},
+                    'blobs': {'blob_store': {}, 'status': 'ok'},
+                    'storage': {'status': 'unverified'}
+                }
+            )
+            blob_store.verify_root.return_value = {'etc/a': 'missing'}
+            with raises(KiwiStackBuildPluginStashCorrupted):
+                self.task.process()
+            self.task.command_args['--container-name'] = 'gone'
+            with raises(KiwiStackBuildPluginStashCorrupted):
+                self.task.process()
+            assert mock_DataOutput.call_args == call(
+                {'gone': {'status': 'missing'}}
+            )
+
+    @patch('kiwi.utils.output.DataOutput')
+    @patch('os.path.isdir')
+    def test_process_verify_no_stash_home(
+        self, mock_os_path_isdir, mock_DataOutput
+    ):
+        mock_os_path_isdir.return_value = False
+        self._init_command_args()
+        self.task.command_args['--verify'] = True
+        self.task.process()
+        mock_DataOutput.assert_called_once_with({})
+
+    @patch('kiwi.utils.output.DataOutput')
+    @patch('kiwi_stackbuild_plugin.collect.StashCollector')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    def test_process_gc(
+        self, mock_Privileges, mock_StashCollector, mock_DataOutput
+    ):
+        self._init_command_args()
+        self.task.command_args['--gc'] = True
+        self.task.command_args['--max-size'] = '1000'
+        self.task.command_args['--keep'] = '2'
+        self.task.process()
+        mock_Privileges.check_for_root_permissions.assert_called_once_with()
+        mock_StashCollector.assert_called_once_with('/var/tmp/kiwi-stash')
+        mock_StashCollector.return_value.collect.assert_called_once_with(
+            1000, 2
+        )
+        mock_DataOutput.assert_called_once_with(
+            mock_StashCollector.return_value.collect.return_value
+        )
+        self.task.command_args['--keep'] = None
+        self.task.process()
+        mock_StashCollector.return_value.collect.assert_called_with(1000, 0)
+
+    def test_process_gc_invalid_size(self):
+        self._init_command_args()
+        self.task.command_args['--gc'] = True
+        self.task.command_args['--max-size'] = '1G'
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
     def test_process_invalid_container_name(self, mock_Privileges):
         self._init_command_args()
@@ -65,7 +221,7 @@ class TestSystemStashTask:
             self.task.process()
 
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stash.OCI.new')
+    @patch('kiwi.oci_tools.OCI.new')
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
     @patch('os.path.isfile')
@@ -104,19 +260,49 @@ class TestSystemStashTask:
         oci.repack.assert_called_once_with(container_config)
         oci.set_config.assert_called_once_with(container_config)
         oci.post_process.assert_called_once_with()
-        oci.export_container_image.assert_called_once_with(
-            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar',
-            'oci-archive', 'tumbleweed:latest'
-        )
-        mock_Command_run.assert_called_once_with(
-            [
-                'podman', 'load', '-i',
-                '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar'
-            ]
+        mock_Path.wipe.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar'
         )
+        assert mock_Command_run.call_args_list == [
+            call(
+                [
+                    'podman', 'image', 'inspect', '--format', '{{.Id}}',
+                    'localhost/tumbleweed:latest'
+                ], raise_on_error=False
+            ),
+            call(
+                [
+                    'skopeo', 'copy',
+                    '--dest-compress', '--dest-compress-format', 'gzip',
+                    f'containers-storage:{oci.working_image}',
+                    'oci-archive:/var/tmp/kiwi-stash/tumbleweed/'
+                    'tumbleweed.tar:tumbleweed:latest'
+                ], custom_env=None
+            ),
+            call(
+                [
+                    'skopeo', 'copy',
+                    f'containers-storage:{oci.working_image}',
+                    'containers-storage:localhost/tumbleweed:latest'
+                ]
+            ),
+            call(
+                [
+                    'podman', 'image', 'inspect', '--format', '{{.Id}}',
+                    'localhost/tumbleweed:latest'
+                ], raise_on_error=False
+            ),
+            call(
+                [
+                    'podman', 'image', 'inspect', '--format',
+                    '{{.Size}} {{len .RootFS.Layers}}',
+                    'localhost/tumbleweed:latest'
+                ], raise_on_error=False
+            )
+        ]
 
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
-    @patch('kiwi_stackbuild_plugin.tasks.system_stash.OCI.new')
+    @patch('kiwi.oci_tools.OCI.new')
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
     @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
     @patch('os.path.isfile')
@@ -136,14 +322,595 @@ class TestSystemStashTask:
         mock_OCI_new.return_value = oci
         mock_os_path_isfile.return_value = True
         mock_os_path_abspath.return_value = 'absolute_root_dir_path'
-        self.task.process()
+        with patch.object(
+            SystemStashTask, '_get_archive_id', return_value='1:2'
+        ):
+            self.task.process()
         oci.import_container_image.assert_called_once_with(
             'oci-archive:/var/tmp/kiwi-stash/'
             'tumbleweed/tumbleweed.tar:tumbleweed:latest'
         )
+        self.mock_StashArchive.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar'
+        )
+        self.mock_StashIndex.return_value.add_stash.assert_called_once_with(
+            'tumbleweed', 'latest', {
+                'layers': 1,
+                'compressed_size': 42,
+                'uncompressed_size': None,
+                'description': 'tumbleweed',
+                'compression': 'gzip'
+            }
+        )
+        mock_Command_run.assert_any_call(
+            [
+                'skopeo', 'copy',
+                f'containers-storage:{oci.working_image}',
+                'containers-storage:localhost/tumbleweed:latest'
+            ]
+        )
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    def test_process_build_additional_layer_from_storage(
+        self, mock_Path, mock_Privileges, mock_OCI_new, mock_Command_run
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--no-archive'] = True
+        oci = Mock()
+        mock_OCI_new.return_value = oci
+        mock_Command_run.return_value = Mock(returncode=0, output='4096 2\n')
+        self.task.process()
+        oci.import_container_image.assert_called_once_with(
+            'containers-storage:localhost/tumbleweed:latest'
+        )
+        self.mock_StashIndex.return_value.add_stash.assert_called_once_with(
+            'tumbleweed', 'latest', {
+                'layers': 2,
+                'compressed_size': None,
+                'uncompressed_size': 4096,
+                'description': 'tumbleweed'
+            }
+        )
+        assert not oci.export_container_image.called
+        mock_Path.wipe.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar'
+        )
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    def test_process_build_metrics(
+        self, mock_Path, mock_Privileges, mock_OCI_new, mock_Command_run,
+        tmp_path
+    ):
+        metrics_file = tmp_path / 'metrics.json'
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--metrics-file'] = str(metrics_file)
+        self.task.process()
+        with open(metrics_file) as metrics:
+            report = json.load(metrics)
+        assert report['command'] == 'stash'
+        assert [phase['name'] for phase in report['phases']] == [
+            'init', 'unpack', 'sync_rootfs', 'repack', 'export', 'commit'
+        ]
+        assert report['counters']['synced_files'] > 0
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_compression(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--compression'] = 'zstd:chunked'
+        self.task.command_args['--compression-threads'] = '8'
+        oci = Mock()
+        mock_OCI_new.return_value = oci
+        mock_os_path_isfile.return_value = False
+        with patch.dict('os.environ', {'PATH': '/usr/bin'}, clear=True):
+            self.task.process()
+        mock_Command_run.assert_any_call(
+            [
+                'skopeo', 'copy',
+                '--dest-compress', '--dest-compress-format', 'zstd:chunked',
+                f'containers-storage:{oci.working_image}',
+                'oci-archive:/var/tmp/kiwi-stash/tumbleweed/'
+                'tumbleweed.tar:tumbleweed:latest'
+            ], custom_env={'PATH': '/usr/bin', 'GOMAXPROCS': '8'}
+        )
+        mock_Command_run.reset_mock()
+        self.task.command_args['--compression'] = 'gzip'
+        self.task.command_args['--compression-threads'] = None
+        self.task.process()
+        mock_Command_run.assert_any_call(
+            [
+                'skopeo', 'copy',
+                '--dest-compress', '--dest-compress-format', 'gzip',
+                f'containers-storage:{oci.working_image}',
+                'oci-archive:/var/tmp/kiwi-stash/tumbleweed/'
+                'tumbleweed.tar:tumbleweed:latest'
+            ], custom_env=None
+        )
+        mock_Command_run.reset_mock()
+        self.task.command_args['--compression'] = 'none'
+        self.task.process()
+        mock_Command_run.assert_any_call(
+            [
+                'skopeo', 'copy', '--dest-oci-accept-uncompressed-layers',
+                f'containers-storage:{oci.working_image}',
+                'oci-archive:/var/tmp/kiwi-stash/tumbleweed/'
+                'tumbleweed.tar:tumbleweed:latest'
+            ], custom_env=None
+        )
+
+    @patch('kiwi.utils.command_capabilities.CommandCapabilities')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    def test_repack(self, mock_Command_run, mock_CommandCapabilities):
+        from kiwi.oci_tools.umoci import OCIUmoci
+        oci = Mock(spec=OCIUmoci)
+        oci.working_image = '/layout:latest'
+        oci.oci_root_dir = '/bundle'
+        oci.creation_date = '2021-01-01T00:00:00Z'
+        oci._process_oci_history_to_arguments.return_value = [
+            '--history.author', 'kiwi'
+        ]
+        mock_CommandCapabilities.has_option_in_help.return_value = True
+        SystemStashTask._repack(oci, {})
         mock_Command_run.assert_called_once_with(
             [
-                'podman', 'load', '-i',
-                '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar'
+                'umoci', 'repack', '--history.author', 'kiwi',
+                '--history.created', '2021-01-01T00:00:00Z',
+                '--compress=none', '--image', '/layout:latest', '/bundle'
             ]
         )
+        mock_CommandCapabilities.has_option_in_help.assert_called_once_with(
+            'umoci', '--compress', ['repack', '--help'], raise_on_error=False
+        )
+        assert not oci.repack.called
+        # umoci without --compress and buildah repack as usual
+        mock_CommandCapabilities.has_option_in_help.return_value = False
+        SystemStashTask._repack(oci, {})
+        oci.repack.assert_called_once_with({})
+        buildah = Mock()
+        SystemStashTask._repack(buildah, {})
+        buildah.repack.assert_called_once_with({})
+        assert mock_Command_run.call_count == 1
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    def test_process_invalid_compression(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['--compression'] = 'xz'
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+        self.task.command_args['--compression'] = 'zstd'
+        self.task.command_args['--compression-threads'] = '0'
+        with raises(KiwiStackBuildPluginInvalidArgument):
+            self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_blob_store(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_StashBlobStore
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--blob-store'] = True
+        self.task.command_args['--exclude'] = ['/usr/share/doc/']
+        mock_os_path_isfile.return_value = False
+        blob_store = mock_StashBlobStore.return_value
+        blob_store.get_sizes.return_value = {
+            'logical_size': 8, 'deduplicated_size': 4
+        }
+        blob_store.add_root.return_value = {
+            'hardlink_bytes': 4, 'sparse_bytes': 0
+        }
+        with patch.object(
+            SystemStashTask, '_get_archive_id', return_value='1:2'
+        ), patch.object(
+            SystemStashTask, '_get_image_id', return_value=''
+        ):
+            with patch(
+                'kiwi_stackbuild_plugin.manifest.StashManifest'
+            ) as mock_StashManifest:
+                manifest = mock_StashManifest.from_root.return_value
+                manifest.meta = {}
+                self.task.process()
+        mock_StashBlobStore.assert_called_once_with('/var/tmp/kiwi-stash')
+        # the root tree is only stored in the blob store
+        assert not mock_OCI_new.called
+        mock_Path.wipe.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.tar'
+        )
+        mock_StashManifest.from_root.assert_called_once_with(
+            '../data/image-root',
+            ['dev/*', 'sys/*', 'proc/*', 'usr/share/doc'],
+            mock_StashManifest.load.return_value
+        )
+        blob_store.add_root.assert_called_once_with(
+            'tumbleweed', '../data/image-root',
+            ['dev/*', 'sys/*', 'proc/*', 'usr/share/doc'], manifest
+        )
+        assert self.task.metrics.counters['hardlink_saved_bytes'] == 4
+        manifest.save.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.manifest'
+        )
+        assert manifest.meta == {'layer': '1:2'}
+        mock_Command_run.assert_any_call(
+            ['podman', 'image', 'rm', 'localhost/tumbleweed:latest'],
+            raise_on_error=False
+        )
+        self.mock_StashIndex.return_value.add_stash.assert_called_once_with(
+            'tumbleweed', 'latest', {
+                'layers': None,
+                'compressed_size': None,
+                'uncompressed_size': 8,
+                'description': 'tumbleweed'
+            }
+        )
+        self.mock_StashDeletions.assert_called_once_with(
+            '/var/tmp/kiwi-stash', 'tumbleweed'
+        )
+        self.mock_StashDeletions.return_value.set.assert_called_once_with([])
+
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_base_stashes(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_Command_run, mock_StashBlobStore
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--blob-store'] = True
+        self.task.command_args['--base'] = ['base', 'app']
+        mock_os_path_isfile.return_value = False
+        blob_store = mock_StashBlobStore.return_value
+        blob_store.add_root.return_value = {
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        with patch.object(
+            SystemStashTask, '_get_archive_id', return_value='1:2'
+        ), patch(
+            'kiwi_stackbuild_plugin.manifest.StashManifest'
+        ) as mock_StashManifest:
+            base_manifest = mock_StashManifest.load.return_value
+            manifest = mock_StashManifest.from_root.return_value
+            manifest.meta = {}
+            manifest.get_deleted.return_value = ['etc/obsolete']
+            self.task.process()
+        assert mock_StashManifest.load.call_args_list[:2] == [
+            call('/var/tmp/kiwi-stash/base/base.manifest'),
+            call('/var/tmp/kiwi-stash/app/app.manifest')
+        ]
+        manifest.get_deleted.assert_called_once_with(
+            [base_manifest, base_manifest],
+            ['dev/*', 'sys/*', 'proc/*']
+        )
+        self.mock_StashDeletions.return_value.set.assert_called_once_with(
+            ['etc/obsolete']
+        )
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    def test_process_build_base_stash_without_manifest(self, mock_Privileges):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--base'] = ['base']
+        with patch(
+            'kiwi_stackbuild_plugin.manifest.StashManifest.load',
+            return_value=None
+        ):
+            with raises(KiwiStackBuildPluginStashNotFoundError):
+                self.task.process()
+
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_blob_store_archive(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_StashBlobStore
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--blob-store'] = True
+        self.task.command_args['--archive'] = True
+        mock_os_path_isfile.return_value = False
+        oci = mock_OCI_new.return_value
+        oci.working_image = 'oci-layout:base_layer'
+        blob_store = mock_StashBlobStore.return_value
+        blob_store.add_root.return_value = {
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        with patch.object(
+            SystemStashTask, '_get_image_id', return_value=''
+        ), patch.object(
+            SystemStashTask, '_get_working_image_ref',
+            return_value='oci:oci-layout:base_layer'
+        ), patch('kiwi_stackbuild_plugin.manifest.StashManifest'):
+            self.task.process()
+        oci.init_container.assert_called_once_with()
+        oci.sync_rootfs.assert_called_once_with(
+            '../data/image-root', ['dev/*', 'sys/*', 'proc/*']
+        )
+        mock_Command_run.assert_any_call(
+            [
+                'skopeo', 'copy', '--dest-compress',
+                '--dest-compress-format', 'gzip',
+                'oci:oci-layout:base_layer',
+                'oci-archive:/var/tmp/kiwi-stash/tumbleweed/'
+                'tumbleweed.tar:tumbleweed:latest'
+            ], custom_env=None
+        )
+        assert blob_store.add_root.called
+
+    @patch('kiwi_stackbuild_plugin.blob_store.StashBlobStore')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_drops_outdated_blob_store_root(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_StashBlobStore
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        mock_os_path_isfile.return_value = False
+        blob_store = mock_StashBlobStore.return_value
+        blob_store.get_root.return_value = '/var/tmp/kiwi-stash/x/root'
+        self.task.process()
+        blob_store.remove_root.assert_called_once_with('tumbleweed')
+        assert not blob_store.add_root.called
+
+    @patch('kiwi_stackbuild_plugin.manifest.StashManifest')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_incremental_initial_layer(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_StashManifest
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--incremental'] = True
+        oci = Mock()
+        mock_OCI_new.return_value = oci
+        mock_os_path_isfile.return_value = False
+        mock_StashManifest.load.return_value = None
+        manifest = mock_StashManifest.from_root.return_value
+        manifest.meta = {}
+        with patch.object(
+            SystemStashTask, '_get_image_id', return_value='1:2'
+        ):
+            self.task.process()
+        mock_StashManifest.from_root.assert_called_once_with(
+            '../data/image-root', ['dev/*', 'sys/*', 'proc/*'], None
+        )
+        oci.sync_rootfs.assert_called_once_with(
+            '../data/image-root', ['dev/*', 'sys/*', 'proc/*']
+        )
+        assert manifest.meta == {'layer': '1:2'}
+        manifest.save.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.manifest'
+        )
+
+    @patch('kiwi_stackbuild_plugin.manifest.StashManifest')
+    @patch('kiwi.utils.sync.DataSync')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_incremental_layer(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_DataSync, mock_StashManifest,
+        tmp_path
+    ):
+        rootfs = tmp_path / 'rootfs'
+        (rootfs / 'etc' / 'gone.d').mkdir(parents=True)
+        (rootfs / 'etc' / 'gone.d' / 'file').write_text('gone')
+        (rootfs / 'etc' / 'gone').write_text('gone')
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--incremental'] = True
+        oci = Mock()
+        oci.oci_root_dir = str(rootfs)
+        mock_OCI_new.return_value = oci
+        mock_os_path_isfile.return_value = True
+        previous_manifest = mock_StashManifest.load.return_value
+        previous_manifest.meta = {'layer': '1:2'}
+        manifest = mock_StashManifest.from_root.return_value
+        manifest.meta = {}
+        manifest.diff.return_value = (
+            ['etc/new'], ['etc/gone', 'etc/gone.d', 'etc/gone.d/file']
+        )
+        files_from = []
+
+        def sync_data(options):
+            with open(options[-1].split('=', 1)[1], 'rb') as files:
+                files_from.append(files.read())
+
+        mock_DataSync.return_value.sync_data.side_effect = sync_data
+        with patch.object(
+            SystemStashTask, '_get_image_id', return_value='1:2'
+        ):
+            self.task.process()
+        mock_StashManifest.load.assert_called_once_with(
+            '/var/tmp/kiwi-stash/tumbleweed/tumbleweed.manifest'
+        )
+        manifest.diff.assert_called_once_with(previous_manifest)
+        assert not oci.sync_rootfs.called
+        assert os.listdir(rootfs / 'etc') == []
+        mock_DataSync.assert_called_once_with(
+            '../data/image-root/', str(rootfs)
+        )
+        mock_DataSync.return_value.sync_data.assert_called_once_with(
+            options=[
+                '--archive', '--hard-links', '--xattrs', '--acls',
+                '--one-file-system', '--inplace',
+                '--filter', '-x! user.*',
+                '--filter', '-x! security.ima*',
+                '--filter', '-x! security.capability*',
+                '--from0', ANY
+            ]
+        )
+        assert files_from == [b'etc/new']
+        oci.repack.assert_called_once_with(ANY)
+
+    @patch('kiwi.utils.command_capabilities.CommandCapabilities')
+    @patch('kiwi_stackbuild_plugin.layer.StashLayer')
+    @patch('kiwi_stackbuild_plugin.manifest.StashManifest')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_incremental_layer_umoci(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_StashManifest, mock_StashLayer,
+        mock_CommandCapabilities
+    ):
+        from kiwi.oci_tools.umoci import OCIUmoci
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--incremental'] = True
+        oci = Mock(spec=OCIUmoci)
+        oci.working_image = '/layout:latest'
+        oci.creation_date = '2021-01-01T00:00:00Z'
+        oci._process_oci_history_to_arguments.return_value = [
+            '--history.author', 'kiwi'
+        ]
+        mock_OCI_new.return_value = oci
+        mock_os_path_isfile.return_value = True
+        mock_CommandCapabilities.has_option_in_help.return_value = True
+        previous_manifest = mock_StashManifest.load.return_value
+        previous_manifest.meta = {'layer': '1:2'}
+        manifest = mock_StashManifest.from_root.return_value
+        manifest.meta = {}
+        manifest.diff.return_value = (['etc/new'], ['etc/gone'])
+        mock_StashLayer.return_value.create.return_value = {
+            'entries': 1, 'whiteouts': 1
+        }
+        with patch.object(
+            SystemStashTask, '_get_image_id', return_value='1:2'
+        ):
+            self.task.process()
+        assert not oci.unpack.called
+        assert not oci.repack.called
+        assert not oci.sync_rootfs.called
+        mock_StashLayer.assert_called_once_with('../data/image-root')
+        mock_StashLayer.return_value.create.assert_called_once_with(
+            ANY, ['etc/new'], ['etc/gone']
+        )
+        mock_Command_run.assert_any_call(
+            [
+                'umoci', 'raw', 'add-layer', '--history.author', 'kiwi',
+                '--history.created', '2021-01-01T00:00:00Z',
+                '--compress=none', '--image', '/layout:latest', ANY
+            ]
+        )
+        oci.set_config.assert_called_once_with(ANY)
+        oci.post_process.assert_called_once_with()
+
+    @patch('kiwi.oci_tools.umoci.CommandCapabilities')
+    def test_can_add_layer(self, mock_CommandCapabilities):
+        from kiwi.oci_tools.umoci import OCIUmoci
+        assert SystemStashTask._can_add_layer(OCIUmoci())
+        assert not SystemStashTask._can_add_layer(Mock())
+
+    @patch('kiwi.utils.sync.DataSync')
+    def test_sync_rootfs_changes_nothing_changed(self, mock_DataSync):
+        oci = Mock()
+        SystemStashTask._sync_rootfs_changes(oci, 'root', [], [])
+        assert not mock_DataSync.called
+
+    @patch('kiwi.oci_tools.umoci.CommandCapabilities')
+    def test_get_container_rootfs(self, mock_CommandCapabilities):
+        from kiwi.oci_tools.umoci import OCIUmoci
+        oci = OCIUmoci()
+        oci.oci_root_dir = '/bundle'
+        assert SystemStashTask._get_container_rootfs(oci) == '/bundle/rootfs'
+        oci = Mock()
+        oci.oci_root_dir = '/mount'
+        assert SystemStashTask._get_container_rootfs(oci) == '/mount'
+
+    @patch('kiwi_stackbuild_plugin.manifest.StashManifest')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    @patch('kiwi.oci_tools.OCI.new')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Privileges')
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Path')
+    @patch('os.path.isfile')
+    def test_process_build_incremental_archive_changed(
+        self, mock_os_path_isfile, mock_Path, mock_Privileges,
+        mock_OCI_new, mock_Command_run, mock_StashManifest
+    ):
+        self._init_command_args()
+        self.task.command_args['--root'] = '../data/image-root'
+        self.task.command_args['--incremental'] = True
+        oci = Mock()
+        mock_OCI_new.return_value = oci
+        mock_os_path_isfile.return_value = True
+        cached_manifest = mock_StashManifest.load.return_value
+        cached_manifest.meta = {'layer': '1:2'}
+        manifest = mock_StashManifest.from_root.return_value
+        manifest.meta = {}
+        with patch.object(
+            SystemStashTask, '_get_image_id', return_value='3:4'
+        ):
+            self.task.process()
+        mock_StashManifest.from_root.assert_called_once_with(
+            '../data/image-root', ['dev/*', 'sys/*', 'proc/*'],
+            cached_manifest
+        )
+        assert not manifest.diff.called
+        oci.sync_rootfs.assert_called_once_with(
+            '../data/image-root', ['dev/*', 'sys/*', 'proc/*']
+        )
+        assert manifest.meta == {'layer': '3:4'}
+
+    def test_get_archive_id(self, tmp_path):
+        archive = tmp_path / 'stash.tar'
+        archive.write_bytes(b'data')
+        os.utime(archive, ns=(0, 5))
+        assert SystemStashTask._get_archive_id(str(archive)) == '4:5'
+        assert SystemStashTask._get_archive_id(str(tmp_path / 'x')) == ''
+
+    @patch('kiwi_stackbuild_plugin.tasks.system_stash.Command.run')
+    def test_get_image_id(self, mock_Command_run):
+        mock_Command_run.return_value = Mock(returncode=0, output='id\n')
+        assert SystemStashTask._get_image_id('localhost/stash') == 'id'
+        mock_Command_run.return_value = Mock(returncode=1, output='')
+        assert SystemStashTask._get_image_id('localhost/stash') == ''
+
+    @patch('kiwi.oci_tools.umoci.CommandCapabilities')
+    def test_get_working_image_ref(self, mock_CommandCapabilities):
+        from kiwi.oci_tools.umoci import OCIUmoci
+        oci = OCIUmoci()
+        oci.working_image = '/layout:latest'
+        assert SystemStashTask._get_working_image_ref(oci) == \
+            'oci:/layout:latest'
+        oci = Mock()
+        oci.working_image = 'image-id'
+        assert SystemStashTask._get_working_image_ref(oci) == \
+            'containers-storage:image-id'
@@ -0,0 +1,119 @@
+import os
+import stat
+import errno
+import logging
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.tree import StackTree
+
+
+class TestStackTree:
+    def test_get_paths(self, tmp_path):
+        root = str(tmp_path / 'root')
+        os.makedirs(os.path.join(root, 'usr', 'bin'))
+        os.makedirs(os.path.join(root, 'private'))
+        for name in ('usr/bin/tool', 'private/data'):
+            with open(os.path.join(root, name), 'w') as data:
+                data.write(name)
+        os.symlink('usr/bin', os.path.join(root, 'bin'))
+        lstat = os.lstat
+
+        def mounted_private(path):
+            path_stat = lstat(path)
+            if path == os.path.join(root, 'private'):
+                return os.stat_result(
+                    path_stat[:2] + (path_stat.st_dev + 1,) + path_stat[3:]
+                )
+            return path_stat
+
+        with patch('os.lstat', side_effect=mounted_private):
+            paths = list(StackTree.get_paths(root))
+        # a mount point is listed but not descended into
+        assert sorted(paths) == [
+            'bin', 'private', 'usr', 'usr/bin', 'usr/bin/tool'
+        ]
+        assert paths.index('usr') < paths.index('usr/bin')
+
+    def test_get_link_group(self):
+        linked = os.stat_result((0, 5, 7, 2) + (0,) * 6)
+        single = os.stat_result((0, 6, 7, 1) + (0,) * 6)
+        assert StackTree.get_link_group('a', linked, None) == (7, 5)
+        assert StackTree.get_link_group('b', single, None) is None
+        assert StackTree.get_link_group('a', linked, {'b': 'b'}) is None
+        assert StackTree.get_link_group('b', single, {'b': 'a'}) == 'a'
+
+    @patch('os.setxattr')
+    @patch('os.getxattr')
+    @patch('os.listxattr')
+    def test_copy_metadata(
+        self, mock_listxattr, mock_getxattr, mock_setxattr, tmp_path, caplog
+    ):
+        source = tmp_path / 'source'
+        source.write_bytes(b'data')
+        os.chmod(source, 0o640)
+        os.utime(source, ns=(10, 20))
+        target = tmp_path / 'target'
+        target.write_bytes(b'data')
+        mock_listxattr.return_value = ['user.b', 'user.a']
+        mock_getxattr.return_value = b'value'
+        mock_setxattr.side_effect = [None, OSError('not supported')]
+        StackTree.copy_metadata(str(source), str(target), os.lstat(source))
+        target_stat = os.lstat(target)
+        assert stat.S_IMODE(target_stat.st_mode) == 0o640
+        assert target_stat.st_mtime_ns == 20
+        assert mock_setxattr.call_args_list[0][0] == (
+            str(target), 'user.a', b'value'
+        )
+        assert 'Setting user.b' in caplog.text
+        mock_listxattr.side_effect = OSError
+        assert StackTree.get_xattrs(str(source)) == []
+
+    @patch('os.lseek')
+    def test_get_data_segments_no_hole_support(self, mock_lseek):
+        mock_lseek.side_effect = OSError(errno.EINVAL, 'Invalid argument')
+        assert list(StackTree._get_data_segments(1, 10)) == [(0, 10)]
+
+    @patch('os.lseek')
+    def test_get_data_segments_trailing_hole(self, mock_lseek):
+        mock_lseek.side_effect = [
+            0, 4, OSError(errno.ENXIO, 'No such device or address')
+        ]
+        assert list(StackTree._get_data_segments(1, 10)) == [(0, 4)]
+
+    def test_copy_range_fallback(self, tmp_path):
+        source = tmp_path / 'source'
+        source.write_bytes(b'0123456789')
+        target = tmp_path / 'target'
+        with open(source, 'rb') as source_file:
+            with open(target, 'wb') as target_file:
+                with patch(
+                    'os.copy_file_range',
+                    side_effect=OSError(errno.EXDEV, 'Cross-device link')
+                ) as mock_copy_file_range, patch(
+                    'kiwi_stackbuild_plugin.tree.COPY_CHUNK_SIZE', 4
+                ):
+                    assert not StackTree._copy_range(
+                        source_file.fileno(), target_file.fileno(), 2, 20
+                    )
+        assert target.read_bytes() == b'\0\0' + b'23456789'
+        mock_copy_file_range.assert_called_once()
+
+    def test_copy_data_fallback_logged_once(self, tmp_path, caplog):
+        source = tmp_path / 'source'
+        source.write_bytes(b'0123456789')
+        target = tmp_path / 'target'
+        with patch(
+            'os.copy_file_range',
+            side_effect=OSError(errno.EXDEV, 'Cross-device link')
+        ) as mock_copy_file_range, patch.object(
+            StackTree, '_get_data_segments',
+            return_value=[(0, 4), (6, 4)]
+        ), patch(
+            'kiwi_stackbuild_plugin.tree.COPY_CHUNK_SIZE', 2
+        ), caplog.at_level(logging.DEBUG, logger='kiwi'):
+            assert StackTree.copy_data(
+                str(source), str(target), 10
+            ) == 2
+        assert target.read_bytes() == b'0123' + b'\0\0' + b'6789'
+        mock_copy_file_range.assert_called_once()
+        assert caplog.text.count('copy_file_range failed') == 1
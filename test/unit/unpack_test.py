@@ -0,0 +1,379 @@
+import io
+import os
+import json
+import stat
+import tarfile
+from pytest import raises
+from unittest.mock import patch
+
+from kiwi_stackbuild_plugin.archive import StashArchive
+from kiwi_stackbuild_plugin.unpack import StashUnpacker
+from kiwi_stackbuild_plugin.path_filter import StashPathFilter
+from kiwi_stackbuild_plugin.exceptions import (
+    KiwiStackBuildPluginUnpackFailed
+)
+
+
+class TestStashUnpacker:
+    def _layer(self, entries):
+        layer = io.BytesIO()
+        with tarfile.open(fileobj=layer, mode='w', format=tarfile.PAX_FORMAT) \
+                as archive:
+            for name, kind, data in entries:
+                info = tarfile.TarInfo(name)
+                info.mtime = 10
+                info.uid = os.getuid()
+                info.gid = os.getgid()
+                if kind == 'dir':
+                    info.type = tarfile.DIRTYPE
+                    info.mode = data or 0o755
+                    archive.addfile(info)
+                elif kind == 'symlink':
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = data
+                    archive.addfile(info)
+                elif kind == 'link':
+                    info.type = tarfile.LNKTYPE
+                    info.mode = 0o640
+                    info.linkname = data
+                    archive.addfile(info)
+                else:
+                    info.mode = 0o640
+                    if kind == 'xattr':
+                        info.pax_headers = {
+                            'SCHILY.xattr.user.stash': 'value'
+                        }
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+        layer.seek(0)
+        return layer
+
+    def _create_root(self, target):
+        StashUnpacker(None).unpack_layer(
+            self._layer(
+                [
+                    ('./', 'dir', None),
+                    ('./etc', 'dir', None),
+                    ('./etc/conf', 'file', b'conf'),
+                    ('./etc/obsolete', 'file', b'obsolete'),
+                    ('./opt', 'dir', None),
+                    ('./opt/app', 'dir', None),
+                    ('./opt/app/old', 'file', b'old'),
+                    ('./opt/data', 'dir', None),
+                    ('./opt/data/old', 'file', b'old'),
+                    ('./bin', 'symlink', 'usr/bin'),
+                    ('./usr', 'dir', None),
+                    ('./usr/bin', 'dir', None),
+                    ('./usr/bin/tool', 'xattr', b'tool'),
+                    ('./usr/bin/link', 'link', 'usr/bin/tool'),
+                    ('./var', 'file', b'file replaced by a directory')
+                ]
+            ), target
+        )
+
+    def test_unpack_layer(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        self._create_root(target)
+        tool = os.path.join(target, 'usr', 'bin', 'tool')
+        with open(tool, 'rb') as data:
+            assert data.read() == b'tool'
+        assert stat.S_IMODE(os.lstat(tool).st_mode) == 0o640
+        assert os.path.samefile(tool, os.path.join(target, 'usr/bin/link'))
+        assert os.readlink(os.path.join(target, 'bin')) == 'usr/bin'
+        assert os.lstat(os.path.join(target, 'usr')).st_mtime == 10
+        try:
+            assert os.getxattr(tool, 'user.stash') == b'value'
+        except OSError:
+            # no user xattrs on the test filesystem
+            pass
+
+    def test_unpack_layer_no_parent_entries(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        StashUnpacker(None).unpack_layer(
+            self._layer([('usr/bin/foo', 'file', b'foo')]), target
+        )
+        with open(os.path.join(target, 'usr', 'bin', 'foo'), 'rb') as data:
+            assert data.read() == b'foo'
+
+    def test_unpack_layer_whiteouts(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        self._create_root(target)
+        stats = StashUnpacker._get_stats()
+        StashUnpacker(None).unpack_layer(
+            self._layer(
+                [
+                    ('etc/.wh.obsolete', 'file', b''),
+                    ('etc/conf', 'file', b'new conf'),
+                    ('opt', 'dir', None),
+                    ('opt/data', 'dir', None),
+                    ('opt/data/new', 'file', b'new'),
+                    ('opt/.wh..wh..opq', 'file', b''),
+                    ('.wh.bin', 'file', b''),
+                    ('bin', 'dir', None),
+                    ('usr/bin/tool', 'file', b'new tool'),
+                    ('var', 'dir', None),
+                    ('var/.wh..wh..opq', 'file', b''),
+                    ('etc/conf.d', 'symlink', 'conf')
+                ]
+            ), target, stats
+        )
+        assert stats == {
+            'files': 4, 'bytes': 19, 'whiteouts': 4,
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        assert sorted(os.listdir(os.path.join(target, 'etc'))) == [
+            'conf', 'conf.d'
+        ]
+        with open(os.path.join(target, 'etc', 'conf')) as data:
+            assert data.read() == 'new conf'
+        # the opaque directory keeps only the content of the layer
+        assert os.listdir(os.path.join(target, 'opt')) == ['data']
+        assert os.listdir(os.path.join(target, 'opt', 'data')) == ['new']
+        assert os.path.isdir(os.path.join(target, 'bin'))
+        assert not os.path.islink(os.path.join(target, 'bin'))
+        assert os.path.isdir(os.path.join(target, 'var'))
+        # replacing the file does not write through the hardlink
+        with open(os.path.join(target, 'usr', 'bin', 'link')) as data:
+            assert data.read() == 'tool'
+
+    def test_unpack_layer_whiteout_own_entry(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        self._create_root(target)
+        StashUnpacker(None).unpack_layer(
+            self._layer(
+                [
+                    ('usr/bin', 'dir', None),
+                    ('usr/bin/new', 'file', b'new'),
+                    ('usr/.wh.bin', 'file', b''),
+                    ('etc/motd', 'file', b'motd'),
+                    ('etc/.wh.motd', 'file', b'')
+                ]
+            ), target
+        )
+        # the whiteout hides the lower entries only
+        assert os.listdir(os.path.join(target, 'usr', 'bin')) == ['new']
+        assert os.path.isfile(os.path.join(target, 'etc', 'motd'))
+
+    def test_unpack_layer_path_filter(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        StashUnpacker(
+            None, StashPathFilter(['usr', 'etc'], ['usr/bin/tool'])
+        ).unpack_layer(
+            self._layer(
+                [
+                    ('etc', 'dir', None),
+                    ('etc/conf', 'file', b'conf'),
+                    ('opt', 'dir', None),
+                    ('opt/data', 'file', b'data'),
+                    ('usr', 'dir', None),
+                    ('usr/bin', 'dir', None),
+                    ('usr/bin/tool', 'file', b'tool'),
+                    ('usr/bin/link', 'link', 'usr/bin/tool'),
+                    ('usr/bin/other', 'file', b'other'),
+                    ('usr/bin/other-link', 'link', 'usr/bin/other')
+                ]
+            ), target
+        )
+        assert sorted(os.listdir(target)) == ['etc', 'usr']
+        # a hardlink to a filtered file has no data to link to
+        assert sorted(os.listdir(os.path.join(target, 'usr', 'bin'))) == [
+            'other', 'other-link'
+        ]
+
+    def test_unpack_layer_unsafe_paths(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        unpacker = StashUnpacker(None)
+        with raises(KiwiStackBuildPluginUnpackFailed):
+            unpacker.unpack_layer(
+                self._layer([('../escape', 'file', b'')]), target
+            )
+        # symlinks are resolved inside of the root tree
+        unpacker.unpack_layer(
+            self._layer(
+                [
+                    ('outside', 'symlink', '/'),
+                    ('outside/escape', 'file', b''),
+                    ('up', 'symlink', '../..'),
+                    ('up/escape-up', 'file', b'')
+                ]
+            ), target
+        )
+        assert not os.path.exists(tmp_path / 'escape')
+        assert not os.path.exists(tmp_path / 'escape-up')
+        assert os.path.isfile(os.path.join(target, 'escape'))
+        assert os.path.isfile(os.path.join(target, 'escape-up'))
+        with raises(KiwiStackBuildPluginUnpackFailed):
+            unpacker.unpack_layer(
+                self._layer(
+                    [
+                        ('loop', 'symlink', 'loop'),
+                        ('loop/file', 'file', b'')
+                    ]
+                ), target
+            )
+
+    def test_unpack_layer_usrmerge(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        StashUnpacker(None).unpack_layer(
+            self._layer(
+                [
+                    ('usr', 'dir', None),
+                    ('usr/lib', 'dir', None),
+                    ('lib', 'symlink', '/usr/lib'),
+                    ('run', 'dir', None),
+                    ('var', 'dir', None),
+                    ('var/run', 'symlink', '/run'),
+                    ('lib/libc.so', 'file', b'libc'),
+                    ('lib/libc.so.link', 'link', 'lib/libc.so'),
+                    ('usr/lib64', 'symlink', '../usr/lib'),
+                    ('usr/lib64/libm.so', 'file', b'libm'),
+                    ('var/run/pid', 'file', b'1'),
+                    ('var/run/lock', 'file', b'1')
+                ]
+            ), target
+        )
+        StashUnpacker(None).unpack_layer(
+            self._layer([('var/run/.wh.pid', 'file', b'')]), target
+        )
+        libc = os.path.join(target, 'usr', 'lib', 'libc.so')
+        with open(libc) as data:
+            assert data.read() == 'libc'
+        assert os.path.samefile(
+            libc, os.path.join(target, 'usr', 'lib', 'libc.so.link')
+        )
+        assert os.readlink(os.path.join(target, 'lib')) == '/usr/lib'
+        assert os.path.isfile(os.path.join(target, 'usr', 'lib', 'libm.so'))
+        assert not os.path.exists(os.path.join(target, 'run', 'pid'))
+        assert os.path.isfile(os.path.join(target, 'run', 'lock'))
+
+    def test_remove_paths(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        self._create_root(target)
+        StashUnpacker.remove_paths(
+            target, ['etc/obsolete', 'opt/app', 'bin/tool', 'usr/gone', '/']
+        )
+        assert os.listdir(os.path.join(target, 'etc')) == ['conf']
+        assert os.listdir(os.path.join(target, 'opt')) == ['data']
+        # the symlink is resolved inside of the root tree
+        assert os.listdir(os.path.join(target, 'usr', 'bin')) == ['link']
+        with raises(KiwiStackBuildPluginUnpackFailed):
+            StashUnpacker.remove_paths(target, ['../outside'])
+
+    def test_unpack_layer_xattr_failed(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        with patch('os.setxattr', side_effect=OSError('not supported')):
+            StashUnpacker(None).unpack_layer(
+                self._layer([('file', 'xattr', b'data')]), target
+            )
+        assert os.path.isfile(os.path.join(target, 'file'))
+
+    def test_unpack_layer_punch_holes_and_hardlinks(self, tmp_path):
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        data = b'data' + bytes(3 * 4096) + b'tail' + bytes(8192)
+        stats = StashUnpacker._get_stats()
+        with patch('kiwi_stackbuild_plugin.unpack.READ_CHUNK_SIZE', 8192):
+            StashUnpacker(None, punch_holes=True).unpack_layer(
+                self._layer(
+                    [
+                        ('db', 'file', data),
+                        ('db.link', 'link', 'db')
+                    ]
+                ), target, stats
+            )
+        db = os.path.join(target, 'db')
+        with open(db, 'rb') as db_data:
+            assert db_data.read() == data
+        assert stat.S_IMODE(os.lstat(db).st_mode) == 0o640
+        assert os.lstat(db).st_mtime == 10
+        assert os.path.samefile(db, os.path.join(target, 'db.link'))
+        assert stats['hardlink_bytes'] == len(data)
+        assert stats['sparse_bytes'] == 3 * 4096 + 8
+        assert stats['files'] == 2
+
+    def test_unpack_layer_keeps_allocated_zeros(self, tmp_path):
+        # preallocated files like swap files must stay allocated
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        data = bytes(1024 * 1024)
+        stats = StashUnpacker._get_stats()
+        StashUnpacker(None).unpack_layer(
+            self._layer([('swapfile', 'file', data)]), target, stats
+        )
+        swapfile = os.path.join(target, 'swapfile')
+        with open(swapfile, 'rb') as swap_data:
+            assert swap_data.read() == data
+        assert os.lstat(swapfile).st_blocks * 512 >= len(data)
+        assert stats['sparse_bytes'] == 0
+
+    def test_unpack_layer_sparse_member(self, tmp_path):
+        # the holes of a sparse tar member are kept
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        layer = io.BytesIO()
+        with tarfile.open(fileobj=layer, mode='w', format=tarfile.PAX_FORMAT) \
+                as archive:
+            info = tarfile.TarInfo('sparse')
+            info.mode = 0o640
+            info.size = 8
+            info.pax_headers = {
+                'GNU.sparse.map': '0,4,8192,4',
+                'GNU.sparse.size': str(4 * 4096)
+            }
+            archive.addfile(info, io.BytesIO(b'datatail'))
+        layer.seek(0)
+        stats = StashUnpacker._get_stats()
+        with patch('kiwi_stackbuild_plugin.unpack.READ_CHUNK_SIZE', 1024):
+            StashUnpacker(None).unpack_layer(layer, target, stats)
+        with open(os.path.join(target, 'sparse'), 'rb') as sparse_data:
+            assert sparse_data.read() == \
+                b'data' + bytes(8188) + b'tail' + bytes(8188)
+        assert stats['sparse_bytes'] == 4 * 4096 - 8
+        assert stats['bytes'] == 4 * 4096
+
+    def test_unpack(self, tmp_path):
+        layers = [
+            self._layer([('etc', 'dir', None), ('etc/a', 'file', b'a')]),
+            self._layer([('etc/.wh.a', 'file', b''), ('etc/b', 'file', b'b')])
+        ]
+        members = {
+            'index.json': json.dumps(
+                {'manifests': [{'digest': 'sha256:manifest'}]}
+            ).encode(),
+            'blobs/sha256/manifest': json.dumps(
+                {
+                    'config': {'digest': 'sha256:config'},
+                    'layers': [
+                        {
+                            'digest': f'sha256:layer{number}',
+                            'mediaType':
+                                'application/vnd.oci.image.layer.v1.tar'
+                        } for number in range(len(layers))
+                    ]
+                }
+            ).encode()
+        }
+        for number, layer in enumerate(layers):
+            members[f'blobs/sha256/layer{number}'] = layer.getvalue()
+        filename = str(tmp_path / 'stash.tar')
+        with tarfile.open(filename, 'w') as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        target = str(tmp_path / 'root')
+        os.makedirs(target)
+        assert StashUnpacker(StashArchive(filename)).unpack(target) == {
+            'files': 2, 'bytes': 2, 'whiteouts': 1,
+            'hardlink_bytes': 0, 'sparse_bytes': 0
+        }
+        assert os.listdir(os.path.join(target, 'etc')) == ['b']